@@ -9,7 +9,7 @@ from pyramid_beaker import session_factory_from_settings
 from six.moves.urllib.parse import urlencode  # pylint: disable=F0401,E0611
 
 from .route import Root
-from .util import BetterScrapingLocator
+from .util import BetterScrapingLocator, TimedCache
 
 
 __version__ = "1.0.9"
@@ -79,6 +79,15 @@ def includeme(config):
             for fn in config.registry.postfork_hooks:
                 fn()
 
+    # Pre-rendered /simple index, keyed by the effective principals
+    index_cache_time = int(settings.get("pypi.index_cache_time", 0))
+    if index_cache_time > 0:
+        config.registry.index_cache = TimedCache(
+            index_cache_time, max_size=int(settings.get("pypi.index_cache_size", 100))
+        )
+    else:
+        config.registry.index_cache = None
+
     config.include("pypicloud.auth")
     config.include("pypicloud.access")
     config.include("pypicloud.cache")
@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 import six
 import hmac
 import hashlib
+import os
 import time
 from collections import defaultdict
 from passlib.apps import LazyCryptContext
@@ -18,6 +19,8 @@ from pyramid.security import (
 )
 from pyramid.settings import aslist
 
+from pypicloud.util import TimedCache
+
 
 DEFAULT_ROUNDS = 535000
 
@@ -50,6 +53,12 @@ def groups_to_principals(groups):
 
 
 ONE_WEEK = 60 * 60 * 24 * 7
+ONE_YEAR = 60 * 60 * 24 * 365
+# Principal for requests that authenticated with a read-only API token
+READ_ONLY_TOKEN = "token:read"
+TOKEN_SCOPES = ("read", "write")
+# Per-process key for the digests stored in the credential cache
+CREDENTIAL_KEY = os.urandom(32)
 
 
 class IAccessBackend(object):
@@ -58,6 +67,8 @@ class IAccessBackend(object):
 
     mutable = False
     ROOT_ACL = [
+        (Deny, READ_ONLY_TOKEN, "write"),
+        (Deny, READ_ONLY_TOKEN, "admin"),
         (Allow, Authenticated, "login"),
         (Allow, "admin", ALL_PERMISSIONS),
         (Deny, Everyone, ALL_PERMISSIONS),
@@ -72,6 +83,10 @@ class IAccessBackend(object):
         pwd_context=None,
         token_expiration=ONE_WEEK,
         signing_key=None,
+        api_token_expiration=ONE_YEAR,
+        principal_cache=None,
+        credential_cache=None,
+        api_token_cache=None,
     ):
         self.request = request
         self.default_read = default_read
@@ -80,11 +95,34 @@ class IAccessBackend(object):
         self.pwd_context = pwd_context
         self.token_expiration = token_expiration
         self.signing_key = signing_key
+        self.api_token_expiration = api_token_expiration
+        self.principal_cache = principal_cache
+        self.credential_cache = credential_cache
+        self.api_token_cache = api_token_cache
+        self._principals = {}
 
     @classmethod
     def configure(cls, settings):
         """ Configure the access backend with app settings """
         rounds = int(settings.get("auth.rounds", DEFAULT_ROUNDS))
+        principal_cache_time = int(settings.get("auth.principal_cache_time", 0))
+        principal_cache = None
+        if principal_cache_time > 0:
+            principal_cache = TimedCache(principal_cache_time)
+        credential_cache_time = int(settings.get("auth.credential_cache_time", 0))
+        credential_cache = None
+        if credential_cache_time > 0:
+            credential_cache = TimedCache(
+                credential_cache_time,
+                max_size=int(settings.get("auth.credential_cache_size", 1000)),
+            )
+        api_token_cache_time = int(settings.get("auth.api_token_cache_time", 300))
+        api_token_cache = None
+        if api_token_cache_time > 0:
+            api_token_cache = TimedCache(
+                api_token_cache_time,
+                max_size=int(settings.get("auth.api_token_cache_size", 1000)),
+            )
         return {
             "default_read": aslist(
                 settings.get("pypi.default_read", ["authenticated"])
@@ -96,6 +134,12 @@ class IAccessBackend(object):
             "pwd_context": get_pwd_context(rounds),
             "token_expiration": int(settings.get("auth.token_expire", ONE_WEEK)),
             "signing_key": settings.get("auth.signing_key"),
+            "api_token_expiration": int(
+                settings.get("auth.api_token_expire", ONE_YEAR)
+            ),
+            "principal_cache": principal_cache,
+            "credential_cache": credential_cache,
+            "api_token_cache": api_token_cache,
         }
 
     @classmethod
@@ -107,6 +151,50 @@ class IAccessBackend(object):
         """
         Get all allowed permissions for all principals on a package
 
+        Returns
+        -------
+        perms : dict
+            Mapping of principal to tuple of permissions
+
+        """
+        return self._merge_permissions(
+            self.user_permissions(package), self.group_permissions(package)
+        )
+
+    def bulk_allowed_permissions(self, packages):
+        """
+        Get all allowed permissions for all principals on many packages
+
+        Backends should override this if they can fetch the permissions for
+        many packages at once.
+
+        Parameters
+        ----------
+        packages : list
+            List of package names
+
+        Returns
+        -------
+        perms : dict
+            Mapping of package name to the result of
+            :meth:`.allowed_permissions` for that package
+
+        """
+        return dict(
+            ((package, self.allowed_permissions(package)) for package in packages)
+        )
+
+    def _merge_permissions(self, user_perms, group_perms):
+        """
+        Construct the principal permissions from the user and group permissions
+
+        Parameters
+        ----------
+        user_perms : dict
+            Mapping of username to a list of permissions
+        group_perms : dict
+            Mapping of group name to a list of permissions
+
         Returns
         -------
         perms : dict
@@ -114,10 +202,10 @@ class IAccessBackend(object):
 
         """
         all_perms = {}
-        for user, perms in six.iteritems(self.user_permissions(package)):
+        for user, perms in six.iteritems(user_perms):
             all_perms["user:" + user] = tuple(perms)
 
-        for group, perms in six.iteritems(self.group_permissions(package)):
+        for group, perms in six.iteritems(group_perms):
             all_perms[group_to_principal(group)] = tuple(perms)
 
         # If there are no group or user specifications for the package, use the
@@ -134,7 +222,7 @@ class IAccessBackend(object):
 
     def get_acl(self, package):
         """ Construct an ACL for a package """
-        acl = []
+        acl = [(Deny, READ_ONLY_TOKEN, "write")]
         permissions = self.allowed_permissions(package)
         for principal, perms in six.iteritems(permissions):
             for perm in perms:
@@ -143,16 +231,190 @@ class IAccessBackend(object):
 
     def has_permission(self, package, perm):
         """ Check if this user has a permission for a package """
+        principals = effective_principals(self.request)
+        if perm != "read" and READ_ONLY_TOKEN in principals:
+            return False
         current_userid = self.request.userid
         if current_userid is not None and self.is_admin(current_userid):
             return True
 
         perms = self.allowed_permissions(package)
-        for principal in effective_principals(self.request):
+        for principal in principals:
             if perm in perms.get(principal, []):
                 return True
         return False
 
+    def filter_readable(self, packages, perm="read"):
+        """
+        Filter a list of packages down to those this user has a permission for
+
+        This is equivalent to calling :meth:`.has_permission` for every
+        package, but fetches the permissions with
+        :meth:`.bulk_allowed_permissions`.
+
+        Parameters
+        ----------
+        packages : list
+            List of package names
+        perm : {'read', 'write'}, optional
+            The permission to check for (default 'read')
+
+        Returns
+        -------
+        packages : list
+            The package names the user has the permission for, in the same
+            order
+
+        """
+        packages = list(packages)
+        principals = effective_principals(self.request)
+        if perm != "read" and READ_ONLY_TOKEN in principals:
+            return []
+        current_userid = self.request.userid
+        if current_userid is not None and self.is_admin(current_userid):
+            return packages
+
+        all_perms = self.bulk_allowed_permissions(packages)
+        readable = []
+        for package in packages:
+            perms = all_perms[package]
+            for principal in principals:
+                if perm in perms.get(principal, []):
+                    readable.append(package)
+                    break
+        return readable
+
+    def _hmac(self, username, timestamp, scope=None, secret=None):
+        """
+        HMAC a username/expiration combo
+
+        If provided, the ``secret`` is signed but not included in the message.
+
+        """
+        if self.signing_key is None:
+            raise RuntimeError("auth.signing_key is not set!")
+        msg = "%s:%d" % (username, timestamp)
+        if scope is not None:
+            msg += ":" + scope
+        signed = msg
+        if secret is not None:
+            signed += ":" + secret
+        return (
+            msg,
+            hmac.new(
+                self.signing_key.encode("utf8"), signed.encode("utf8"), hashlib.sha256
+            ).hexdigest(),
+        )
+
+    def _check_signature(self, signature, expected):
+        """ Compare two HMAC signatures """
+        if hasattr(hmac, "compare_digest"):
+            if isinstance(signature, six.text_type):
+                signature = signature.encode("utf-8")
+            if isinstance(expected, six.text_type):
+                expected = expected.encode("utf-8")
+            return hmac.compare_digest(signature, expected)
+        else:
+            return signature == expected
+
+    def get_api_token(self, username, scope="read", expire=None):
+        """
+        Create a signed API token for a user
+
+        Parameters
+        ----------
+        username : str
+        scope : {'read', 'write'}, optional
+            Tokens with 'read' scope cannot be used to upload or delete
+            packages, or for admin operations (default 'read')
+        expire : int, optional
+            Number of seconds the token is valid for. Longer times are reduced
+            to ``auth.api_token_expire``, which is also the default.
+
+        Returns
+        -------
+        token : str
+
+        """
+        if scope not in TOKEN_SCOPES:
+            raise ValueError("Unrecognized token scope '%s'" % scope)
+        if expire is None:
+            expire = self.api_token_expiration
+        elif expire <= 0:
+            raise ValueError("Token expiration must be positive")
+        expire = min(expire, self.api_token_expiration)
+        secret = self._api_token_secret(username)
+        if secret is None:
+            raise ValueError("Unknown user '%s'" % username)
+        msg, signature = self._hmac(username, time.time() + expire, scope, secret)
+        return msg + ":" + signature
+
+    def _api_token_secret(self, username):
+        """
+        Get a value that is signed into the API tokens of a user
+
+        When it changes, all of the user's tokens become invalid. By default
+        this is the stored password hash, so that changing the password revokes
+        the tokens.
+
+        Returns
+        -------
+        secret : str or None
+            None if the user does not exist or is pending
+
+        """
+        if self.mutable and self.user_data(username) is None:
+            return None
+        return self._get_password_hash(username) or None
+
+    def _cached_api_token_secret(self, username):
+        """ Get the API token secret of a user from the cache if enabled """
+        if self.api_token_cache is None:
+            return self._api_token_secret(username)
+        secret = self.api_token_cache.get(username)
+        if secret is None:
+            secret = self._api_token_secret(username)
+            if secret is not None:
+                self.api_token_cache[username] = secret
+        return secret
+
+    def validate_api_token(self, token):
+        """
+        Validate an API token
+
+        Checks the signature and expiration, and that the user still exists
+        and has not changed their password since the token was created. The
+        user lookup is cached for ``auth.api_token_cache_time`` seconds, so a
+        change made by another process can take that long to revoke the token.
+
+        Parameters
+        ----------
+        token : str
+
+        Returns
+        -------
+        credentials : tuple or None
+            The (username, scope) for the token, or None if the validation
+            fails
+
+        """
+        if self.signing_key is None:
+            return None
+        try:
+            username, expires, scope, signature = token.rsplit(":", 3)
+            expires = int(expires)
+        except ValueError:
+            return None
+        if scope not in TOKEN_SCOPES or expires < time.time():
+            return None
+        secret = self._cached_api_token_secret(username)
+        if secret is None:
+            return None
+        _, expected = self._hmac(username, expires, scope, secret)
+        if not self._check_signature(signature, expected):
+            return None
+        return username, scope
+
     def user_principals(self, username):
         """
         Get a list of principals for a user
@@ -166,12 +428,45 @@ class IAccessBackend(object):
         principals : list
 
         """
-        principals = ["user:" + username, Everyone, Authenticated]
-        if self.is_admin(username):
-            principals.append("admin")
-        for group in self.groups(username):
-            principals.append("group:" + group)
-        return principals
+        principals = self._principals.get(username)
+        if principals is None and self.principal_cache is not None:
+            principals = self.principal_cache.get(username)
+        if principals is None:
+            principals = ["user:" + username, Everyone, Authenticated]
+            if self.is_admin(username):
+                principals.append("admin")
+            for group in self.groups(username):
+                principals.append("group:" + group)
+            principals = tuple(principals)
+            if self.principal_cache is not None:
+                self.principal_cache[username] = principals
+        self._principals[username] = principals
+        return list(principals)
+
+    def invalidate_principals(self, username=None):
+        """
+        Drop the cached principals for a user
+
+        Mutable backends should call this whenever a user's admin status or
+        group membership changes.
+
+        Parameters
+        ----------
+        username : str, optional
+            If None, drop the cached principals for all users
+
+        """
+        if username is None:
+            self._principals.clear()
+            if self.principal_cache is not None:
+                self.principal_cache.clear()
+            return
+        self._principals.pop(username, None)
+        if self.principal_cache is not None:
+            try:
+                del self.principal_cache[username]
+            except KeyError:
+                pass
 
     def in_group(self, username, group):
         """
@@ -290,7 +585,50 @@ class IAccessBackend(object):
             user_data = self.user_data(username)
             if user_data is None:
                 return False
-        return bool(stored_pw and self.pwd_context.verify(password, stored_pw))
+        if not stored_pw:
+            return False
+        if self.credential_cache is None:
+            return self.pwd_context.verify(password, stored_pw)
+
+        # The digest covers the stored hash, so changing the password will
+        # invalidate the entry even if it was changed by another process
+        digest = self._credential_digest(stored_pw, password)
+        cached = self.credential_cache.get(username)
+        if cached is not None and hmac.compare_digest(cached, digest):
+            return True
+        valid = self.pwd_context.verify(password, stored_pw)
+        if valid:
+            self.credential_cache[username] = digest
+        return valid
+
+    def _credential_digest(self, stored_pw, password):
+        """ Construct the value to store in the credential cache """
+        msg = stored_pw + ":" + password
+        return hmac.new(CREDENTIAL_KEY, msg.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def invalidate_credentials(self, username):
+        """
+        Drop the cached credentials for a user
+
+        Mutable backends should call this whenever a user's password changes
+        or the user is deleted. This also drops the user from the API token
+        cache.
+
+        Parameters
+        ----------
+        username : str
+
+        """
+        if self.credential_cache is not None:
+            try:
+                del self.credential_cache[username]
+            except KeyError:
+                pass
+        if self.api_token_cache is not None:
+            try:
+                del self.api_token_cache[username]
+            except KeyError:
+                pass
 
     def _get_password_hash(self, username):
         """ Get the stored password hash for a user """
@@ -538,18 +876,6 @@ class IMutableAccessBackend(IAccessBackend):
         msg, signature = self._hmac(username, time.time())
         return msg + ":" + signature
 
-    def _hmac(self, username, timestamp):
-        """ HMAC a username/expiration combo """
-        if self.signing_key is None:
-            raise RuntimeError("auth.signing_key is not set!")
-        msg = "%s:%d" % (username, timestamp)
-        return (
-            msg,
-            hmac.new(
-                self.signing_key.encode("utf8"), msg.encode("utf8"), hashlib.sha256
-            ).hexdigest(),
-        )
-
     def validate_signup_token(self, token):
         """
         Validate a signup token
@@ -573,16 +899,8 @@ class IMutableAccessBackend(IAccessBackend):
         if issued + self.token_expiration < time.time():
             return None
         _, expected = self._hmac(username, issued)
-        if hasattr(hmac, "compare_digest"):
-            if isinstance(signature, six.text_type):
-                signature = signature.encode("utf-8")
-            if isinstance(expected, six.text_type):
-                expected = expected.encode("utf-8")
-            if not hmac.compare_digest(signature, expected):
-                return None
-        else:
-            if signature != expected:
-                return None
+        if not self._check_signature(signature, expected):
+            return None
         return username
 
     def allow_register(self):
@@ -666,6 +984,7 @@ class IMutableAccessBackend(IAccessBackend):
 
         """
         self._set_password_hash(username, self.pwd_context.hash(password))
+        self.invalidate_credentials(username)
 
     def _set_password_hash(self, username, password_hash):
         """
@@ -1,6 +1,7 @@
 """ Abstract backends that are backed by simple JSON """
 
 from .base import IAccessBackend, IMutableAccessBackend
+from pypicloud.util import invalidate_index_cache
 
 
 class IJsonAccessBackend(IAccessBackend):
@@ -201,6 +202,9 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
             except ValueError:
                 pass
         self._save()
+        self.invalidate_principals(username)
+        self.invalidate_credentials(username)
+        invalidate_index_cache(self.request)
 
     def pending_users(self):
         return list(self.db["pending_users"].keys())
@@ -212,6 +216,8 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
     def delete_group(self, group):
         self.db["groups"].pop(group, None)
         self._save()
+        self.invalidate_principals()
+        invalidate_index_cache(self.request)
 
     def edit_user_group(self, username, group, add):
         if add:
@@ -219,6 +225,7 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
         else:
             self.db["groups"][group].remove(username)
         self._save()
+        self.invalidate_principals(username)
 
     def _init_package(self, package):
         """
@@ -246,6 +253,7 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
             if package["groups"][group] == []:
                 package["groups"].pop(group)
         self._save()
+        invalidate_index_cache(self.request)
 
     def edit_user_permission(self, package_name, username, perm, add):
         if perm != "read" and perm != "write":
@@ -268,6 +276,7 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
             if user_perms == []:
                 package["users"].pop(username)
         self._save()
+        invalidate_index_cache(self.request)
 
     def set_user_admin(self, username, admin):
         if admin:
@@ -275,6 +284,7 @@ class IMutableJsonAccessBackend(IJsonAccessBackend, IMutableAccessBackend):
         else:
             self.db["admins"].remove(username)
         self._save()
+        self.invalidate_principals(username)
 
     def set_allow_register(self, allow):
         self.db["allow_registration"] = allow
@@ -289,6 +289,12 @@ class LDAPAccessBackend(IAccessBackend):
     def _get_password_hash(self, *_):  # pragma: no cover
         raise RuntimeError("LDAP should never call _get_password_hash")
 
+    def _api_token_secret(self, username):
+        user = self.conn.get_user(username)
+        if user is None:
+            return None
+        return user.dn
+
     def verify_user(self, username, password):
         return self.conn.verify_user(username, password)
 
@@ -29,8 +29,14 @@ class RemoteAccessBackend(IAccessBackend):
         kwargs["auth"] = auth
         return kwargs
 
-    def _req(self, uri, params=None):
-        """ Hit a server endpoint and return the json response """
+    def _req(self, uri, params=None, data=None):
+        """
+        Hit a server endpoint and return the json response
+
+        If ``data`` is provided, it will be sent as a JSON POST body instead of
+        making a GET request.
+
+        """
         try:
             import requests
         except ImportError:  # pragma: no cover
@@ -38,7 +44,12 @@ class RemoteAccessBackend(IAccessBackend):
                 "You must 'pip install requests' before using "
                 "the remote server access backend"
             )
-        response = requests.get(self.server + uri, params=params, auth=self.auth)
+        if data is None:
+            response = requests.get(self.server + uri, params=params, auth=self.auth)
+        else:
+            response = requests.post(
+                self.server + uri, params=params, json=data, auth=self.auth
+            )
         response.raise_for_status()
         return response.json()
 
@@ -51,6 +62,12 @@ class RemoteAccessBackend(IAccessBackend):
         # We don't have to do anything here because we overrode 'verify_user'
         pass
 
+    def _api_token_secret(self, username):
+        # There is no password hash, but we can check that the user exists
+        if self.user_data(username) is None:
+            return None
+        return ""
+
     def groups(self, username=None):
         uri = self._settings.get("auth.uri.groups", "/groups")
         params = {}
@@ -78,6 +95,20 @@ class RemoteAccessBackend(IAccessBackend):
         params = {"package": package}
         return self._req(uri, params)
 
+    def bulk_allowed_permissions(self, packages):
+        uri = self._settings.get("auth.uri.bulk_permissions")
+        if uri is None:
+            return super(RemoteAccessBackend, self).bulk_allowed_permissions(packages)
+        packages = list(packages)
+        response = self._req(uri, data=packages)
+        all_perms = {}
+        for package in packages:
+            data = response.get(package, {})
+            all_perms[package] = self._merge_permissions(
+                data.get("users", {}), data.get("groups", {})
+            )
+        return all_perms
+
     def user_package_permissions(self, username):
         uri = self._settings.get(
             "auth.uri.user_package_permissions", "/user_package_permissions"
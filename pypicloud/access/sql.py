@@ -15,11 +15,15 @@ from sqlalchemy import orm
 import zope.sqlalchemy
 
 from .base import IMutableAccessBackend
+from pypicloud.util import invalidate_index_cache
 
 
 # pylint: disable=C0103,W0231
 Base = declarative_base()
 
+# Maximum number of package names to put in a single IN clause
+IN_CHUNK_SIZE = 500
+
 association_table = Table(
     "pypicloud_user_groups",
     Base.metadata,
@@ -242,6 +246,29 @@ class SQLAccessBackend(IMutableAccessBackend):
             perms[perm.username] = perm.permissions
         return perms
 
+    def bulk_allowed_permissions(self, packages):
+        packages = list(packages)
+        user_perms = dict(((package, {}) for package in packages))
+        group_perms = dict(((package, {}) for package in packages))
+        for i in range(0, len(packages), IN_CHUNK_SIZE):
+            chunk = packages[i : i + IN_CHUNK_SIZE]
+            query = self.db.query(UserPermission).filter(
+                UserPermission.package.in_(chunk)
+            )
+            for perm in query:
+                user_perms[perm.package][perm.username] = perm.permissions
+            query = self.db.query(GroupPermission).filter(
+                GroupPermission.package.in_(chunk)
+            )
+            for perm in query:
+                group_perms[perm.package][perm.groupname] = perm.permissions
+        all_perms = {}
+        for package in packages:
+            all_perms[package] = self._merge_permissions(
+                user_perms[package], group_perms[package]
+            )
+        return all_perms
+
     def user_package_permissions(self, username):
         query = self.db.query(UserPermission).filter_by(username=username)
         packages = []
@@ -299,11 +326,15 @@ class SQLAccessBackend(IMutableAccessBackend):
         self.db.query(User).filter_by(username=username).delete()
         clause = association_table.c.username == username
         self.db.execute(association_table.delete(clause))
+        self.invalidate_principals(username)
+        self.invalidate_credentials(username)
+        invalidate_index_cache(self.request)
 
     def set_user_admin(self, username, admin):
         user = self.db.query(User).filter_by(username=username).first()
         if user is not None:
             user.admin = admin
+        self.invalidate_principals(username)
 
     def edit_user_group(self, username, groupname, add):
         user = self.db.query(User).filter_by(username=username).first()
@@ -313,6 +344,7 @@ class SQLAccessBackend(IMutableAccessBackend):
                 user.groups.add(group)
             else:
                 user.groups.remove(group)
+        self.invalidate_principals(username)
 
     def create_group(self, group):
         self.db.add(Group(group))
@@ -321,6 +353,8 @@ class SQLAccessBackend(IMutableAccessBackend):
         self.db.query(Group).filter_by(name=group).delete()
         clause = association_table.c.group == group
         self.db.execute(association_table.delete(clause))
+        self.invalidate_principals()
+        invalidate_index_cache(self.request)
 
     def edit_user_permission(self, package, username, perm, add):
         record = (
@@ -341,6 +375,7 @@ class SQLAccessBackend(IMutableAccessBackend):
             raise ValueError("Unrecognized permission '%s'" % perm)
         if not record.read and not record.write:
             self.db.delete(record)
+        invalidate_index_cache(self.request)
 
     def edit_group_permission(self, package, group, perm, add):
         record = (
@@ -361,6 +396,7 @@ class SQLAccessBackend(IMutableAccessBackend):
             raise ValueError("Unrecognized permission '%s'" % perm)
         if not record.read and not record.write:
             self.db.delete(record)
+        invalidate_index_cache(self.request)
 
     def check_health(self):
         try:
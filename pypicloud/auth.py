@@ -10,6 +10,11 @@ from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.httpexceptions import HTTPForbidden, HTTPUnauthorized
 from pyramid.security import Everyone, authenticated_userid
 
+from pypicloud.access.base import READ_ONLY_TOKEN
+
+# Basic auth username that marks the password as an API token
+TOKEN_USERNAME = "__token__"
+
 
 # Copied from
 # http://docs.pylonsproject.org/projects/pyramid_cookbook/en/latest/auth/basic.html
@@ -56,6 +61,8 @@ class BasicAuthenticationPolicy(object):
         if credentials is None:
             return None
         userid = credentials["login"]
+        if userid == TOKEN_USERNAME:
+            return None
         if request.access.verify_user(credentials["login"], credentials["password"]):
             return userid
         return None
@@ -79,6 +86,67 @@ class BasicAuthenticationPolicy(object):
         return []
 
 
+def get_api_token(request):
+    """
+    Get the validated API token from the request
+
+    The token may be passed as a bearer token, or as the password of HTTP basic
+    auth with the username ``__token__``.
+
+    Returns
+    -------
+    credentials : tuple or None
+        The (username, scope) of a valid token, or None
+
+    """
+    authorization = AUTHORIZATION(request.environ)
+    try:
+        authmeth, auth = authorization.split(" ", 1)
+    except ValueError:  # not enough values to unpack
+        return None
+    if authmeth.lower() == "bearer":
+        token = auth.strip()
+    else:
+        credentials = get_basicauth_credentials(request)
+        if credentials is None or credentials["login"] != TOKEN_USERNAME:
+            return None
+        token = credentials["password"]
+    return request.access.validate_api_token(token)
+
+
+class TokenAuthenticationPolicy(object):
+
+    """
+    Auth policy that accepts the signed API tokens from
+    :meth:`~pypicloud.access.base.IAccessBackend.get_api_token`
+
+    """
+
+    def authenticated_userid(self, request):
+        """ Verify the token and return the authed userid """
+        if request.api_token is None:
+            return None
+        return request.api_token[0]
+
+    def unauthenticated_userid(self, request):
+        """ Return userid without performing auth """
+        return request.userid
+
+    def effective_principals(self, request):
+        """ Restrict the active user if the token is read-only """
+        if request.api_token is not None and request.api_token[1] == "read":
+            return [Everyone, READ_ONLY_TOKEN]
+        return [Everyone]
+
+    def remember(self, request, principal, **kw):
+        """ HTTP Headers to remember credentials """
+        return []
+
+    def forget(self, request):
+        """ HTTP headers to forget credentials """
+        return []
+
+
 class SessionAuthPolicy(object):
 
     """ Simple auth policy using beaker sessions """
@@ -159,7 +227,9 @@ def includeme(config):
     config.set_authentication_policy(config.registry.authentication_policy)
     config.add_authentication_policy(SessionAuthPolicy())
     config.add_authentication_policy(BasicAuthenticationPolicy())
+    config.add_authentication_policy(TokenAuthenticationPolicy())
     config.add_request_method(authenticated_userid, name="userid", reify=True)
+    config.add_request_method(get_api_token, name="api_token", reify=True)
     config.add_request_method(_forbid, name="forbid")
     config.add_request_method(_request_login, name="request_login")
     config.add_request_method(_is_logged_in, name="is_logged_in", reify=True)
@@ -1,15 +1,29 @@
 """ Base class for all cache implementations """
-from datetime import datetime
+from bisect import bisect_right
+from datetime import datetime, timedelta
 
 import logging
 from pyramid.settings import asbool
 
 import posixpath
+from .search import get_search_index
 from pypicloud.models import Package
 from pypicloud.storage import get_storage_impl
-from pypicloud.util import create_matcher, parse_filename, normalize_name
+from pypicloud.util import (
+    create_matcher,
+    invalidate_index_cache,
+    parse_filename,
+    normalize_name,
+    to_timestamp,
+    chunked,
+)
 
 LOG = logging.getLogger(__name__)
+# How far before the watermark to look for changes during an incremental
+# reload. Covers clock skew between the server and the storage backend.
+WATERMARK_SKEW = timedelta(minutes=5)
+# Number of packages to read and write at a time during a graceful reload
+DEFAULT_RELOAD_BATCH_SIZE = 500
 
 
 class ICache(object):
@@ -18,10 +32,21 @@ class ICache(object):
 
     package_class = Package
 
-    def __init__(self, request=None, storage=None, allow_overwrite=None):
+    def __init__(
+        self,
+        request=None,
+        storage=None,
+        allow_overwrite=None,
+        incremental_reload=False,
+        reload_batch_size=DEFAULT_RELOAD_BATCH_SIZE,
+        search_index=None,
+    ):
         self.request = request
         self.storage = storage(request)
         self.allow_overwrite = allow_overwrite
+        self.incremental_reload = incremental_reload
+        self.reload_batch_size = reload_batch_size
+        self.search_index = search_index
 
     def reload_if_needed(self):
         """
@@ -32,7 +57,16 @@ class ICache(object):
         """
         if not self.distinct():
             LOG.info("Cache is empty. Rebuilding from storage backend...")
-            self.reload_from_storage(False)
+            # A watermark left behind when the cache was emptied would make
+            # this an incremental reload that misses all the older packages.
+            start = datetime.utcnow()
+            incremental, self.incremental_reload = self.incremental_reload, False
+            try:
+                self.reload_from_storage(False)
+            finally:
+                self.incremental_reload = incremental
+            if incremental:
+                self.set_watermark(start)
             LOG.info("Cache repopulated")
 
     @classmethod
@@ -41,6 +75,11 @@ class ICache(object):
         return {
             "storage": get_storage_impl(settings),
             "allow_overwrite": asbool(settings.get("pypi.allow_overwrite", False)),
+            "incremental_reload": asbool(settings.get("db.incremental_reload", False)),
+            "reload_batch_size": int(
+                settings.get("db.reload_batch_size", DEFAULT_RELOAD_BATCH_SIZE)
+            ),
+            "search_index": get_search_index(settings),
         }
 
     @classmethod
@@ -67,13 +106,193 @@ class ICache(object):
         """ Pass through to storage """
         return self.storage.download_response(package)
 
+    def get_url_expiration(self):
+        """ Pass through to storage """
+        return self.storage.get_url_expiration()
+
     def reload_from_storage(self, clear=True):
         """ Make sure local database is populated with packages """
         if clear:
             self.clear_all()
+        elif self._reload_incremental():
+            return
+        start = datetime.utcnow()
         packages = self.storage.list(self.package_class)
         for pkg in packages:
             self.save(pkg)
+        if self.incremental_reload:
+            self.set_watermark(start)
+        self._invalidate_indexes()
+
+    def _reload_incremental(self):
+        """
+        Reconcile the cache with the packages changed since the last reload
+
+        Only the packages that were modified after the watermark are loaded
+        from storage. Deleted packages are found by comparing the filenames in
+        storage to the filenames in the cache.
+
+        Returns
+        -------
+        reloaded : bool
+            False if incremental reloads are disabled or there is no watermark,
+            in which case a full reload is needed
+
+        """
+        if not self.incremental_reload:
+            return False
+        watermark = self.get_watermark()
+        if watermark is None:
+            return False
+        LOG.info("Reloading packages changed since %s from storage", watermark)
+        start = datetime.utcnow()
+        filenames, changed = self.storage.list_changes(
+            self.package_class, watermark - WATERMARK_SKEW
+        )
+        if changed:
+            LOG.info("Saving %d changed packages to cache", len(changed))
+            for pkg in changed:
+                self.save(pkg)
+        # Packages that were uploaded after we listed storage will be missing
+        # from the listing, so only remove packages that are older than that.
+        cutoff = to_timestamp(start)
+        removed = 0
+        for filename in self.cached_filenames() - filenames:
+            pkg = self.fetch(filename)
+            if pkg is not None and to_timestamp(pkg.last_modified) < cutoff:
+                self.clear(pkg)
+                removed += 1
+        if removed:
+            LOG.info("Removed %d deleted packages from cache", removed)
+        self.set_watermark(start)
+        self._invalidate_indexes()
+        return True
+
+    def _reload_graceful(self):
+        """
+        Reconcile the cache with storage while keeping the cache usable
+
+        Storage and the cache are both read in batches of
+        ``reload_batch_size`` packages. Only the filenames in storage are kept
+        in memory for the whole reload, so memory usage does not grow with the
+        number of package objects.
+
+        """
+        LOG.info("Rebuilding cache from storage")
+        # Log start time
+        start = datetime.utcnow()
+        cutoff = to_timestamp(start)
+        # Add packages that are in storage and missing from the cache
+        filenames = set()
+        added = 0
+        packages = self.storage.list(self.package_class)
+        for batch in chunked(packages, self.reload_batch_size):
+            filenames.update(pkg.filename for pkg in batch)
+            cached = self._fetch_batch([pkg.filename for pkg in batch])
+            missing = [pkg for pkg in batch if pkg.filename not in cached]
+            if missing:
+                self._save_batch(missing)
+                added += len(missing)
+        if added:
+            LOG.info("Added %d missing packages to cache", added)
+
+        # Delete extra packages from cache when last_modified < start
+        # The time filter helps us avoid deleting packages that were
+        # concurrently uploaded.
+        extra = []
+        for batch in self._iter_cached(self.reload_batch_size):
+            for pkg in batch:
+                if (
+                    pkg.filename not in filenames
+                    and to_timestamp(pkg.last_modified) < cutoff
+                ):
+                    extra.append(pkg)
+        if extra:
+            LOG.info("Removing %d extra packages from cache", len(extra))
+            for batch in chunked(extra, self.reload_batch_size):
+                self._clear_batch(batch)
+
+        # If any packages were concurrently deleted during the cache rebuild,
+        # we can detect them by listing storage again and looking for any
+        # packages that were present the first time and are missing now. The
+        # second listing only needs the filenames.
+        current, _ = self.storage.list_changes(self.package_class, start)
+        deleted = filenames - current
+        if deleted:
+            LOG.info(
+                "Removing %d packages from cache that were concurrently "
+                "deleted during rebuild",
+                len(deleted),
+            )
+            for batch in chunked(deleted, self.reload_batch_size):
+                self._clear_batch(list(self._fetch_batch(batch).values()))
+        if self.incremental_reload:
+            self.set_watermark(start)
+        self._invalidate_indexes()
+
+    def _fetch_batch(self, filenames):
+        """
+        Get the cached packages for a batch of filenames
+
+        Returns
+        -------
+        packages : dict
+            Mapping of filename to :class:`~pypicloud.models.Package` for the
+            filenames that are in the cache
+
+        """
+        packages = {}
+        for filename in filenames:
+            pkg = self.fetch(filename)
+            if pkg is not None:
+                packages[filename] = pkg
+        return packages
+
+    def _save_batch(self, packages):
+        """ Save a batch of packages that are missing from the cache """
+        for pkg in packages:
+            self.save(pkg)
+
+    def _clear_batch(self, packages):
+        """ Remove a batch of packages from the cache """
+        for pkg in packages:
+            self.clear(pkg)
+
+    def _iter_cached(self, batch_size):
+        """ Generate lists of at most ``batch_size`` cached packages """
+        packages = (pkg for name in self.distinct() for pkg in self.all(name))
+        return chunked(packages, batch_size)
+
+    def get_watermark(self):
+        """
+        Get the time of the last reload from storage
+
+        Caches that do not store a watermark always return None, which means
+        that they never reload incrementally.
+
+        Returns
+        -------
+        watermark : :class:`~datetime.datetime` or None
+            Naive UTC datetime
+
+        """
+        return None
+
+    def set_watermark(self, watermark):
+        """
+        Store the time of the last reload from storage
+
+        Parameters
+        ----------
+        watermark : :class:`~datetime.datetime`
+            Naive UTC datetime
+
+        """
+        pass
+
+    def cached_filenames(self):
+        """ Get the set of filenames of all the packages in the cache """
+        return set(pkg.filename for name in self.distinct() for pkg in self.all(name))
 
     def upload(self, filename, data, name=None, version=None, summary=None):
         """
@@ -115,6 +334,9 @@ class ICache(object):
         new_pkg = self.package_class(name, version, filename, summary=summary)
         self.storage.upload(new_pkg, data)
         self.save(new_pkg)
+        if self.search_index is not None:
+            self.search_index.add(new_pkg)
+        invalidate_index_cache(self.request)
         return new_pkg
 
     def delete(self, package):
@@ -128,6 +350,15 @@ class ICache(object):
         """
         self.storage.delete(package)
         self.clear(package)
+        if self.search_index is not None:
+            self.search_index.remove(package)
+        invalidate_index_cache(self.request)
+
+    def _invalidate_indexes(self):
+        """ Drop the indexes of the cache after it was changed in bulk """
+        invalidate_index_cache(self.request)
+        if self.search_index is not None:
+            self.search_index.invalidate()
 
     def fetch(self, filename):
         """
@@ -163,6 +394,93 @@ class ICache(object):
         """
         raise NotImplementedError
 
+    def all_files(self, name):
+        """
+        Get the files of all versions of a package for listing download links
+
+        Backends may load only the name, version, filename, last_modified and
+        data of each package, so the summary may be missing. The packages are
+        not sorted, and should not be saved back to the cache.
+
+        Parameters
+        ----------
+        name : str
+            The name of the package
+
+        Returns
+        -------
+        packages : list
+            List of :class:`~pypicloud.models.Package` s with the given name
+
+        """
+        return self.all(name)
+
+    def latest(self, name):
+        """
+        Get the most recent version of a package
+
+        Parameters
+        ----------
+        name : str
+            The name of the package
+
+        Returns
+        -------
+        package : :class:`~pypicloud.models.Package` or None
+
+        """
+        packages = self.all(name)
+        if not packages:
+            return None
+        return max(packages)
+
+    def paginate(self, name, offset=0, limit=None):
+        """
+        Get a page of the versions of a package, newest first
+
+        Parameters
+        ----------
+        name : str
+            The name of the package
+        offset : int, optional
+            The number of versions to skip
+        limit : int, optional
+            The maximum number of versions to return (default all)
+
+        Returns
+        -------
+        packages : list
+            List of :class:`~pypicloud.models.Package` s
+
+        """
+        packages = sorted(self.all(name), reverse=True)
+        if limit is None:
+            return packages[offset:]
+        return packages[offset : offset + limit]
+
+    def version_stamp(self, name):
+        """
+        Get a cheap value that changes whenever the versions of a package do
+
+        Parameters
+        ----------
+        name : str
+            The name of the package
+
+        Returns
+        -------
+        stamp : tuple or None
+            Tuple of (last_modified, count) where last_modified is the most
+            recent ``last_modified`` of all the package files and count is the
+            number of files. None if there are no files for the package.
+
+        """
+        packages = self.all(name)
+        if not packages:
+            return None
+        last_modified = max((p.last_modified for p in packages))
+        return (last_modified, len(packages))
+
     def distinct(self):
         """
         Get all distinct package names
@@ -198,6 +516,8 @@ class ICache(object):
 
 
         """
+        if self.search_index is not None:
+            return self.search_index.search(self, criteria, query_type)
         name_queries = criteria.get("name", [])
         summary_queries = criteria.get("summary", [])
         packages = []
@@ -249,6 +569,33 @@ class ICache(object):
 
         return packages
 
+    def summary_page(self, limit, token=None):
+        """
+        Get a page of the package summaries
+
+        Parameters
+        ----------
+        limit : int
+            The maximum number of summaries to return
+        token : str, optional
+            The continuation token returned with the previous page
+
+        Returns
+        -------
+        packages : list
+            List of package dicts, in the same format as :meth:`.summary`
+        token : str
+            Pass this to get the next page. None if this is the last page.
+
+        """
+        packages = sorted(self.summary(), key=lambda p: p["name"])
+        if token is not None:
+            names = [p["name"] for p in packages]
+            packages = packages[bisect_right(names, token) :]
+        if len(packages) <= limit:
+            return packages, None
+        return packages[:limit], packages[limit - 1]["name"]
+
     def clear(self, package):
         """
         Remove this package from the caching database
@@ -1,14 +1,18 @@
 """ Store package data in DynamoDB """
 import logging
 import six
+import threading
+import time
 from collections import defaultdict
 from datetime import datetime
-from dynamo3 import DynamoDBConnection
+from dynamo3 import DynamoDBConnection, DynamoDBError, IndexUpdate, Limit
 from pkg_resources import parse_version
 from pyramid.settings import asbool, aslist
+from six.moves.queue import Empty, Full, Queue
 
 from .base import ICache
 from pypicloud.models import Package
+from pypicloud.util import chunked
 
 
 try:
@@ -23,6 +27,11 @@ except ImportError:  # pragma: no cover
     )
 
 LOG = logging.getLogger(__name__)
+# Index that only projects the attributes needed for download links
+FILES_INDEX = "name-files-index"
+FILES_INDEX_ATTRIBUTES = ["version", "last_modified", "data"]
+# Sent by a scan worker when its segment is finished
+_SEGMENT_DONE = object()
 
 
 class DynamoPackage(Package, Model):
@@ -58,16 +67,121 @@ class PackageSummary(Model):
         self.summary = package.summary
 
 
+class CacheMetadata(Model):
+
+    """ Key-value store for the state of the cache itself """
+
+    key = Field(hash_key=True)
+    value = Field(data_type=datetime)
+
+
+class SummarySnapshot(object):
+
+    """
+    In-process copy of the package summary table
+
+    Saves and clears made through this process update the snapshot directly.
+    Other processes may also change the table, so the snapshot is reloaded
+    when it is older than ``cache_time`` seconds.
+
+    Parameters
+    ----------
+    cache_time : int
+        Reload the snapshot after this many seconds
+
+    """
+
+    def __init__(self, cache_time):
+        self.cache_time = cache_time
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._generation = 0
+        # name -> summary dict
+        self._summaries = {}
+        self._sorted = None
+
+    def get(self, loader):
+        """
+        Get the summaries sorted by name, loading them if stale
+
+        Parameters
+        ----------
+        loader : callable
+            Called with no arguments to read all summary dicts from DynamoDB
+
+        """
+        with self._lock:
+            if (
+                self._loaded is not None
+                and time.time() - self._loaded < self.cache_time
+            ):
+                return self._get_sorted()
+            generation = self._generation
+        started = time.time()
+        summaries = dict((summary["name"], summary) for summary in loader())
+        with self._lock:
+            # If anything changed while we were reading, the summaries we read
+            # may already be stale. Return them, but don't keep them.
+            if generation == self._generation:
+                self._summaries = summaries
+                self._sorted = None
+                self._loaded = started
+                return self._get_sorted()
+        return [summaries[name] for name in sorted(summaries)]
+
+    def _get_sorted(self):
+        """ Get the summaries sorted by name. Must hold the lock. """
+        if self._sorted is None:
+            self._sorted = [self._summaries[name] for name in sorted(self._summaries)]
+        return self._sorted
+
+    def update(self, summaries):
+        """ Update the snapshot with summary dicts that were saved """
+        with self._lock:
+            self._generation += 1
+            if self._loaded is not None:
+                for summary in summaries:
+                    self._summaries[summary["name"]] = summary
+                self._sorted = None
+
+    def remove(self, name):
+        """ Remove the summary of a package that was deleted """
+        with self._lock:
+            self._generation += 1
+            if self._summaries.pop(name, None) is not None:
+                self._sorted = None
+
+    def invalidate(self):
+        """ Drop the snapshot after the table was changed in bulk """
+        with self._lock:
+            self._generation += 1
+            self._loaded = None
+            self._summaries = {}
+            self._sorted = None
+
+
 class DynamoCache(ICache):
 
     """ Caching database that uses DynamoDB """
 
     package_class = DynamoPackage
 
-    def __init__(self, request=None, engine=None, graceful_reload=False, **kwargs):
+    def __init__(
+        self,
+        request=None,
+        engine=None,
+        graceful_reload=False,
+        scan_segments=1,
+        summary_snapshot=None,
+        files_index=False,
+        **kwargs
+    ):
         super(DynamoCache, self).__init__(request, **kwargs)
         self.engine = engine
         self.graceful_reload = graceful_reload
+        self.scan_segments = scan_segments
+        self.summary_snapshot = summary_snapshot
+        self.files_index = files_index
 
     @classmethod
     def configure(cls, settings):
@@ -81,13 +195,17 @@ class DynamoCache(ICache):
         secure = asbool(settings.get("db.secure", False))
         namespace = settings.get("db.namespace", ())
         graceful_reload = asbool(settings.get("db.graceful_reload", False))
+        scan_segments = int(settings.get("db.scan_segments", 1))
+        files_index = asbool(settings.get("db.files_index", False))
 
         tablenames = aslist(settings.get("db.tablenames", []))
         if tablenames:
-            if len(tablenames) != 2:
-                raise ValueError("db.tablenames must be a 2-element list")
+            if len(tablenames) not in (2, 3):
+                raise ValueError("db.tablenames must be a 2 or 3-element list")
             DynamoPackage.meta_.name = tablenames[0]
             PackageSummary.meta_.name = tablenames[1]
+            if len(tablenames) == 3:
+                CacheMetadata.meta_.name = tablenames[2]
 
         if host is not None:
             connection = DynamoDBConnection.connect(
@@ -104,29 +222,234 @@ class DynamoCache(ICache):
             )
         else:
             raise ValueError("Must specify either db.region_name or db.host!")
+        if "db.request_retries" in settings:
+            connection.request_retries = int(settings["db.request_retries"])
         kwargs["engine"] = engine = Engine(namespace=namespace, dynamo=connection)
         kwargs["graceful_reload"] = graceful_reload
+        kwargs["scan_segments"] = scan_segments
+        summary_cache_time = int(settings.get("db.summary_cache_time", 0))
+        if summary_cache_time > 0:
+            kwargs["summary_snapshot"] = SummarySnapshot(summary_cache_time)
+
+        kwargs["files_index"] = files_index
 
-        engine.register(DynamoPackage, PackageSummary)
+        if files_index:
+            cls._add_files_index()
+        engine.register(DynamoPackage, PackageSummary, CacheMetadata)
         LOG.info("Checking if DynamoDB tables exist")
         engine.create_schema()
+        if files_index:
+            cls._create_files_index(engine)
         return kwargs
 
+    @staticmethod
+    def _add_files_index():
+        """ Add the files index to the package model, so new tables have it """
+        for index in DynamoPackage.meta_.global_indexes:
+            if index.name == FILES_INDEX:
+                return index
+        index = GlobalIndex.include(
+            FILES_INDEX, "name", includes=FILES_INDEX_ATTRIBUTES
+        )
+        DynamoPackage.meta_.global_indexes.append(index)
+        return index
+
+    @classmethod
+    def _create_files_index(cls, engine):
+        """ Add the files index to a package table that was created without it """
+        tablename = DynamoPackage.meta_.ddb_tablename(engine.namespace)
+        desc = engine.dynamo.describe_table(tablename)
+        if any(index.name == FILES_INDEX for index in desc.global_indexes):
+            return
+        LOG.info("Adding index %s to %s", FILES_INDEX, tablename)
+        index = cls._add_files_index().get_ddb_index(DynamoPackage.meta_.fields)
+        engine.dynamo.update_table(tablename, index_updates=[IndexUpdate.create(index)])
+
+    def get_watermark(self):
+        metadata = self.engine.get(CacheMetadata, key="watermark")
+        if metadata is None or metadata.value is None:
+            return None
+        return metadata.value.replace(tzinfo=None)
+
+    def set_watermark(self, watermark):
+        metadata = CacheMetadata("watermark", value=watermark.replace(tzinfo=UTC))
+        self.engine.save(metadata, overwrite=True)
+
+    def cached_filenames(self):
+        items = self._scan(DynamoPackage, attributes=["filename"])
+        return set(item["filename"] for item in items)
+
+    def _scan(self, model, attributes=None):
+        """
+        Generate all items in a table
+
+        The table is split into ``scan_segments`` segments that are scanned in
+        parallel.
+
+        Parameters
+        ----------
+        model : class
+            The flywheel model of the table
+        attributes : list, optional
+            If provided, generate dicts with only these attributes instead of
+            models
+
+        """
+        tablename = model.meta_.ddb_tablename(self.engine.namespace)
+        dynamo = self.engine.dynamo
+
+        def load(item):
+            """ Convert a raw item to a model """
+            if attributes is not None:
+                return item
+            return model.ddb_load_(self.engine, item)
+
+        if self.scan_segments <= 1:
+            for item in dynamo.scan2(tablename, attributes=attributes):
+                yield load(item)
+            return
+
+        results = Queue(maxsize=1000)
+        stop = threading.Event()
+
+        def put(item):
+            """
+            Put an item on the queue
+
+            Returns False if the scan was abandoned before the item was queued
+
+            """
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def scan_segment(segment):
+            """ Scan one segment of the table """
+            try:
+                for item in dynamo.scan2(
+                    tablename,
+                    attributes=attributes,
+                    segment=segment,
+                    total_segments=self.scan_segments,
+                ):
+                    # Don't fetch any more pages once the consumer is gone
+                    if not put(item):
+                        return
+                put(_SEGMENT_DONE)
+            except Exception as e:  # pylint: disable=W0703
+                put(e)
+
+        for segment in range(self.scan_segments):
+            thread = threading.Thread(target=scan_segment, args=(segment,))
+            thread.daemon = True
+            thread.start()
+        remaining = self.scan_segments
+        try:
+            while remaining:
+                try:
+                    item = results.get(timeout=1)
+                except Empty:
+                    continue
+                if item is _SEGMENT_DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield load(item)
+        finally:
+            stop.set()
+
     def fetch(self, filename):
         return self.engine.get(DynamoPackage, filename=filename)
 
     def all(self, name):
         return sorted(self.engine.query(DynamoPackage).filter(name=name), reverse=True)
 
+    def all_files(self, name):
+        if not self.files_index:
+            return super(DynamoCache, self).all_files(name)
+        tablename = DynamoPackage.meta_.ddb_tablename(self.engine.namespace)
+        try:
+            items = list(
+                self.engine.dynamo.query2(
+                    tablename,
+                    "#name = :name",
+                    alias={"#name": "name"},
+                    index=FILES_INDEX,
+                    name=name,
+                )
+            )
+        except DynamoDBError:
+            # The index can't be read while it is being built
+            LOG.warning(
+                "Could not query %s, falling back to %s", FILES_INDEX, tablename
+            )
+            return self.all(name)
+        fields = DynamoPackage.meta_.fields
+        packages = []
+        for item in items:
+            data = item.get("data")
+            packages.append(
+                Package(
+                    item["name"],
+                    item["version"],
+                    item["filename"],
+                    fields["last_modified"].ddb_load(item["last_modified"]),
+                    **(fields["data"].ddb_load(data) if data is not None else {})
+                )
+            )
+        return packages
+
+    def version_stamp(self, name):
+        summary = self.engine.get(PackageSummary, name=name)
+        if summary is None:
+            return None
+        count = self.engine.query(DynamoPackage).filter(name=name).count()
+        if count == 0:
+            return None
+        return (summary.last_modified, count)
+
+    def _summaries(self):
+        """ Get all summary dicts, sorted by name """
+        if self.summary_snapshot is not None:
+            return self.summary_snapshot.get(self._load_summaries)
+        return self._load_summaries()
+
+    def _load_summaries(self):
+        """ Read all summary dicts from DynamoDB, sorted by name """
+        summaries = sorted(self._scan(PackageSummary), key=lambda s: s.name)
+        return [s.__json__() for s in summaries]
+
     def distinct(self):
-        names = set()
-        for summary in self.engine.scan(PackageSummary):
-            names.add(summary.name)
-        return sorted(names)
+        return [summary["name"] for summary in self._summaries()]
 
     def summary(self):
-        summaries = sorted(self.engine.scan(PackageSummary), key=lambda s: s.name)
-        return [s.__json__() for s in summaries]
+        return [dict(summary) for summary in self._summaries()]
+
+    def summary_page(self, limit, token=None):
+        if self.summary_snapshot is not None:
+            return super(DynamoCache, self).summary_page(limit, token)
+        # Only read one page of the table. Pages are in table order, not
+        # sorted by name.
+        tablename = PackageSummary.meta_.ddb_tablename(self.engine.namespace)
+        results = self.engine.dynamo.scan2(
+            tablename,
+            limit=Limit(scan_limit=limit, item_limit=limit, strict=True),
+            exclusive_start_key=None if token is None else {"name": token},
+        )
+        summaries = [
+            PackageSummary.ddb_load_(self.engine, item).__json__() for item in results
+        ]
+        next_token = None
+        if results.last_evaluated_key is not None:
+            next_token = self.engine.dynamo.dynamizer.decode_keys(
+                results.last_evaluated_key
+            )["name"]
+        return summaries, next_token
 
     def clear(self, package):
         self.engine.delete(package)
@@ -143,12 +466,14 @@ class DynamoCache(ICache):
         if remaining == 0:
             LOG.info("Removing package summary %s", package_name)
             self.engine.delete_key(PackageSummary, name=package_name)
+            if self.summary_snapshot is not None:
+                self.summary_snapshot.remove(package_name)
 
     def clear_all(self):
         # We're replacing the schema, so make sure we save and restore the
         # current table/index throughput
         throughput = {}
-        for model in (DynamoPackage, PackageSummary):
+        for model in (DynamoPackage, PackageSummary, CacheMetadata):
             tablename = model.meta_.ddb_tablename(self.engine.namespace)
             desc = self.engine.dynamo.describe_table(tablename)
             tablename = model.meta_.ddb_tablename()
@@ -164,55 +489,56 @@ class DynamoCache(ICache):
 
         self.engine.delete_schema()
         self.engine.create_schema(throughput=throughput)
+        if self.summary_snapshot is not None:
+            self.summary_snapshot.invalidate()
 
     def save(self, package):
         summary = PackageSummary(package)
         self.engine.save([package, summary], overwrite=True)
+        if self.summary_snapshot is not None:
+            self.summary_snapshot.update([summary.__json__()])
+
+    def _invalidate_indexes(self):
+        super(DynamoCache, self)._invalidate_indexes()
+        if self.summary_snapshot is not None:
+            self.summary_snapshot.invalidate()
 
     def reload_from_storage(self, clear=True):
         if not self.graceful_reload:
-            return super(DynamoCache, self).reload_from_storage(clear)
-        LOG.info("Rebuilding cache from storage")
-        # Log start time
-        start = datetime.utcnow().replace(tzinfo=UTC)
-        # Fetch packages from storage s1
-        s1 = set(self.storage.list(self.package_class))
-        # Fetch cache packages c1
-        c1 = set(self.engine.scan(DynamoPackage))
-        # Add missing packages to cache (s1 - c1)
-        missing = s1 - c1
-        if missing:
-            LOG.info("Adding %d missing packages to cache", len(missing))
-            self.engine.save(missing)
-        # Delete extra packages from cache (c1 - s1) when last_modified < start
-        # The time filter helps us avoid deleting packages that were
-        # concurrently uploaded.
-        extra1 = [p for p in (c1 - s1) if p.last_modified < start]
-        if extra1:
-            LOG.info("Removing %d extra packages from cache", len(extra1))
-            self.engine.delete(extra1)
-
-        # If any packages were concurrently deleted during the cache rebuild,
-        # we can detect them by polling storage again and looking for any
-        # packages that were present in s1 and are missing from s2
-        s2 = set(self.storage.list(self.package_class))
-        # Delete extra packages from cache (s1 - s2)
-        extra2 = s1 - s2
-        if extra2:
-            LOG.info(
-                "Removing %d packages from cache that were concurrently "
-                "deleted during rebuild",
-                len(extra2),
-            )
-            self.engine.delete(extra2)
-            # Remove these concurrently-deleted files from the list of packages
-            # that were missing from the cache. Don't want to use those to
-            # update the summaries below.
-            missing -= extra2
+            if clear:
+                self.clear_all()
+            elif self._reload_incremental():
+                return
+            start = datetime.utcnow()
+            # Only write one summary per package name, at the end
+            latest = {}
+            packages = self.storage.list(self.package_class)
+            for batch in chunked(packages, self.reload_batch_size):
+                self.engine.save(batch, overwrite=True)
+                for package in batch:
+                    newest = latest.get(package.name)
+                    if newest is None or package.last_modified > newest.last_modified:
+                        latest[package.name] = package
+            summaries = [PackageSummary(package) for package in latest.values()]
+            LOG.info("Saving %d package summaries", len(summaries))
+            self.engine.save(summaries, overwrite=True)
+            if self.incremental_reload:
+                self.set_watermark(start)
+            self._invalidate_indexes()
+            return
+        if not self._reload_incremental():
+            self._reload_graceful()
+
+    def _fetch_batch(self, filenames):
+        pkgs = self.engine.get(DynamoPackage, list(filenames))
+        return dict((pkg.filename, pkg) for pkg in pkgs)
+
+    def _save_batch(self, packages):
+        self.engine.save(packages)
 
         # Update the PackageSummary for added packages
         packages_by_name = defaultdict(list)
-        for package in missing:
+        for package in packages:
             # Set the tz here so we can compare against the PackageSummary
             package.last_modified = package.last_modified.replace(tzinfo=UTC)
             packages_by_name[package.name].append(package)
@@ -233,16 +559,18 @@ class DynamoCache(ICache):
         if summaries:
             LOG.info("Updating %d package summaries", len(summaries))
             self.engine.save(summaries, overwrite=True)
+            if self.summary_snapshot is not None:
+                self.summary_snapshot.update([s.__json__() for s in summaries])
 
+    def _clear_batch(self, packages):
+        self.engine.delete(packages)
         # Remove the PackageSummary for deleted packages
-        removed = set()
-        for package in extra1:
-            removed.add(package.name)
-        for package in extra2:
-            removed.add(package.name)
-        for name in removed:
+        for name in set(package.name for package in packages):
             self._maybe_delete_summary(name)
 
+    def _iter_cached(self, batch_size):
+        return chunked(self._scan(DynamoPackage), batch_size)
+
     def check_health(self):
         try:
             self.engine.scan(PackageSummary).first()
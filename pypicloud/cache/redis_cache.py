@@ -2,14 +2,19 @@
 from __future__ import unicode_literals
 
 import calendar
+import copy
 import json
 import logging
+import os
 import six
-from collections import defaultdict
+import threading
+import time
 from datetime import datetime
 from pyramid.settings import asbool
+from redis.exceptions import ResponseError
 
 from .base import ICache
+from pypicloud.util import TimedCache, chunked, sortable_version
 
 
 try:
@@ -18,15 +23,253 @@ except ImportError:  # pragma: no cover
     izip = zip  # pylint: disable=C0103
 
 LOG = logging.getLogger(__name__)
-
-
-def summary_from_package(package):
-    """ Create a summary dict from a package """
-    return {
-        "name": package.name,
-        "summary": package.summary or "",
-        "last_modified": package.last_modified,
-    }
+# Number of keys to ask for in each SCAN and to send in each pipeline
+DEFAULT_SCAN_BATCH_SIZE = 1000
+# Channel that redis sends client tracking invalidations to
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+
+# KEYS: package hash, set of names, set of filenames, summary hash and
+# optionally the version index
+# ARGV: name, version index member, save summary (0/1), hash field/value pairs
+SAVE_SCRIPT = """
+local name, member, save_summary = ARGV[1], ARGV[2], ARGV[3]
+local fields = {}
+for i = 4, #ARGV, 2 do
+    fields[ARGV[i]] = ARGV[i + 1]
+end
+redis.call("HMSET", KEYS[1], unpack(ARGV, 4))
+redis.call("SADD", KEYS[2], name)
+redis.call("SADD", KEYS[3], fields["filename"])
+if #KEYS > 4 then
+    redis.call("ZADD", KEYS[5], 0, member)
+end
+if save_summary == "1" then
+    local current = redis.call("HGET", KEYS[4], "last_modified")
+    if not current or tonumber(current) <= tonumber(fields["last_modified"]) then
+        redis.call(
+            "HMSET", KEYS[4], "name", name, "summary", fields["summary"],
+            "last_modified", fields["last_modified"]
+        )
+    end
+end
+"""
+# KEYS: same as SAVE_SCRIPT
+# ARGV: name, version index member, filename
+# Returns the number of files left for the package
+CLEAR_SCRIPT = """
+local name, member, filename = ARGV[1], ARGV[2], ARGV[3]
+redis.call("DEL", KEYS[1])
+redis.call("SREM", KEYS[3], filename)
+if #KEYS > 4 then
+    redis.call("ZREM", KEYS[5], member)
+end
+local count = redis.call("SCARD", KEYS[3])
+if count == 0 then
+    redis.call("SREM", KEYS[2], name)
+    redis.call("DEL", KEYS[4])
+end
+return count
+"""
+
+
+class NearCache(object):
+
+    """
+    In-process cache of redis reads
+
+    Entries are invalidated by redis client tracking, which needs redis 6.0 or
+    later. A background thread subscribes to the invalidation messages for all
+    keys under the prefix (broadcasting mode). Nothing is cached until the
+    subscription is active, and the cache is cleared whenever the connection
+    is lost, so that missed invalidations can't leave stale entries behind.
+    If the server doesn't support client tracking, the near cache disables
+    itself and every read goes to redis.
+
+    Parameters
+    ----------
+    db : :class:`redis.StrictRedis`
+    prefix : str
+        The prefix of all of the pypicloud keys
+    cache_time : int
+        Evict entries after this many seconds, in case an invalidation is
+        missed without the connection being dropped
+    max_size : int
+        The maximum number of entries
+
+    """
+
+    # Seconds between pings of the tracking connection
+    ping_interval = 10
+    # Maximum seconds to wait before reconnecting after an error
+    max_retry_delay = 60
+
+    def __init__(self, db, prefix, cache_time, max_size):
+        self._db = db
+        self._prefix = prefix
+        self._cache = TimedCache(cache_time, max_size=max_size)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._ready = False
+        self._thread = None
+        self._pid = None
+        self._disabled = False
+
+    def get(self, key, loader):
+        """
+        Get a cached value, or load and cache it
+
+        Parameters
+        ----------
+        key : tuple
+            ``("fetch", filename)``, ``("all", name)``, ``("distinct",)`` or
+            ``("summary",)``
+        loader : callable
+            Called with no arguments to read the value from redis
+
+        """
+        self._ensure_listening()
+        with self._lock:
+            ready = self._ready
+            if ready and key in self._cache:
+                return self._cache[key]
+            generation = self._generation
+        value = loader()
+        if ready:
+            with self._lock:
+                # If anything was invalidated while we were reading, the value
+                # we read may already be stale.
+                if self._generation == generation:
+                    self._cache[key] = value
+        return value
+
+    def invalidate(self, keys):
+        """
+        Drop the entries that depend on some redis keys
+
+        Parameters
+        ----------
+        keys : list or None
+            List of redis keys that changed. None drops everything.
+
+        """
+        with self._lock:
+            self._generation += 1
+            if keys is None:
+                self._cache.clear()
+                return
+            for key in keys:
+                self._invalidate_key(key)
+
+    def _invalidate_key(self, key):
+        """ Drop the entries that depend on one redis key """
+        if not key.startswith(self._prefix):
+            return
+        kind, _, arg = key[len(self._prefix) :].partition(":")
+        if kind == "package":
+            self._cache.pop(("fetch", arg), None)
+            # Overwriting a package only changes its hash, and we don't know
+            # which package name it belongs to.
+            for entry in [k for k in self._cache if k[0] == "all"]:
+                self._cache.pop(entry, None)
+        elif kind in ("set", "versions"):
+            if arg:
+                self._cache.pop(("all", arg), None)
+            else:
+                self._cache.pop(("distinct",), None)
+                self._cache.pop(("summary",), None)
+        elif kind == "summary":
+            self._cache.pop(("summary",), None)
+
+    def clear(self):
+        """ Drop all entries and stop serving from the cache """
+        with self._lock:
+            self._generation += 1
+            self._ready = False
+            self._cache.clear()
+
+    def _ensure_listening(self):
+        """ Start the invalidation thread in this process if needed """
+        pid = os.getpid()
+        if self._disabled or (self._pid == pid and self._thread is not None):
+            return
+        with self._lock:
+            if self._disabled or (self._pid == pid and self._thread is not None):
+                return
+            # Threads don't survive a fork, and the cache may have been
+            # populated by the parent.
+            self._pid = pid
+            self._ready = False
+            self._cache.clear()
+            self._thread = threading.Thread(
+                target=self._listen, name="pypicloud-redis-near-cache"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _listen(self):
+        """ Receive invalidations until the process exits """
+        delay = 1
+        while True:
+            try:
+                self._listen_once()
+            except ResponseError as e:
+                # Only the CLIENT commands can fail this way, and they won't
+                # start working on a retry.
+                LOG.warning(
+                    "Disabling redis near cache. Client tracking needs "
+                    "redis 6.0 or later: %s",
+                    e,
+                )
+                self._disabled = True
+                self.clear()
+                return
+            except Exception:  # pylint: disable=W0703
+                LOG.exception("Lost connection for redis cache invalidation")
+            with self._lock:
+                if self._ready:
+                    delay = 1
+            self.clear()
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_retry_delay)
+
+    def _listen_once(self):
+        """ Subscribe to invalidations and process them until an error """
+        pool = self._db.connection_pool
+        pubsub = self._db.pubsub()
+        pubsub.connection = pool.get_connection("SUBSCRIBE")
+        tracker = pool.get_connection("CLIENT")
+        try:
+            pubsub.connection.send_command("CLIENT", "ID")
+            client_id = pubsub.connection.read_response()
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            tracker.send_command(
+                "CLIENT",
+                "TRACKING",
+                "ON",
+                "REDIRECT",
+                client_id,
+                "BCAST",
+                "PREFIX",
+                self._prefix,
+            )
+            tracker.read_response()
+            last_ping = time.time()
+            with self._lock:
+                self._ready = True
+            while True:
+                message = pubsub.get_message(timeout=self.ping_interval)
+                if message is not None and message["type"] == "message":
+                    self.invalidate(message["data"])
+                if time.time() - last_ping >= self.ping_interval:
+                    # Tracking stops silently if this connection drops
+                    tracker.send_command("PING")
+                    tracker.read_response()
+                    last_ping = time.time()
+        finally:
+            pubsub.reset()
+            tracker.disconnect()
+            pool.release(tracker)
 
 
 class RedisCache(ICache):
@@ -35,10 +278,26 @@ class RedisCache(ICache):
 
     redis_prefix = "pypicloud:"
 
-    def __init__(self, request=None, db=None, graceful_reload=False, **kwargs):
+    def __init__(
+        self,
+        request=None,
+        db=None,
+        graceful_reload=False,
+        scan_batch_size=DEFAULT_SCAN_BATCH_SIZE,
+        unlink=False,
+        version_index=False,
+        near_cache=None,
+        **kwargs
+    ):
         super(RedisCache, self).__init__(request, **kwargs)
         self.db = db
         self.graceful_reload = graceful_reload
+        self.scan_batch_size = scan_batch_size
+        self.unlink = unlink
+        self.version_index = version_index
+        self.near_cache = near_cache
+        self._save_script = self.db.register_script(SAVE_SCRIPT)
+        self._clear_script = self.db.register_script(CLEAR_SCRIPT)
 
     @classmethod
     def configure(cls, settings):
@@ -50,8 +309,20 @@ class RedisCache(ICache):
                 "You must 'pip install redis' before using " "redis as the database"
             )
         kwargs["graceful_reload"] = asbool(settings.get("db.graceful_reload", False))
+        kwargs["scan_batch_size"] = int(
+            settings.get("db.scan_batch_size", DEFAULT_SCAN_BATCH_SIZE)
+        )
+        kwargs["unlink"] = asbool(settings.get("db.unlink", False))
+        kwargs["version_index"] = asbool(settings.get("db.version_index", False))
         db_url = settings.get("db.url")
-        kwargs["db"] = StrictRedis.from_url(db_url, decode_responses=True)
+        kwargs["db"] = db = StrictRedis.from_url(db_url, decode_responses=True)
+        if asbool(settings.get("db.near_cache", False)):
+            kwargs["near_cache"] = NearCache(
+                db,
+                cls.redis_prefix,
+                int(settings.get("db.near_cache_time", 300)),
+                int(settings.get("db.near_cache_size", 10000)),
+            )
         return kwargs
 
     def redis_key(self, key):
@@ -71,7 +342,50 @@ class RedisCache(ICache):
         """ Get the redis key to a summary for a package """
         return "%ssummary:%s" % (self.redis_prefix, name)
 
+    def redis_version_index(self, name):
+        """ Get the key to a redis sorted set of filenames in version order """
+        return "%sversions:%s" % (self.redis_prefix, name)
+
+    @staticmethod
+    def _version_index_member(package):
+        """ Get the member of the version index for a package """
+        return sortable_version(package.version) + "|" + package.filename
+
+    @property
+    def redis_watermark_key(self):
+        """ Get the redis key that stores the time of the last reload """
+        return self.redis_prefix + "watermark"
+
+    def get_watermark(self):
+        watermark = self.db.get(self.redis_watermark_key)
+        if watermark is None:
+            return None
+        return datetime.utcfromtimestamp(float(watermark))
+
+    def set_watermark(self, watermark):
+        dt = watermark
+        timestamp = calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
+        self.db.set(self.redis_watermark_key, timestamp)
+
+    def cached_filenames(self):
+        pipe = self.db.pipeline()
+        for name in self.db.smembers(self.redis_set):
+            pipe.smembers(self.redis_filename_set(name))
+        filenames = set()
+        for members in pipe.execute():
+            filenames.update(members)
+        return filenames
+
     def fetch(self, filename):
+        if self.near_cache is not None:
+            # Callers may modify the package, so never hand out the cached one
+            return copy.deepcopy(
+                self.near_cache.get(("fetch", filename), lambda: self._fetch(filename))
+            )
+        return self._fetch(filename)
+
+    def _fetch(self, filename):
+        """ Fetch a package from redis """
         data = self.db.hgetall(self.redis_key(filename))
         if not data:
             return None
@@ -92,6 +406,16 @@ class RedisCache(ICache):
         )
 
     def all(self, name):
+        if self.near_cache is not None:
+            return copy.deepcopy(
+                self.near_cache.get(("all", name), lambda: self._all(name))
+            )
+        return self._all(name)
+
+    def _all(self, name):
+        """ Fetch all versions of a package from redis """
+        if self.version_index:
+            return self.paginate(name)
         filenames = self.db.smembers(self.redis_filename_set(name))
         pipe = self.db.pipeline()
         for filename in filenames:
@@ -100,10 +424,97 @@ class RedisCache(ICache):
         packages.sort(reverse=True)
         return packages
 
+    def latest(self, name):
+        if not self.version_index:
+            return super(RedisCache, self).latest(name)
+        packages = self.paginate(name, 0, 1)
+        if packages:
+            return packages[0]
+        return super(RedisCache, self).latest(name)
+
+    def paginate(self, name, offset=0, limit=None):
+        if not self.version_index:
+            return super(RedisCache, self).paginate(name, offset, limit)
+        index = self.redis_version_index(name)
+        # The members all have the same score, so they are ordered by the
+        # sortable version at the start of the member
+        pipe = self.db.pipeline()
+        pipe.zcard(index)
+        pipe.scard(self.redis_filename_set(name))
+        if limit is None:
+            pipe.zrevrangebylex(index, "+", "-")
+        else:
+            pipe.zrevrangebylex(index, "+", "-", start=offset, num=limit)
+        indexed, count, members = pipe.execute()
+        if indexed != count:
+            # Files that were cached before the index was turned on are not in
+            # it yet
+            self._index_versions(name)
+            members = self.db.zrevrangebylex(index, "+", "-")
+            end = None if limit is None else offset + limit
+            members = members[offset:end]
+        elif limit is None:
+            members = members[offset:]
+        pipe = self.db.pipeline()
+        for member in members:
+            pipe.hgetall(self.redis_key(member.partition("|")[2]))
+        return [self._load(data) for data in pipe.execute() if data]
+
+    def _index_versions(self, name):
+        """ Make the version index of a package match its set of filenames """
+        LOG.info("Indexing the versions of %s", name)
+        index = self.redis_version_index(name)
+        filenames = list(self.db.smembers(self.redis_filename_set(name)))
+        pipe = self.db.pipeline()
+        for filename in filenames:
+            pipe.hget(self.redis_key(filename), "version")
+        args = []
+        for filename, version in izip(filenames, pipe.execute()):
+            if version is not None:
+                args.extend((0, sortable_version(version) + "|" + filename))
+        pipe = self.db.pipeline()
+        if args:
+            pipe.execute_command("ZADD", index, *args)
+        current = set(filenames)
+        stale = [
+            member
+            for member in self.db.zrange(index, 0, -1)
+            if member.partition("|")[2] not in current
+        ]
+        if stale:
+            pipe.zrem(index, *stale)
+        pipe.execute()
+
+    def version_stamp(self, name):
+        pipe = self.db.pipeline()
+        pipe.scard(self.redis_filename_set(name))
+        pipe.hget(self.redis_summary_key(name), "last_modified")
+        count, last_modified = pipe.execute()
+        if count == 0:
+            return None
+        if last_modified is None:
+            return super(RedisCache, self).version_stamp(name)
+        return (datetime.utcfromtimestamp(float(last_modified)), count)
+
     def distinct(self):
+        if self.near_cache is not None:
+            return list(self.near_cache.get(("distinct",), self._distinct))
+        return self._distinct()
+
+    def _distinct(self):
+        """ Fetch all package names from redis """
         return list(self.db.smembers(self.redis_set))
 
     def summary(self):
+        if self.near_cache is not None:
+            return [
+                dict(summary)
+                for summary in self.near_cache.get(("summary",), self._summary)
+            ]
+        return self._summary()
+
+    def _summary(self):
+        """ Fetch all package summaries from redis """
         return self._load_summaries(self.db.smembers(self.redis_set))
 
     def _load_summaries(self, package_names):
@@ -120,44 +531,74 @@ class RedisCache(ICache):
             )
         return summaries
 
-    def clear(self, package):
-        count = self._delete_package(package)
-        if count == 0:
-            self._delete_summary(package.name)
-
-    def _delete_package(self, package, pipe=None):
-        """ Delete package keys from redis """
-        should_execute = False
-        if pipe is None:
-            should_execute = True
-            pipe = self.db.pipeline()
-        pipe.delete(self.redis_key(package.filename))
-        pipe.srem(self.redis_filename_set(package.name), package.filename)
-        if should_execute:
-            pipe.scard(self.redis_filename_set(package.name))
-            return pipe.execute()[2]
-
-    def _delete_summary(self, package_name, pipe=None):
-        """ Delete summary keys from redis """
-        should_execute = False
-        if pipe is None:
-            should_execute = True
-            pipe = self.db.pipeline()
-        pipe.srem(self.redis_set, package_name)
-        pipe.delete(self.redis_summary_key(package_name))
-        if should_execute:
-            pipe.execute()
+    def clear(self, package, pipe=None):
+        keys, args = self._script_keys(package)
+        args.append(package.filename)
+        client = self.db if pipe is None else pipe
+        remaining = self._clear_script(keys=keys, args=args, client=client)
+        self._invalidate_near_cache(keys)
+        return remaining
+
+    def _invalidate_near_cache(self, keys):
+        """
+        Invalidate the near-cache immediately after a local write
+
+        Other processes are notified by redis client tracking.
+
+        """
+        if self.near_cache is not None:
+            self.near_cache.invalidate(keys)
+
+    def _script_keys(self, package):
+        """ Get the KEYS and first ARGV for the save and clear scripts """
+        keys = [
+            self.redis_key(package.filename),
+            self.redis_set,
+            self.redis_filename_set(package.name),
+            self.redis_summary_key(package.name),
+        ]
+        member = ""
+        if self.version_index:
+            keys.append(self.redis_version_index(package.name))
+            member = self._version_index_member(package)
+        return keys, [package.name, member]
 
     def clear_all(self):
-        keys = self.db.keys(self.redis_prefix + "*")
-        if keys:
-            self.db.delete(*keys)
+        for keys in self._scan(self.redis_prefix + "*"):
+            self._delete_keys(keys)
+        self._invalidate_near_cache(None)
+
+    def _scan(self, pattern, batch_size=None):
+        """
+        Iterate over the keys that match a pattern without blocking redis
+
+        Parameters
+        ----------
+        pattern : str
+            Glob-style pattern for the keys
+        batch_size : int, optional
+            The maximum number of keys in each batch. Defaults to
+            ``scan_batch_size``.
+
+        Returns
+        -------
+        batches : generator
+            Generator of lists of keys
+
+        """
+        batch_size = batch_size or self.scan_batch_size
+        keys = self.db.scan_iter(match=pattern, count=batch_size)
+        return chunked(keys, batch_size)
+
+    def _delete_keys(self, keys, pipe=None):
+        """ Delete keys with UNLINK if enabled, otherwise with DEL """
+        db = self.db if pipe is None else pipe
+        if self.unlink:
+            db.unlink(*keys)
+        else:
+            db.delete(*keys)
 
     def save(self, package, pipe=None, save_summary=True):
-        should_execute = False
-        if pipe is None:
-            pipe = self.db.pipeline()
-            should_execute = True
         dt = package.last_modified
         last_modified = calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
         data = {
@@ -169,137 +610,70 @@ class RedisCache(ICache):
         }
         for key, value in six.iteritems(package.data):
             data[key] = json.dumps(value)
-        pipe.hmset(self.redis_key(package.filename), data)
-        pipe.sadd(self.redis_set, package.name)
-        pipe.sadd(self.redis_filename_set(package.name), package.filename)
-        if save_summary:
-            self._save_summary(summary_from_package(package), pipe)
-        if should_execute:
-            pipe.execute()
-
-    def _save_summary(self, summary, pipe):
-        """ Save a summary dict to redis """
-        dt = summary["last_modified"]
-        last_modified = calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
-        pipe.hmset(
-            self.redis_summary_key(summary["name"]),
-            {
-                "name": summary["name"],
-                "summary": summary["summary"],
-                "last_modified": last_modified,
-            },
-        )
+        keys, args = self._script_keys(package)
+        args.append(1 if save_summary else 0)
+        for field, value in six.iteritems(data):
+            args.extend((field, value))
+        client = self.db if pipe is None else pipe
+        self._save_script(keys=keys, args=args, client=client)
+        self._invalidate_near_cache(keys)
 
     def _load_all_packages(self):
         """ Load all packages that are in redis """
-        pipe = self.db.pipeline()
-        for filename_key in self.db.keys(self.redis_key("*")):
-            pipe.hgetall(filename_key)
-        return [self._load(data) for data in pipe.execute() if data]
+        packages = []
+        for batch in self._iter_cached(self.scan_batch_size):
+            packages.extend(batch)
+        return packages
 
     def reload_from_storage(self, clear=True):
         if not self.graceful_reload:
             if clear:
                 self.clear_all()
+            elif self._reload_incremental():
+                return
+            start = datetime.utcnow()
             packages = self.storage.list(self.package_class)
-            pipe = self.db.pipeline()
-            for pkg in packages:
-                self.save(pkg, pipe=pipe)
-            pipe.execute()
+            for batch in chunked(packages, self.scan_batch_size):
+                pipe = self.db.pipeline()
+                for pkg in batch:
+                    self.save(pkg, pipe=pipe)
+                pipe.execute()
+            if self.incremental_reload:
+                self.set_watermark(start)
+            self._invalidate_indexes()
             return
 
-        LOG.info("Rebuilding cache from storage")
-        # Log start time
-        start = datetime.utcnow()
-        # Fetch packages from storage s1
-        s1 = set(self.storage.list(self.package_class))
-        # Fetch cache packages c1
-        c1 = set(self._load_all_packages())
-
-        # Add missing packages to cache (s1 - c1)
-        missing = s1 - c1
-        if missing:
-            LOG.info("Adding %d missing packages to cache", len(missing))
-            pipe = self.db.pipeline()
-            for package in missing:
-                self.save(package, pipe, save_summary=False)
-            pipe.execute()
-
-        # Delete extra packages from cache (c1 - s1) when last_modified < start
-        # The time filter helps us avoid deleting packages that were
-        # concurrently uploaded.
-        extra1 = [p for p in (c1 - s1) if p.last_modified < start]
-        if extra1:
-            LOG.info("Removing %d extra packages from cache", len(extra1))
-            pipe = self.db.pipeline()
-            for package in extra1:
-                self._delete_package(package, pipe)
-            pipe.execute()
-
-        # If any packages were concurrently deleted during the cache rebuild,
-        # we can detect them by polling storage again and looking for any
-        # packages that were present in s1 and are missing from s2
-        s2 = set(self.storage.list(self.package_class))
-        # Delete extra packages from cache (s1 - s2)
-        extra2 = s1 - s2
-        if extra2:
-            LOG.info(
-                "Removing %d packages from cache that were concurrently "
-                "deleted during rebuild",
-                len(extra2),
-            )
-            pipe = self.db.pipeline()
-            for package in extra2:
-                self._delete_package(package, pipe)
-            pipe.execute()
-            # Remove these concurrently-deleted files from the list of packages
-            # that were missing from the cache. Don't want to use those to
-            # update the summaries below.
-            missing -= extra2
-
-        # Update the summary for added packages
-        packages_by_name = defaultdict(list)
-        for package in missing:
-            package.last_modified = package.last_modified
-            packages_by_name[package.name].append(package)
-
-        summaries = self._load_summaries(packages_by_name.keys())
-        summaries_by_name = {}
-        for summary in summaries:
-            summaries_by_name[summary["name"]] = summary
-        for name, packages in six.iteritems(packages_by_name):
-            if name in summaries_by_name:
-                summary = summaries_by_name[name]
-            else:
-                summary = summary_from_package(packages[0])
-                summaries.append(summary)
-            for package in packages:
-                if package.last_modified > summary["last_modified"]:
-                    summary["last_modified"] = package.last_modified
-                    summary["summary"] = package.summary
-        if summaries:
-            LOG.info("Updating %d package summaries", len(summaries))
-            pipe = self.db.pipeline()
-            for summary in summaries:
-                self._save_summary(summary, pipe)
-            pipe.execute()
-
-        # Remove the PackageSummary for deleted packages
-        removed = set()
-        for package in extra1:
-            removed.add(package.name)
-        for package in extra2:
-            removed.add(package.name)
-        if removed:
-            pipe = self.db.pipeline()
-            for name in removed:
-                pipe.scard(self.redis_filename_set(name))
-            counts = pipe.execute()
+        if not self._reload_incremental():
+            self._reload_graceful()
+
+    def _fetch_batch(self, filenames):
+        pipe = self.db.pipeline()
+        for filename in filenames:
+            pipe.hgetall(self.redis_key(filename))
+        packages = {}
+        for filename, data in izip(filenames, pipe.execute()):
+            if data:
+                packages[filename] = self._load(data)
+        return packages
+
+    def _save_batch(self, packages):
+        pipe = self.db.pipeline()
+        for package in packages:
+            self.save(package, pipe)
+        pipe.execute()
+
+    def _clear_batch(self, packages):
+        pipe = self.db.pipeline()
+        for package in packages:
+            self.clear(package, pipe)
+        pipe.execute()
+
+    def _iter_cached(self, batch_size):
+        for batch in self._scan(self.redis_key("*"), batch_size):
             pipe = self.db.pipeline()
-            for name, count in izip(removed, counts):
-                if count == 0:
-                    self._delete_summary(name, pipe)
-            pipe.execute()
+            for key in batch:
+                pipe.hgetall(key)
+            yield [self._load(data) for data in pipe.execute() if data]
 
     def check_health(self):
         from redis import RedisError
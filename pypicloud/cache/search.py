@@ -0,0 +1,285 @@
+""" Indexes that speed up searching the cache """
+import logging
+import threading
+import time
+
+from pyramid.path import DottedNameResolver
+
+from pypicloud.util import create_matcher, sortable_version
+
+
+LOG = logging.getLogger(__name__)
+
+
+def get_search_index(settings):
+    """
+    Create the search index from settings
+
+    Returns None if no search index is configured.
+
+    """
+    dotted_index = settings.get("db.search_index")
+    if not dotted_index:
+        return None
+    if dotted_index == "ngram":
+        dotted_index = "pypicloud.cache.search.NGramSearchIndex"
+    index_impl = DottedNameResolver(__name__).resolve(dotted_index)
+    return index_impl(**index_impl.configure(settings))
+
+
+class ISearchIndex(object):
+
+    """
+    Base class for an index of the cached packages used by pip search
+
+    A single index is shared by all requests in a process, so implementations
+    must be thread-safe.
+
+    """
+
+    @classmethod
+    def configure(cls, settings):
+        """ Configure the search index with app settings """
+        return {}
+
+    def add(self, package):
+        """
+        Index a package that was saved to the cache
+
+        Parameters
+        ----------
+        package : :class:`~pypicloud.models.Package`
+
+        """
+        raise NotImplementedError
+
+    def remove(self, package):
+        """
+        Remove a package that was cleared from the cache
+
+        Parameters
+        ----------
+        package : :class:`~pypicloud.models.Package`
+
+        """
+        raise NotImplementedError
+
+    def invalidate(self):
+        """ Called when the cache was changed in bulk, e.g. by a reload """
+        raise NotImplementedError
+
+    def search(self, cache, criteria, query_type):
+        """
+        Perform a search from pip
+
+        Has the same semantics as :meth:`~pypicloud.cache.ICache.search`, but
+        the results may be ranked by relevance.
+
+        Parameters
+        ----------
+        cache : :class:`~pypicloud.cache.ICache`
+            The cache to load the matching packages from
+        criteria : dict
+        query_type : str
+
+        """
+        raise NotImplementedError
+
+
+class NGramSearchIndex(ISearchIndex):
+
+    """
+    In-process inverted index of the trigrams in package names and summaries
+
+    Queries of at least three characters only look at the packages that
+    contain all of their trigrams, and the candidates are then checked with
+    the same substring matching as an unindexed search. Other processes may
+    change the cache without updating this index, so it is rebuilt from the
+    cache when it is older than ``cache_time`` seconds.
+
+    Parameters
+    ----------
+    cache_time : int, optional
+        Rebuild the index after this many seconds (default 300)
+
+    """
+
+    n = 3
+
+    def __init__(self, cache_time=300):
+        self.cache_time = cache_time
+        self._lock = threading.Lock()
+        # Only one thread scans the cache at a time
+        self._rebuild_lock = threading.Lock()
+        self._built = None
+        # Changes made while the index is being rebuilt
+        self._changes = None
+        # Incremented by invalidate()
+        self._generation = 0
+        # filename -> (name, summary, sortable version)
+        self._docs = {}
+        # ngram -> set of filenames
+        self._postings = {}
+
+    @classmethod
+    def configure(cls, settings):
+        return {"cache_time": int(settings.get("db.search_index_time", 300))}
+
+    def _ngrams(self, text):
+        """ Get the set of ngrams in a lowercase string """
+        return set(text[i : i + self.n] for i in range(len(text) - self.n + 1))
+
+    def _add(self, package):
+        """ Add a package to the index. Must hold the lock. """
+        self._remove(package.filename)
+        self._index(self._docs, self._postings, package)
+
+    def _index(self, docs, postings, package):
+        """ Add a new package to a set of documents and postings """
+        name = package.name.lower()
+        summary = package.summary.lower() if package.summary is not None else None
+        docs[package.filename] = (name, summary, sortable_version(package.version))
+        for gram in self._ngrams(name) | self._ngrams(summary or ""):
+            postings.setdefault(gram, set()).add(package.filename)
+
+    def _remove(self, filename):
+        """ Remove a package from the index. Must hold the lock. """
+        doc = self._docs.pop(filename, None)
+        if doc is None:
+            return
+        for gram in self._ngrams(doc[0]) | self._ngrams(doc[1] or ""):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(filename)
+                if not postings:
+                    del self._postings[gram]
+
+    def add(self, package):
+        with self._lock:
+            if self._built is not None:
+                self._add(package)
+            if self._changes is not None:
+                self._changes.append((self._add, package))
+
+    def remove(self, package):
+        with self._lock:
+            if self._built is not None:
+                self._remove(package.filename)
+            if self._changes is not None:
+                self._changes.append((self._remove, package.filename))
+
+    def invalidate(self):
+        with self._lock:
+            self._built = None
+            self._generation += 1
+
+    def _needs_rebuild(self):
+        """ Check if the index is missing or too old """
+        return self._built is None or time.time() - self._built > self.cache_time
+
+    def _rebuild(self, cache):
+        """
+        Build the index from all packages in the cache
+
+        The cache is scanned without holding the lock, so searches can keep
+        using the old index, and the new index is swapped in at the end. If
+        another thread is already rebuilding, this waits for it only when
+        there is no old index to use.
+
+        """
+        if not self._rebuild_lock.acquire(self._built is None):
+            return
+        try:
+            if not self._needs_rebuild():
+                return
+            LOG.info("Building the search index")
+            started = time.time()
+            with self._lock:
+                self._changes = []
+                generation = self._generation
+            docs = {}
+            postings = {}
+            try:
+                for batch in cache._iter_cached(cache.reload_batch_size):
+                    for package in batch:
+                        self._index(docs, postings, package)
+            except Exception:
+                with self._lock:
+                    self._changes = None
+                raise
+            with self._lock:
+                self._docs = docs
+                self._postings = postings
+                # The scan may have missed the changes made while it ran
+                for method, arg in self._changes:
+                    method(arg)
+                self._changes = None
+                # Rebuild again if the cache was reloaded during the scan
+                if self._generation == generation:
+                    self._built = started
+        finally:
+            self._rebuild_lock.release()
+
+    def _candidates(self, queries, query_type):
+        """ Get a superset of the filenames that match. Must hold the lock. """
+        if not queries:
+            # An empty "and" matches everything
+            return set(self._docs) if query_type == "and" else set()
+        candidates = None
+        for query in queries:
+            grams = self._ngrams(query.lower())
+            if len(query) < self.n:
+                matches = set(self._docs)
+            else:
+                postings = [self._postings.get(gram, set()) for gram in grams]
+                postings.sort(key=len)
+                matches = set(postings[0]).intersection(*postings[1:])
+            if candidates is None:
+                candidates = matches
+            elif query_type == "or":
+                candidates |= matches
+            else:
+                candidates &= matches
+        return candidates
+
+    def search(self, cache, criteria, query_type):
+        if self._needs_rebuild():
+            self._rebuild(cache)
+        name_queries = criteria.get("name", [])
+        summary_queries = criteria.get("summary", [])
+        match_name = create_matcher(name_queries, query_type)
+        match_summary = create_matcher(summary_queries, query_type)
+
+        # Find the latest matching version of each package
+        latest = {}
+        with self._lock:
+            candidates = self._candidates(name_queries, query_type)
+            candidates |= self._candidates(summary_queries, query_type)
+            for filename in candidates:
+                name, summary, version = self._docs[filename]
+                if not match_name(name) and (
+                    summary is None or not match_summary(summary)
+                ):
+                    continue
+                if name not in latest or version > latest[name][0]:
+                    latest[name] = (version, filename)
+
+        # Rank by how well the name matches
+        queries = [query.lower() for query in name_queries]
+
+        def rank(name):
+            """ Lower is more relevant """
+            if name in queries:
+                return (0, name)
+            if any(name.startswith(query) for query in queries):
+                return (1, name)
+            if match_name(name):
+                return (2, name)
+            return (3, name)
+
+        packages = []
+        for name in sorted(latest, key=rank):
+            package = cache.fetch(latest[name][1])
+            if package is not None:
+                packages.append(package)
+        return packages
@@ -1,22 +1,36 @@
 """ Store package data in a SQL database """
 import json
 import logging
+import threading
+import time
 import zope.sqlalchemy
 from datetime import datetime
-from pyramid.settings import asbool
-from sqlalchemy import engine_from_config, distinct, and_, or_, Column, DateTime, String
+from pyramid.settings import asbool, aslist
+from sqlalchemy import (
+    engine_from_config,
+    inspect,
+    and_,
+    or_,
+    Column,
+    DateTime,
+    Index,
+    String,
+)
+from sqlalchemy.dialects import mysql, postgresql
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import func
+from sqlalchemy.orm import object_session, sessionmaker
+from sqlalchemy.sql import func, literal_column, select
 from sqlalchemy.types import TypeDecorator, TEXT
 
 from .base import ICache
 from pypicloud.models import Package
+from pypicloud.util import chunked, sortable_version
 
 
 LOG = logging.getLogger(__name__)
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
 Base = declarative_base()  # pylint: disable=C0103
 
@@ -82,6 +96,38 @@ class SQLPackage(Package, Base):
     last_modified = Column(DateTime(), index=True, nullable=False)
     summary = Column(String(255, convert_unicode=True), index=True, nullable=True)
     data = Column(JSONEncodedDict(), nullable=False)
+    # Sorts in version order, so that the database can order by version
+    sort_version = Column(String(255, convert_unicode=True), nullable=True)
+
+    __table_args__ = (Index("ix_packages_name_sort_version", name, sort_version),)
+
+    def __init__(self, *args, **kwargs):
+        super(SQLPackage, self).__init__(*args, **kwargs)
+        self.sort_version = make_sort_version(self.version)
+
+
+def make_sort_version(version):
+    """ Get the value of the sort_version column for a version """
+    return sortable_version(version)[:255]
+
+
+class SQLPackageSummary(Base):
+
+    """ Summary of the most recently modified file of each package """
+
+    __tablename__ = "package_summaries"
+    name = Column(String(255, convert_unicode=True), primary_key=True)
+    summary = Column(String(255, convert_unicode=True), nullable=True)
+    last_modified = Column(DateTime(), nullable=False)
+
+
+class SQLMetadata(Base):
+
+    """ Key-value store for the state of the cache itself """
+
+    __tablename__ = "pypicloud_metadata"
+    key = Column(String(255, convert_unicode=True), primary_key=True)
+    value = Column(String(255, convert_unicode=True), nullable=True)
 
 
 def create_schema(engine):
@@ -99,6 +145,52 @@ def create_schema(engine):
 
     """
     Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+
+def upgrade_schema(engine):
+    """
+    Add the columns and indexes that an older version did not create
+
+    ``create_all`` only creates missing tables, so a ``packages`` table that
+    was created by an older version needs the ``sort_version`` column and its
+    index added to it.
+
+    Parameters
+    ----------
+    engine : :class:`sqlalchemy.Engine`
+
+    """
+    table = SQLPackage.__table__
+    inspector = inspect(engine)
+    columns = set(column["name"] for column in inspector.get_columns(table.name))
+    if "sort_version" not in columns:
+        LOG.info("Adding column sort_version to %s", table.name)
+        column_type = table.c.sort_version.type.compile(dialect=engine.dialect)
+        engine.execute(
+            "ALTER TABLE %s ADD COLUMN sort_version %s" % (table.name, column_type)
+        )
+    indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in indexes:
+            LOG.info("Adding index %s to %s", index.name, table.name)
+            index.create(bind=engine)
+
+    # Fill in the sort_version of rows written before the column existed
+    query = select([table.c.filename, table.c.version]).where(
+        table.c.sort_version.is_(None)
+    )
+    rows = engine.execute(query).fetchall()
+    if rows:
+        LOG.info("Setting sort_version of %d cached packages", len(rows))
+    for batch in chunked(rows, 500):
+        with engine.begin() as conn:
+            for filename, version in batch:
+                conn.execute(
+                    table.update()
+                    .where(table.c.filename == filename)
+                    .values(sort_version=make_sort_version(version))
+                )
 
 
 def drop_schema(engine):
@@ -118,22 +210,127 @@ def drop_schema(engine):
     Base.metadata.drop_all(bind=engine)
 
 
+class ReplicaSet(object):
+
+    """
+    Round-robin selection of read replicas
+
+    Parameters
+    ----------
+    engines : list
+        List of :class:`sqlalchemy.Engine` for the replicas
+    retry_interval : int, optional
+        Skip a replica for this many seconds after a query on it fails
+        (default 30)
+    sticky_time : int, optional
+        Send all reads from this process to the primary for this many seconds
+        after it writes to the cache (default 0)
+
+    """
+
+    def __init__(self, engines, retry_interval=30, sticky_time=0):
+        self.engines = engines
+        self.retry_interval = retry_interval
+        self.sticky_time = sticky_time
+        self.dbmaker = sessionmaker()
+        self._lock = threading.Lock()
+        self._next = 0
+        self._failed = {}
+        self._last_write = None
+
+    @classmethod
+    def configure(cls, settings):
+        """
+        Create the replica set from the ``db.replica.*`` settings
+
+        Returns None if there are no replicas configured. The settings are
+        removed so that they aren't passed to the primary engine.
+
+        """
+        replica_settings = {}
+        for key in list(settings):
+            if key.startswith("db.replica."):
+                replica_settings[key[len("db.replica.") :]] = settings.pop(key)
+        urls = aslist(replica_settings.pop("urls", ""))
+        retry_interval = int(replica_settings.pop("retry_interval", 30))
+        sticky_time = int(replica_settings.pop("sticky_time", 0))
+        if not urls:
+            return None
+        engines = []
+        for url in urls:
+            engine_settings = dict(replica_settings)
+            engine_settings["url"] = url
+            engines.append(engine_from_config(engine_settings, prefix=""))
+        return cls(engines, retry_interval, sticky_time)
+
+    def choose(self):
+        """
+        Get the next healthy replica
+
+        Returns None if all replicas have failed recently, or if this process
+        wrote to the cache within the last ``sticky_time`` seconds.
+
+        """
+        now = time.time()
+        with self._lock:
+            if (
+                self._last_write is not None
+                and now - self._last_write < self.sticky_time
+            ):
+                return None
+            for _ in range(len(self.engines)):
+                engine = self.engines[self._next]
+                self._next = (self._next + 1) % len(self.engines)
+                failed = self._failed.get(engine)
+                if failed is None or now - failed >= self.retry_interval:
+                    self._failed.pop(engine, None)
+                    return engine
+        return None
+
+    def mark_failed(self, engine):
+        """ Stop using a replica for ``retry_interval`` seconds """
+        with self._lock:
+            self._failed[engine] = time.time()
+
+    def mark_write(self):
+        """ Record that this process just wrote to the primary """
+        if self.sticky_time:
+            with self._lock:
+                self._last_write = time.time()
+
+    def dispose(self):
+        """ Dispose of the connection pools """
+        for engine in self.engines:
+            engine.dispose()
+
+
 class SQLCache(ICache):
 
     """ Caching database that uses SQLAlchemy """
 
     package_class = SQLPackage
 
-    def __init__(self, request=None, dbmaker=None, graceful_reload=False, **kwargs):
+    def __init__(
+        self, request=None, dbmaker=None, graceful_reload=False, replicas=None, **kwargs
+    ):
         super(SQLCache, self).__init__(request, **kwargs)
         self.dbmaker = dbmaker
         self.db = self.dbmaker()
         self.graceful_reload = graceful_reload
+        self.replicas = replicas
+        self._replica_db = None
+        self._replica_engine = None
+        # Once a request writes to the cache, it reads from the primary
+        self._primary_reads = replicas is None
 
         if request is not None:
             zope.sqlalchemy.register(self.db, transaction_manager=request.tm)
 
     def reload_if_needed(self):
+        self._use_primary()
+        if not self.distinct() and self.db.query(SQLPackage.filename).first():
+            # The summaries table is new, but the packages are already cached
+            self._rebuild_summaries()
         super(SQLCache, self).reload_if_needed()
         if self.request is None:
             self.db.commit()
@@ -143,11 +340,13 @@ class SQLCache(ICache):
     def configure(cls, settings):
         kwargs = super(SQLCache, cls).configure(settings)
         graceful_reload = asbool(settings.pop("db.graceful_reload", False))
+        replicas = ReplicaSet.configure(settings)
         engine = engine_from_config(settings, prefix="db.")
         # Create SQL schema if not exists
         create_schema(engine)
         kwargs["dbmaker"] = sessionmaker(bind=engine)
         kwargs["graceful_reload"] = graceful_reload
+        kwargs["replicas"] = replicas
         return kwargs
 
     @classmethod
@@ -155,17 +354,145 @@ class SQLCache(ICache):
         # Have to dispose of connections after uWSGI forks,
         # otherwise they'll get corrupted.
         kwargs["dbmaker"].kw["bind"].dispose()
+        if kwargs.get("replicas") is not None:
+            kwargs["replicas"].dispose()
+
+    @property
+    def read_db(self):
+        """ The session to use for read-only queries """
+        if self._primary_reads:
+            return self.db
+        if self._replica_db is None:
+            engine = self.replicas.choose()
+            if engine is None:
+                return self.db
+            self._replica_engine = engine
+            self._replica_db = self.replicas.dbmaker(bind=engine)
+            if self.request is not None:
+                self.request.add_finished_callback(lambda _: self._close_replica_db())
+        return self._replica_db
+
+    def _close_replica_db(self):
+        """ Release the connection to the replica """
+        if self._replica_db is not None:
+            self._replica_db.close()
+            self._replica_db = None
+
+    def _use_primary(self):
+        """ Send all further reads from this cache to the primary """
+        self._primary_reads = True
+        self._close_replica_db()
+
+    def _read(self, query):
+        """
+        Run a read-only query on a replica, falling back to the primary
+
+        Parameters
+        ----------
+        query : callable
+            Takes a session and returns the result of the query
+
+        """
+        db = self.read_db
+        if db is self.db:
+            return query(db)
+        try:
+            return query(db)
+        except SQLAlchemyError:
+            LOG.warning("Query on read replica failed", exc_info=True)
+            self.replicas.mark_failed(self._replica_engine)
+            self._close_replica_db()
+            return query(self.db)
+
+    def _mark_write(self):
+        """ Route reads to the primary after writing to it """
+        if self.replicas is not None:
+            self._use_primary()
+            self.replicas.mark_write()
+
+    def upload(self, filename, data, name=None, version=None, summary=None):
+        # Check for an existing package on the primary
+        self._use_primary()
+        return super(SQLCache, self).upload(
+            filename, data, name=name, version=version, summary=summary
+        )
+
+    def get_watermark(self):
+        row = self.db.query(SQLMetadata).filter_by(key="watermark").first()
+        if row is None or row.value is None:
+            return None
+        return datetime.strptime(row.value, WATERMARK_FORMAT)
+
+    def set_watermark(self, watermark):
+        self.db.merge(
+            SQLMetadata(key="watermark", value=watermark.strftime(WATERMARK_FORMAT))
+        )
+
+    def cached_filenames(self):
+        return set(row[0] for row in self.db.query(SQLPackage.filename))
 
     def fetch(self, filename):
-        return self.db.query(SQLPackage).filter_by(filename=filename).first()
+        return self._read(
+            lambda db: db.query(SQLPackage).filter_by(filename=filename).first()
+        )
 
     def all(self, name):
-        pkgs = self.db.query(SQLPackage).filter_by(name=name).all()
-        pkgs.sort(reverse=True)
-        return pkgs
+        return self._read(lambda db: self._versions_query(db, name).all())
+
+    def _versions_query(self, db, name):
+        """ Query the versions of a package, newest first """
+        return (
+            db.query(SQLPackage)
+            .filter_by(name=name)
+            .order_by(SQLPackage.sort_version.desc(), SQLPackage.filename.desc())
+        )
+
+    def latest(self, name):
+        return self._read(lambda db: self._versions_query(db, name).first())
+
+    def paginate(self, name, offset=0, limit=None):
+        def query(db):
+            """ Select one page of versions """
+            versions = self._versions_query(db, name).offset(offset)
+            if limit is not None:
+                versions = versions.limit(limit)
+            return versions.all()
+
+        return self._read(query)
+
+    def all_files(self, name):
+        # Select only the columns needed for links, without the ORM overhead
+        table = SQLPackage.__table__
+        query = select(
+            [
+                table.c.name,
+                table.c.version,
+                table.c.filename,
+                table.c.last_modified,
+                table.c.data,
+            ]
+        ).where(table.c.name == name)
+        rows = self._read(lambda db: db.execute(query).fetchall())
+        return [Package(row[0], row[1], row[2], row[3], **row[4]) for row in rows]
+
+    def version_stamp(self, name):
+        last_modified, count = self._read(
+            lambda db: db.query(
+                func.max(SQLPackage.last_modified), func.count(SQLPackage.filename)
+            )
+            .filter(SQLPackage.name == name)
+            .one()
+        )
+        if count == 0:
+            return None
+        return (last_modified, count)
 
     def distinct(self):
-        names = self.db.query(distinct(SQLPackage.name)).order_by(SQLPackage.name).all()
+        names = self._read(
+            lambda db: db.query(SQLPackageSummary.name)
+            .order_by(SQLPackageSummary.name)
+            .all()
+        )
         return [n[0] for n in names]
 
     def search(self, criteria, query_type):
@@ -188,6 +515,8 @@ class SQLCache(ICache):
                 (column2 LIKE '%c%' OR column2 LIKE '%d%')
 
         """
+        if self.search_index is not None:
+            return self.search_index.search(self, criteria, query_type)
         conditions = []
         for key, queries in criteria.items():
             # Make sure search key exists in the package class.
@@ -213,48 +542,113 @@ class SQLCache(ICache):
 
         # Piece together the queries. Refer to the method docstring for
         # examples as to how this works.
-        results = self.db.query(SQLPackage).filter(or_(*conditions))
+        def query(db):
+            """ Select the most recent matching version of each package """
+            subquery = (
+                db.query(
+                    SQLPackage.name,
+                    func.max(SQLPackage.sort_version).label("sort_version"),
+                )
+                .filter(or_(*conditions))
+                .group_by(SQLPackage.name)
+                .subquery()
+            )
+            return (
+                db.query(SQLPackage)
+                .filter(or_(*conditions))
+                .filter(
+                    (SQLPackage.name == subquery.c.name)
+                    & (SQLPackage.sort_version == subquery.c.sort_version)
+                )
+                .order_by(SQLPackage.filename.desc())
+                .all()
+            )
 
-        # Extract only the most recent version for each package
+        # Dedupe because a version may have several files
         latest_map = {}
-        for package in results.all():
-            if package.name not in latest_map or package > latest_map[package.name]:
-                latest_map[package.name] = package
+        for package in self._read(query):
+            latest_map.setdefault(package.name, package)
 
         return latest_map.values()
 
     def summary(self):
+        rows = self._read(
+            lambda db: db.query(
+                SQLPackageSummary.name,
+                SQLPackageSummary.last_modified,
+                SQLPackageSummary.summary,
+            )
+            .order_by(SQLPackageSummary.name)
+            .all()
+        )
+        return [
+            {"name": row[0], "last_modified": row[1], "summary": row[2]} for row in rows
+        ]
+
+    def _rebuild_summaries(self):
+        """ Fill the summaries table from the packages table """
+        LOG.info("Building package summaries from the cached packages")
+        self.db.query(SQLPackageSummary).delete(synchronize_session=False)
+        # Dedupe because two packages may share the same last_modified
+        seen_packages = set()
+        rows = []
+        for name, last_modified, summary in self._summary_rows(self.db):
+            if name in seen_packages:
+                continue
+            seen_packages.add(name)
+            rows.append(
+                {"name": name, "last_modified": last_modified, "summary": summary}
+            )
+        for batch in chunked(rows, self.reload_batch_size):
+            self._execute(SQLPackageSummary.__table__.insert(), batch)
+
+    @staticmethod
+    def _summary_rows(db):
+        """ Query the latest name, last_modified, and summary of each package """
         subquery = (
-            self.db.query(
+            db.query(
                 SQLPackage.name,
                 func.max(SQLPackage.last_modified).label("last_modified"),
             )
             .group_by(SQLPackage.name)
             .subquery()
         )
-        rows = self.db.query(
-            SQLPackage.name, SQLPackage.last_modified, SQLPackage.summary
-        ).filter(
-            (SQLPackage.name == subquery.c.name)
-            & (SQLPackage.last_modified == subquery.c.last_modified)
-        )
-
-        # Dedupe because two packages may share the same last_modified
-        seen_packages = set()
-        packages = []
-        for row in rows:
-            if row[0] in seen_packages:
-                continue
-            seen_packages.add(row[0])
-            packages.append(
-                {"name": row[0], "last_modified": row[1], "summary": row[2]}
+        return (
+            db.query(SQLPackage.name, SQLPackage.last_modified, SQLPackage.summary)
+            .filter(
+                (SQLPackage.name == subquery.c.name)
+                & (SQLPackage.last_modified == subquery.c.last_modified)
             )
-        return packages
+            .all()
+        )
 
     def clear(self, package):
+        self._mark_write()
+        if object_session(package) not in (None, self.db):
+            # The package was read from a replica
+            package = self.db.merge(package)
         self.db.delete(package)
+        self._refresh_summary(package.name)
+
+    def _refresh_summary(self, name):
+        """ Recompute the summary of a package after files are removed """
+        latest = (
+            self.db.query(SQLPackage.last_modified, SQLPackage.summary)
+            .filter_by(name=name)
+            .order_by(SQLPackage.last_modified.desc())
+            .first()
+        )
+        if latest is None:
+            self.db.query(SQLPackageSummary).filter_by(name=name).delete(
+                synchronize_session=False
+            )
+        else:
+            self.db.merge(
+                SQLPackageSummary(name=name, last_modified=latest[0], summary=latest[1])
+            )
 
     def clear_all(self):
+        self._mark_write()
         # Release any transactions before we go reloading schema
         if self.request is None:
             self.db.rollback()
@@ -265,52 +659,179 @@ class SQLCache(ICache):
         create_schema(engine)
 
     def save(self, package):
+        self._mark_write()
         self.db.merge(package)
+        # Write the package now, in order with the statements below
+        self.db.flush()
+        self._upsert_summary(package)
+
+    def _upsert_summary(self, package):
+        """
+        Insert or update the summary of a package with a single statement
+
+        The summary is only replaced if the package is at least as new, and
+        the comparison happens in the database so that concurrent uploads of
+        the same package can't conflict or overwrite a newer summary.
+
+        """
+        table = SQLPackageSummary.__table__
+        row = {
+            "name": package.name,
+            "summary": package.summary,
+            "last_modified": package.last_modified,
+        }
+        newer = table.c.last_modified <= package.last_modified
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "postgresql":
+            stmt = postgresql.insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.name],
+                set_={
+                    "summary": stmt.excluded.summary,
+                    "last_modified": stmt.excluded.last_modified,
+                },
+                where=newer,
+            )
+            self._execute(stmt, row)
+        elif dialect == "mysql":
+            stmt = mysql.insert(table)
+            # SQLAlchemy can't render other VALUES() columns inside of an
+            # assignment, so write them out.
+            inserted_last_modified = literal_column("VALUES(last_modified)")
+            newer = inserted_last_modified >= table.c.last_modified
+            # MySQL applies the assignments in order, so the summary has to be
+            # compared before last_modified changes.
+            stmt = stmt.on_duplicate_key_update(
+                [
+                    (
+                        "summary",
+                        func.IF(
+                            newer, literal_column("VALUES(summary)"), table.c.summary
+                        ),
+                    ),
+                    (
+                        "last_modified",
+                        func.IF(newer, inserted_last_modified, table.c.last_modified),
+                    ),
+                ]
+            )
+            self._execute(stmt, row)
+        else:
+            if dialect == "sqlite":
+                self._execute(table.insert().prefix_with("OR IGNORE"), row)
+            update = (
+                table.update()
+                .where(and_(table.c.name == package.name, newer))
+                .values(summary=package.summary, last_modified=package.last_modified)
+            )
+            result = self.db.execute(update)
+            if self.request is not None:
+                zope.sqlalchemy.mark_changed(self.db)
+            if dialect != "sqlite" and result.rowcount == 0:
+                exists = self.db.execute(
+                    select([table.c.name]).where(table.c.name == package.name)
+                ).first()
+                if exists is None:
+                    self._execute(table.insert(), row)
 
     def reload_from_storage(self, clear=True):
+        self._mark_write()
         if not self.graceful_reload:
-            return super(SQLCache, self).reload_from_storage(clear)
-
-        LOG.info("Rebuilding cache from storage")
-        # Log start time
-        start = datetime.utcnow()
-        # Fetch packages from storage s1
-        s1 = set(self.storage.list(self.package_class))
-        # Fetch cache packages c1
-        c1 = set(self.db.query(SQLPackage).all())
-        # Add missing packages to cache (s1 - c1)
-        missing = s1 - c1
-        if missing:
-            LOG.info("Adding %d missing packages to cache", len(missing))
-            for pkg in missing:
-                self.db.merge(pkg)
-        # Delete extra packages from cache (c1 - s1) when last_modified < start
-        # The time filter helps us avoid deleting packages that were
-        # concurrently uploaded.
-        extra1 = [p for p in (c1 - s1) if p.last_modified <= start]
-        if extra1:
-            LOG.info("Removing %d extra packages from cache", len(extra1))
-            for pkg in extra1:
-                self.db.query(SQLPackage).filter(
-                    SQLPackage.filename == pkg.filename
-                ).delete(synchronize_session=False)
-
-        # If any packages were concurrently deleted during the cache rebuild,
-        # we can detect them by polling storage again and looking for any
-        # packages that were present in s1 and are missing from s2
-        s2 = set(self.storage.list(self.package_class))
-        # Delete extra packages from cache (s1 - s2)
-        extra2 = s1 - s2
-        if extra2:
-            LOG.info(
-                "Removing %d packages from cache that were concurrently "
-                "deleted during rebuild",
-                len(extra2),
+            if clear:
+                self.clear_all()
+            elif self._reload_incremental():
+                return
+            start = datetime.utcnow()
+            packages = self.storage.list(self.package_class)
+            for batch in chunked(packages, self.reload_batch_size):
+                self._upsert_packages(batch)
+                self._commit()
+            self._rebuild_summaries()
+            if self.incremental_reload:
+                self.set_watermark(start)
+            self._invalidate_indexes()
+            return
+
+        if not self._reload_incremental():
+            self._reload_graceful()
+
+    def _commit(self):
+        """ Commit the current transaction and start a new one """
+        if self.request is None:
+            self.db.commit()
+        else:
+            self.request.tm.commit()
+            self.request.tm.begin()
+
+    def _upsert_packages(self, packages):
+        """
+        Insert or replace a batch of packages with a single statement
+
+        This bypasses the ORM and does not update the package summaries.
+
+        """
+        rows = [
+            {
+                "filename": package.filename,
+                "name": package.name,
+                "version": package.version,
+                "last_modified": package.last_modified,
+                "summary": package.summary,
+                "data": package.data,
+                "sort_version": make_sort_version(package.version),
+            }
+            for package in packages
+        ]
+        if not rows:
+            return
+        table = SQLPackage.__table__
+        dialect = self.db.get_bind().dialect.name
+        if dialect == "postgresql":
+            stmt = postgresql.insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.filename],
+                set_=dict((k, stmt.excluded[k]) for k in rows[0] if k != "filename"),
+            )
+        elif dialect == "mysql":
+            stmt = mysql.insert(table)
+            stmt = stmt.on_duplicate_key_update(
+                **dict((k, stmt.inserted[k]) for k in rows[0] if k != "filename")
             )
-            for pkg in extra2:
-                self.db.query(SQLPackage).filter(
-                    SQLPackage.filename == pkg.filename
-                ).delete(synchronize_session=False)
+        elif dialect == "sqlite":
+            stmt = table.insert().prefix_with("OR REPLACE")
+        else:
+            filenames = [row["filename"] for row in rows]
+            self._execute(table.delete().where(table.c.filename.in_(filenames)))
+            stmt = table.insert()
+        self._execute(stmt, rows)
+
+    def _execute(self, stmt, params=None):
+        """ Execute a Core statement that writes to the database """
+        self.db.execute(stmt, params)
+        if self.request is not None:
+            # The transaction manager doesn't see writes made outside the ORM
+            zope.sqlalchemy.mark_changed(self.db)
+
+    def _fetch_batch(self, filenames):
+        pkgs = self.db.query(SQLPackage).filter(SQLPackage.filename.in_(filenames))
+        return dict((pkg.filename, pkg) for pkg in pkgs)
+
+    def _save_batch(self, packages):
+        self._upsert_packages(packages)
+        for name in set(pkg.name for pkg in packages):
+            self._refresh_summary(name)
+
+    def _clear_batch(self, packages):
+        filenames = [pkg.filename for pkg in packages]
+        self.db.query(SQLPackage).filter(SQLPackage.filename.in_(filenames)).delete(
+            synchronize_session=False
+        )
+        for name in set(pkg.name for pkg in packages):
+            self._refresh_summary(name)
+
+    def _iter_cached(self, batch_size):
+        pkgs = self.db.query(SQLPackage).order_by(SQLPackage.filename)
+        return chunked(pkgs.yield_per(batch_size), batch_size)
 
     def check_health(self):
         try:
@@ -1,5 +1,6 @@
 """ Base class for storage backends """
 from pypicloud.models import Package
+from pypicloud.util import to_timestamp
 
 
 class IStorage(object):
@@ -18,6 +19,37 @@ class IStorage(object):
         """ Return a list or generator of all packages """
         raise NotImplementedError
 
+    def list_changes(self, factory=Package, since=None):
+        """
+        List the packages that were modified after a point in time
+
+        Backends that can list their files without fetching the metadata
+        should override this so that only the changed packages are fetched.
+
+        Parameters
+        ----------
+        factory : type
+            Class used to construct the packages
+        since : :class:`~datetime.datetime`
+            Naive UTC datetime. Packages modified at or after this will be
+            returned.
+
+        Returns
+        -------
+        filenames : set
+            The filenames of all packages in storage
+        packages : list
+            The :class:`~pypicloud.models.Package` s modified since ``since``
+
+        """
+        filenames = set()
+        packages = []
+        for package in self.list(factory):
+            filenames.add(package.filename)
+            if to_timestamp(package.last_modified) >= to_timestamp(since):
+                packages.append(package)
+        return filenames, packages
+
     def get_url(self, package):
         """
         Create or return an HTTP url for a package file
@@ -34,6 +66,18 @@ class IStorage(object):
         """
         return self.request.app_url("api", "package", package.name, package.filename)
 
+    def get_url_expiration(self):
+        """
+        Get the number of seconds that urls from :meth:`.get_url` are valid
+
+        Returns
+        -------
+        seconds : int or None
+            None if the urls never expire
+
+        """
+        return None
+
     def download_response(self, package):
         """
         Return a HTTP Response that will download this package
@@ -1,14 +1,256 @@
 """ Store packages as files on disk """
+import errno
 import json
+import logging
+import posixpath
+import six
 from datetime import datetime
-from contextlib import closing
+from contextlib import closing, contextmanager
 from binascii import hexlify
+from multiprocessing.pool import ThreadPool
 
-from pyramid.response import FileResponse
+from pyramid.response import FileResponse, Response
+from pyramid.settings import asbool
+from six.moves import map  # pylint: disable=W0622
+from six.moves.urllib.parse import quote  # pylint: disable=F0401,E0611
 
 import os
 from .base import IStorage
 from pypicloud.models import Package
+from pypicloud.util import to_timestamp
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+LOG = logging.getLogger(__name__)
+# Name of the file in the storage directory that indexes all packages
+INDEX_NAME = ".pypicloud-index.jsonl"
+# Header line of a complete index
+INDEX_HEADER = {"pypicloud_index": 1}
+# Values of 'storage.sendfile' and the headers they send
+SENDFILE_HEADERS = {"x-sendfile": "X-Sendfile", "x-accel-redirect": "X-Accel-Redirect"}
+
+
+def _read_metadata(metafile):
+    """ Read a package metadata file, or return {} if it is missing or bad """
+    try:
+        with open(metafile, "r") as mfile:
+            return json.load(mfile)
+    except (IOError, OSError, ValueError):
+        # If JSON fails to decode, don't sweat it.
+        return {}
+
+
+class FileIndex(object):
+
+    """
+    Append-only log of the package files in a :class:`.FileStorage`
+
+    The first line is a header, and every other line records a file that was
+    uploaded or deleted. Uploads and deletes only append to the log if it
+    already exists, and listing the packages builds it from the directory
+    if it is missing. The log is compacted when most of its records are
+    obsolete.
+
+    Parameters
+    ----------
+    path : str
+        The path of the log file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _locked(self, create=False):
+        """
+        Open the log for appending and hold an exclusive lock on it
+
+        Yields the file descriptor, or None if the log does not exist and
+        ``create`` is False.
+
+        """
+        flags = os.O_WRONLY | os.O_APPEND
+        if create:
+            flags |= os.O_CREAT
+        while True:
+            try:
+                fd = os.open(self.path, flags, 0o644)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                yield None
+                return
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # If the log was replaced while we waited for the lock, lock the
+                # new one instead.
+                replaced = os.fstat(fd).st_ino != os.stat(self.path).st_ino
+            except OSError:
+                replaced = True
+            if not replaced:
+                break
+            os.close(fd)
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _append(self, record):
+        """ Append a record to the log if it exists """
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._locked() as fd:
+            if fd is not None:
+                os.write(fd, line)
+
+    def add(self, key, last_modified, metadata):
+        """
+        Record a package file that was uploaded
+
+        Parameters
+        ----------
+        key : str
+            The path of the file, relative to the storage directory
+        last_modified : float
+            The mtime of the file
+        metadata : dict
+            The contents of the metadata file
+
+        """
+        self._append({"key": key, "last_modified": last_modified, "metadata": metadata})
+
+    def remove(self, key):
+        """ Record a package file that was deleted """
+        self._append({"key": key, "deleted": True})
+
+    def _read_records(self):
+        """
+        Read the records in the log
+
+        Returns
+        -------
+        complete : bool
+            False if the log does not exist or is still being built
+        records : list
+            The records after the header, in order
+
+        """
+        records = []
+        try:
+            ifile = open(self.path, "r")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False, records
+        complete = False
+        with ifile:
+            for line in ifile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # An incomplete line from a write that failed
+                    continue
+                if record == INDEX_HEADER:
+                    complete = True
+                else:
+                    records.append(record)
+        return complete, records
+
+    @staticmethod
+    def _apply(files, records):
+        """ Apply records to a mapping of key to (last_modified, metadata) """
+        for record in records:
+            if record.get("deleted"):
+                files.pop(record["key"], None)
+            else:
+                files[record["key"]] = (record["last_modified"], record["metadata"])
+
+    def _rewrite(self, files):
+        """ Replace the log with a complete one. Must hold the lock. """
+        uid = hexlify(os.urandom(4)).decode("utf-8")
+        tempfile = self.path + "." + uid
+        with open(tempfile, "w") as ofile:
+            ofile.write(json.dumps(INDEX_HEADER) + "\n")
+            for key in sorted(files):
+                last_modified, metadata = files[key]
+                record = {
+                    "key": key,
+                    "last_modified": last_modified,
+                    "metadata": metadata,
+                }
+                ofile.write(json.dumps(record) + "\n")
+        os.rename(tempfile, self.path)
+
+    def read(self):
+        """
+        Get all package files in the index
+
+        Returns
+        -------
+        files : dict
+            Mapping of key to (last_modified, metadata), or None if the index
+            has not been built
+
+        """
+        complete, records = self._read_records()
+        if not complete:
+            return None
+        files = {}
+        self._apply(files, records)
+        if len(records) > 2 * len(files) + 1000:
+            LOG.info("Compacting the package index %s", self.path)
+            with self._locked() as fd:
+                if fd is not None:
+                    # Include anything appended since we read it
+                    complete, records = self._read_records()
+                    files = {}
+                    self._apply(files, records)
+                    if complete:
+                        self._rewrite(files)
+        return files
+
+    def build(self, scan):
+        """
+        Build the index from the package files in the directory
+
+        Parameters
+        ----------
+        scan : iterable
+            Generates (key, last_modified, metadata) for every package file
+
+        Returns
+        -------
+        files : dict
+            Mapping of key to (last_modified, metadata)
+
+        """
+        LOG.info("Building the package index %s", self.path)
+        # Create the log first, so that uploads and deletes during the scan are
+        # recorded and can be applied on top of it.
+        with self._locked(create=True):
+            pass
+        files = {}
+        for key, last_modified, metadata in scan:
+            files[key] = (last_modified, metadata)
+        with self._locked(create=True):
+            complete, records = self._read_records()
+            if complete:
+                # Someone else finished building it first
+                files = {}
+            self._apply(files, records)
+            if not complete:
+                self._rewrite(files)
+        return files
 
 
 class FileStorage(IStorage):
@@ -17,6 +259,10 @@ class FileStorage(IStorage):
 
     def __init__(self, request=None, **kwargs):
         self.directory = kwargs.pop("directory")
+        self.list_workers = kwargs.pop("list_workers", 1)
+        self.index = kwargs.pop("index", None)
+        self.sendfile = kwargs.pop("sendfile", None)
+        self.sendfile_prefix = kwargs.pop("sendfile_prefix", None)
         super(FileStorage, self).__init__(request, **kwargs)
 
     @classmethod
@@ -26,6 +272,26 @@ class FileStorage(IStorage):
         if not os.path.exists(directory):
             os.makedirs(directory)
         kwargs["directory"] = directory
+        kwargs["list_workers"] = int(settings.get("storage.list_workers", 1))
+        if asbool(settings.get("storage.index", False)):
+            kwargs["index"] = FileIndex(os.path.join(directory, INDEX_NAME))
+        sendfile = settings.get("storage.sendfile")
+        if sendfile:
+            sendfile = sendfile.lower()
+            if sendfile not in SENDFILE_HEADERS:
+                raise ValueError(
+                    "storage.sendfile must be one of %s"
+                    % ", ".join(sorted(SENDFILE_HEADERS))
+                )
+            kwargs["sendfile"] = sendfile
+            if sendfile == "x-accel-redirect":
+                prefix = settings.get("storage.sendfile_prefix")
+                if not prefix:
+                    raise ValueError(
+                        "You must specify the 'storage.sendfile_prefix' to use "
+                        "X-Accel-Redirect"
+                    )
+                kwargs["sendfile_prefix"] = prefix.rstrip("/")
         return kwargs
 
     def get_path(self, package):
@@ -43,28 +309,108 @@ class FileStorage(IStorage):
         return self.path_to_meta_path(self.get_path(package))
 
     def list(self, factory=Package):
-        for root, _, files in os.walk(self.directory):
-            for filename in files:
-                if filename.endswith(".meta"):
-                    # We don't want to yield for this file
-                    continue
+        for name, version, filename, mtime, metadata in self._list_files():
+            last_modified = datetime.fromtimestamp(mtime)
+            yield factory(name, version, filename, last_modified, **metadata)
 
-                shortpath = root[len(self.directory) :].strip("/")
-                name, version = shortpath.split("/")
-                fullpath = os.path.join(root, filename)
-                last_modified = datetime.fromtimestamp(os.path.getmtime(fullpath))
-                metadata = {}
-                metafile = self.path_to_meta_path(fullpath)
-                if os.path.exists(metafile):
-                    with open(metafile, "r") as mfile:
-                        try:
-                            metadata = json.load(mfile)
-                        except ValueError:
-                            # If JSON fails to decode, don't sweat it.
-                            pass
-                yield factory(name, version, filename, last_modified, **metadata)
+    def list_changes(self, factory=Package, since=None):
+        cutoff = to_timestamp(since)
+        filenames = set()
+        packages = []
+        for name, version, filename, mtime, metadata in self._list_files(cutoff):
+            filenames.add(filename)
+            if mtime < cutoff:
+                continue
+            last_modified = datetime.fromtimestamp(mtime)
+            packages.append(factory(name, version, filename, last_modified, **metadata))
+        return filenames, packages
+
+    def _list_files(self, cutoff=None):
+        """
+        Generate (name, version, filename, mtime, metadata) for all package files
+
+        Parameters
+        ----------
+        cutoff : float, optional
+            If provided, don't read the metadata of files older than this. Their
+            metadata will be None.
+
+        """
+        if self.index is None:
+            for result in self._scan(cutoff):
+                yield result
+            return
+        files = self.index.read()
+        if files is None:
+            files = self.index.build(
+                (posixpath.join(name, version, filename), mtime, metadata,)
+                for name, version, filename, mtime, metadata in self._scan()
+            )
+        for key, (mtime, metadata) in six.iteritems(files):
+            name, version, filename = key.split("/")
+            yield name, version, filename, mtime, metadata
+
+    def _scan(self, cutoff=None):
+        """
+        Generate (name, version, filename, mtime, metadata) by scanning the
+        directory
+
+        Each package directory is scanned by one of ``list_workers`` threads.
+
+        """
+        pool = None
+        if self.list_workers > 1:
+            pool = ThreadPool(self.list_workers)
+            imap = pool.imap_unordered
+        else:
+            imap = map
+        try:
+            names = [entry.name for entry in scandir(self.directory) if entry.is_dir()]
+            for files in imap(lambda name: self._scan_package(name, cutoff), names):
+                for result in files:
+                    yield result
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _scan_package(self, name, cutoff):
+        """ Get the results of :meth:`._scan` for one package directory """
+        results = []
+        for version_entry in scandir(os.path.join(self.directory, name)):
+            if not version_entry.is_dir():
+                continue
+            entries = list(scandir(version_entry.path))
+            names = set(entry.name for entry in entries)
+            for entry in entries:
+                # Skip metadata and the temporary files of uploads
+                if entry.name.endswith(".meta") or entry.name.startswith("."):
+                    continue
+                if not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime
+                metadata = None
+                if cutoff is None or mtime >= cutoff:
+                    metadata = {}
+                    if self.path_to_meta_path(entry.name) in names:
+                        metadata = _read_metadata(self.path_to_meta_path(entry.path))
+                results.append((name, version_entry.name, entry.name, mtime, metadata))
+        return results
 
     def download_response(self, package):
+        if self.sendfile is not None:
+            # Let the web server send the file
+            response = Response(content_type="application/octet-stream")
+            if self.sendfile == "x-accel-redirect":
+                location = "%s/%s/%s/%s" % (
+                    self.sendfile_prefix,
+                    quote(package.name),
+                    quote(package.version),
+                    quote(package.filename),
+                )
+            else:
+                location = self.get_path(package)
+            response.headers[SENDFILE_HEADERS[self.sendfile]] = location
+            return response
         return FileResponse(
             self.get_path(package),
             request=self.request,
@@ -96,6 +442,13 @@ class FileStorage(IStorage):
 
         os.rename(tempfile, destfile)
 
+        if self.index is not None:
+            self.index.add(
+                posixpath.join(package.name, package.version, package.filename),
+                os.path.getmtime(destfile),
+                metadata,
+            )
+
     def delete(self, package):
         filename = self.get_path(package)
         meta_file = self.get_metadata_path(package)
@@ -105,6 +458,10 @@ class FileStorage(IStorage):
         except OSError:
             # Metadata file may not exist
             pass
+        if self.index is not None:
+            self.index.remove(
+                posixpath.join(package.name, package.version, package.filename)
+            )
         version_dir = os.path.dirname(filename)
         try:
             os.rmdir(version_dir)
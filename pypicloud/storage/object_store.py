@@ -122,6 +122,11 @@ class ObjectStoreStorage(IStorage):
         else:
             return self._generate_url(package)
 
+    def get_url_expiration(self):
+        if self.redirect_urls or self.public_url:
+            return None
+        return self.expire_after
+
     def download_response(self, package):
         return HTTPFound(location=self._generate_url(package))
 
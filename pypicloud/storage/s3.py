@@ -1,4 +1,5 @@
 """ Store packages in S3 """
+import json
 import posixpath
 
 import boto3
@@ -13,16 +14,29 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 
 from datetime import datetime, timedelta
+from gzip import GzipFile
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from pyramid.settings import asbool, falsey
 from pyramid_duh.settings import asdict
+from six import BytesIO
+from six.moves import map  # pylint: disable=W0622
 from six.moves.urllib.parse import urlparse, quote  # pylint: disable=F0401,E0611
 
 from .object_store import ObjectStoreStorage
 from pypicloud.models import Package
-from pypicloud.util import parse_filename, get_settings
+from pypicloud.util import parse_filename, get_settings, to_timestamp
 
 
 LOG = logging.getLogger(__name__)
+# Keys that split the bucket listing into ranges that can be fetched in
+# parallel. The 'storage.prepend_hash' prefixes are hex, so these spread the
+# packages evenly over the ranges.
+SHARD_BOUNDARIES = "123456789abcdef"
+# botocore's default for max_pool_connections
+DEFAULT_POOL_CONNECTIONS = 10
+# Name of the object under the prefix that caches the metadata of all packages
+MANIFEST_NAME = ".pypicloud-manifest.jsonl.gz"
 
 
 class S3Storage(ObjectStoreStorage):
@@ -31,6 +45,11 @@ class S3Storage(ObjectStoreStorage):
 
     test = False
 
+    def __init__(self, request=None, list_workers=1, manifest=False, **kwargs):
+        super(S3Storage, self).__init__(request, **kwargs)
+        self.list_workers = list_workers
+        self.manifest = manifest
+
     @classmethod
     def _subclass_specific_config(cls, settings, common_config):
         sse = settings.get("storage.server_side_encryption")
@@ -42,7 +61,14 @@ class S3Storage(ObjectStoreStorage):
                 sse,
             )
 
-        return {"sse": sse}
+        list_workers = int(
+            settings.get("storage.max_pool_connections", DEFAULT_POOL_CONNECTIONS)
+        )
+        return {
+            "sse": sse,
+            "list_workers": list_workers,
+            "manifest": asbool(settings.get("storage.manifest", False)),
+        }
 
     @classmethod
     def get_bucket(cls, bucket_name, settings):
@@ -114,31 +140,218 @@ class S3Storage(ObjectStoreStorage):
     @classmethod
     def package_from_object(cls, obj, factory):
         """ Create a package from a S3 object """
-        filename = posixpath.basename(obj.key)
-        name = obj.metadata.get("name")
-        version = obj.metadata.get("version")
-        summary = obj.metadata.get("summary")
+        return cls._package_from_metadata(
+            obj.key, obj.metadata, obj.last_modified, factory
+        )
+
+    @classmethod
+    def _package_from_metadata(cls, key, metadata, last_modified, factory):
+        """ Create a package from the key and metadata of a S3 object """
+        filename = posixpath.basename(key)
+        name = metadata.get("name")
+        version = metadata.get("version")
+        summary = metadata.get("summary")
         # We used to not store metadata. This is for backwards
         # compatibility
         if name is None or version is None:
             try:
                 name, version = parse_filename(filename)
             except ValueError:
-                LOG.warning("S3 file %s has no package name", obj.key)
+                LOG.warning("S3 file %s has no package name", key)
                 return None
 
-        return factory(
-            name, version, filename, obj.last_modified, summary, path=obj.key
-        )
+        return factory(name, version, filename, last_modified, summary, path=key)
 
     def list(self, factory=Package):
-        keys = self.bucket.objects.filter(Prefix=self.bucket_prefix)
-        for summary in keys:
-            # ObjectSummary has no metadata, so we have to fetch it.
-            obj = summary.Object()
-            pkg = self.package_from_object(obj, factory)
-            if pkg is not None:
-                yield pkg
+        # Everything here only uses the S3 client, because boto3 resources are
+        # not thread-safe.
+        pool = None
+        if self.list_workers > 1:
+            # List ranges of keys in parallel, and HEAD each key to fetch the
+            # metadata as soon as its range has been listed.
+            pool = ThreadPool(self.list_workers)
+            imap = pool.imap_unordered
+            shards = self._shards()
+        else:
+            imap = map
+            shards = [(None, None)]
+        try:
+            keys = chain.from_iterable(imap(self._list_shard, shards))
+            if self.manifest:
+                results = self._reconcile_manifest(keys, imap)
+            else:
+                results = imap(self._fetch_metadata, keys)
+            for result in results:
+                if result is None:
+                    continue
+                pkg = self._package_from_metadata(*result, factory=factory)
+                if pkg is not None:
+                    yield pkg
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def list_changes(self, factory=Package, since=None):
+        # The key listing has the last_modified of every object, so we only
+        # need to HEAD the objects that changed.
+        cutoff = to_timestamp(since)
+        pool = None
+        if self.list_workers > 1:
+            pool = ThreadPool(self.list_workers)
+            imap = pool.imap_unordered
+            shards = self._shards()
+        else:
+            imap = map
+            shards = [(None, None)]
+        try:
+            filenames = set()
+            changed = []
+            for key, last_modified in chain.from_iterable(
+                imap(self._list_shard, shards)
+            ):
+                filenames.add(posixpath.basename(key))
+                if to_timestamp(last_modified) >= cutoff:
+                    changed.append((key, last_modified))
+            packages = []
+            for result in imap(self._fetch_metadata, changed):
+                if result is None:
+                    continue
+                pkg = self._package_from_metadata(*result, factory=factory)
+                if pkg is not None:
+                    packages.append(pkg)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return filenames, packages
+
+    def _reconcile_manifest(self, keys, imap):
+        """
+        Use the manifest for the metadata of objects that have not changed
+
+        The manifest is rewritten once all of the results have been consumed,
+        if any objects were added or removed.
+
+        Returns
+        -------
+        results : generator
+            Generator of (key, metadata, last_modified) for every object
+
+        """
+        manifest = self._read_manifest()
+        known = []
+        missing = []
+        for key, last_modified in keys:
+            entry = manifest.get(key)
+            if entry is not None and entry["last_modified"] == to_timestamp(
+                last_modified
+            ):
+                known.append((key, entry["metadata"], last_modified))
+            else:
+                missing.append((key, last_modified))
+
+        def results():
+            """ Yield the known objects, then fetch the rest """
+            for result in known:
+                yield result
+            fetched = []
+            for result in imap(self._fetch_metadata, missing):
+                if result is not None:
+                    fetched.append(result)
+                    yield result
+            if fetched or len(known) != len(manifest):
+                self._write_manifest(known + fetched)
+
+        return results()
+
+    def _read_manifest(self):
+        """ Load the manifest as a dict of key to manifest entry """
+        try:
+            response = self.bucket.meta.client.get_object(
+                Bucket=self.bucket.name, Key=self.manifest_key
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return {}
+            raise
+        data = GzipFile(fileobj=BytesIO(response["Body"].read())).read()
+        manifest = {}
+        for line in data.decode("utf-8").splitlines():
+            entry = json.loads(line)
+            manifest[entry["key"]] = entry
+        return manifest
+
+    def _write_manifest(self, results):
+        """ Replace the manifest with a list of (key, metadata, last_modified) """
+        data = BytesIO()
+        with GzipFile(fileobj=data, mode="wb") as ofile:
+            for key, metadata, last_modified in sorted(results):
+                entry = {
+                    "key": key,
+                    "metadata": metadata,
+                    "last_modified": to_timestamp(last_modified),
+                }
+                ofile.write((json.dumps(entry) + "\n").encode("utf-8"))
+        kwargs = {}
+        if self.sse is not None:
+            kwargs["ServerSideEncryption"] = self.sse
+        self.bucket.meta.client.put_object(
+            Bucket=self.bucket.name,
+            Key=self.manifest_key,
+            Body=data.getvalue(),
+            ContentType="application/gzip",
+            **kwargs
+        )
+
+    @property
+    def manifest_key(self):
+        """ The key of the manifest object """
+        return self.bucket_prefix + MANIFEST_NAME
+
+    def _shards(self):
+        """
+        Split the keys under the bucket prefix into ranges
+
+        Returns
+        -------
+        shards : list
+            List of (start, end) tuples. Each range contains the keys that are
+            after ``start`` and before or equal to ``end``. None means
+            unbounded.
+
+        """
+        bounds = [self.bucket_prefix + c for c in SHARD_BOUNDARIES]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _list_shard(self, shard):
+        """ List the (key, last_modified) of all objects in a range """
+        start, end = shard
+        kwargs = {"Bucket": self.bucket.name, "Prefix": self.bucket_prefix}
+        if start is not None:
+            kwargs["StartAfter"] = start
+        keys = []
+        paginator = self.bucket.meta.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get("Contents", []):
+                if end is not None and obj["Key"] > end:
+                    return keys
+                if obj["Key"] == self.manifest_key:
+                    continue
+                keys.append((obj["Key"], obj["LastModified"]))
+        return keys
+
+    def _fetch_metadata(self, item):
+        """ HEAD an object to get its metadata """
+        key, last_modified = item
+        try:
+            response = self.bucket.meta.client.head_object(
+                Bucket=self.bucket.name, Key=key
+            )
+        except ClientError as e:
+            # The object was deleted after we listed it
+            if e.response["Error"]["Code"] == "404":
+                return None
+            raise
+        return key, response.get("Metadata", {}), last_modified
 
     def _generate_url(self, package):
         """ Generate a signed url to the S3 file """
@@ -244,6 +457,11 @@ class CloudFrontS3Storage(S3Storage):
 
         return kwargs
 
+    def get_url_expiration(self):
+        if self.redirect_urls or self.cf_signer is None:
+            return None
+        return self.expire_after
+
     def _rsa_signer(self, message):
         """ Generate a RSA signature for a message """
         return self.crypto_pk.sign(message, padding.PKCS1v15(), hashes.SHA1())
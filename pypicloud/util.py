@@ -1,6 +1,8 @@
 """ Utilities """
+import calendar
 import posixpath
 import re
+import threading
 import time
 
 import distlib.locators
@@ -46,6 +48,104 @@ def normalize_name(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
+# Lifted from the packaging library (PEP 440)
+VERSION_RE = re.compile(
+    r"""
+    ^\s*v?
+    (?:(?P<epoch>[0-9]+)!)?
+    (?P<release>[0-9]+(?:\.[0-9]+)*)
+    (?P<pre>[-_\.]?(?P<pre_l>a|b|c|rc|alpha|beta|pre|preview)[-_\.]?(?P<pre_n>[0-9]+)?)?
+    (?P<post>(?:-(?P<post_n1>[0-9]+))|(?:[-_\.]?(?P<post_l>post|rev|r)[-_\.]?(?P<post_n2>[0-9]+)?))?
+    (?P<dev>[-_\.]?(?P<dev_l>dev)[-_\.]?(?P<dev_n>[0-9]+)?)?
+    (?:\+(?P<local>[a-z0-9]+(?:[-_\.][a-z0-9]+)*))?
+    \s*$
+    """,
+    re.VERBOSE | re.IGNORECASE,
+)
+PRE_RELEASE_ORDER = {
+    "a": "a",
+    "alpha": "a",
+    "b": "b",
+    "beta": "b",
+    "c": "c",
+    "rc": "c",
+    "pre": "c",
+    "preview": "c",
+}
+
+
+def _sortable_int(number):
+    """ Encode an int so that the strings sort in numeric order """
+    digits = str(int(number))
+    return "%02d%s" % (len(digits), digits)
+
+
+def sortable_version(version):
+    """
+    Convert a version into a string that sorts in version order
+
+    Comparing the strings gives the same order as comparing the versions with
+    ``pkg_resources.parse_version``. Versions that are not PEP 440 compliant
+    sort before all other versions, in string order.
+
+    Parameters
+    ----------
+    version : str
+
+    Returns
+    -------
+    key : str
+        No key is a prefix of another key, so the keys can be followed by other
+        data without changing the sort order.
+
+    """
+    match = VERSION_RE.match(version)
+    if match is None:
+        legacy = re.sub(r"[^a-z0-9]+", ".", version.lower())
+        return "0" + legacy + "!"
+    key = ["1", _sortable_int(match.group("epoch") or 0)]
+
+    # Trailing zeros don't matter: 1.0 == 1.0.0
+    release = [int(n) for n in match.group("release").split(".")]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    key.extend(_sortable_int(n) for n in release)
+    key.append(".")
+
+    # Dev releases of a final release sort before its pre-releases
+    if match.group("pre"):
+        pre_l = PRE_RELEASE_ORDER[match.group("pre_l").lower()]
+        key.append("1" + pre_l + _sortable_int(match.group("pre_n") or 0))
+    elif match.group("dev") and not match.group("post"):
+        key.append("0")
+    else:
+        key.append("2")
+
+    if match.group("post"):
+        post_n = match.group("post_n1") or match.group("post_n2") or 0
+        key.append("1" + _sortable_int(post_n))
+    else:
+        key.append("0")
+
+    if match.group("dev"):
+        key.append("0" + _sortable_int(match.group("dev_n") or 0))
+    else:
+        key.append("1")
+
+    # Numeric local segments sort after alphanumeric ones
+    if match.group("local"):
+        key.append("1")
+        for part in re.split(r"[-_\.]", match.group("local").lower()):
+            if part.isdigit():
+                key.append("1" + _sortable_int(part))
+            else:
+                key.append("0" + part + "!")
+        key.append(".")
+    else:
+        key.append("0")
+    return "".join(key)
+
+
 class BetterScrapingLocator(SimpleScrapingLocator):
 
     """ Layer on top of SimpleScrapingLocator that allows preferring wheels """
@@ -107,6 +207,53 @@ def create_matcher(queries, query_type):
         return lambda x: all((q in x.lower() for q in queries))
 
 
+def invalidate_index_cache(request):
+    """
+    Drop all pre-rendered package indexes
+
+    This should be called whenever the set of packages, or the permissions on
+    them, changes. If the request has a transaction manager the indexes are
+    dropped again after the transaction commits, so that an index rendered by
+    a concurrent request from the old data does not stay cached.
+
+    Parameters
+    ----------
+    request : :class:`~pyramid.request.Request` or None
+
+    """
+    registry = getattr(request, "registry", None)
+    index_cache = getattr(registry, "index_cache", None)
+    if index_cache is None:
+        return
+    index_cache.clear()
+    tm = getattr(request, "tm", None)
+    if tm is not None:
+        tm.get().addAfterCommitHook(lambda succeeded: index_cache.clear())
+
+
+def to_timestamp(dt):
+    """ Convert a naive (UTC) or timezone-aware datetime to a unix timestamp """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items
+
+    Only one chunk is held in memory at a time, so this can be used to process
+    long generators in batches.
+
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_settings(settings, prefix, **kwargs):
     """
     Convenience method for fetching settings
@@ -147,42 +294,86 @@ class TimedCache(dict):
         attempt to populate itself by calling this function with the key it was
         accessed with. This function should return a value to cache, or None if
         no value is found.
+    max_size : int, optional
+        If provided, adding a new key when the cache is full will evict the
+        expired entries, and then the oldest entry if it is still full.
+
+    Notes
+    -----
+    Writes and evictions hold a lock, so a cache may be shared between
+    threads.
 
     """
 
-    def __init__(self, cache_time, factory=None):
+    def __init__(self, cache_time, factory=None, max_size=None):
         super(TimedCache, self).__init__()
         if cache_time is not None and cache_time < 0:
             raise ValueError("cache_time cannot be negative")
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be positive")
         self._cache_time = cache_time
         self._factory = factory
+        self._max_size = max_size
         self._times = {}
+        self._lock = threading.RLock()
 
     def _has_expired(self, key):
         """ Check if a key is both present and expired """
-        if key not in self._times or self._cache_time is None:
+        if self._cache_time is None:
             return False
-        updated = self._times[key]
+        # Another thread may remove the key at any time
+        updated = self._times.get(key)
         return updated is not None and time.time() - updated > self._cache_time
 
     def _evict(self, key):
         """ Remove a key if it has expired """
         if self._has_expired(key):
-            del self[key]
+            with self._lock:
+                if self._has_expired(key):
+                    del self[key]
 
     def __contains__(self, key):
         self._evict(key)
         return super(TimedCache, self).__contains__(key)
 
+    def _eviction_order(self, key):
+        """ Sort key for evicting entries, oldest first """
+        updated = self._times[key]
+        # Entries with no expiration are evicted last
+        return (updated is None, updated or 0)
+
+    def _make_room(self, key):
+        """
+        Evict entries if adding this key would go over the max size
+
+        Must hold the lock.
+
+        """
+        if self._max_size is None or key in self or len(self) < self._max_size:
+            return
+        for k in [k for k in self._times if self._has_expired(k)]:
+            del self[k]
+        if len(self) >= self._max_size:
+            oldest = min(self._times, key=self._eviction_order)
+            del self[oldest]
+
     def __delitem__(self, key):
-        del self._times[key]
-        super(TimedCache, self).__delitem__(key)
+        with self._lock:
+            del self._times[key]
+            super(TimedCache, self).__delitem__(key)
+
+    def clear(self):
+        with self._lock:
+            self._times.clear()
+            super(TimedCache, self).clear()
 
     def __setitem__(self, key, value):
         if self._cache_time == 0:
             return
-        self._times[key] = time.time()
-        super(TimedCache, self).__setitem__(key, value)
+        with self._lock:
+            self._make_room(key)
+            self._times[key] = time.time()
+            super(TimedCache, self).__setitem__(key, value)
 
     def __getitem__(self, key):
         self._evict(key)
@@ -235,5 +426,7 @@ class TimedCache(dict):
                 return
             expiration = time.time() + expiration - self._cache_time
 
-        self._times[key] = expiration
-        super(TimedCache, self).__setitem__(key, value)
+        with self._lock:
+            self._make_room(key)
+            self._times[key] = expiration
+            super(TimedCache, self).__setitem__(key, value)
@@ -32,21 +32,24 @@ LOG = logging.getLogger(__name__)
     context=APIPackagingResource, request_method="GET", subpath=(), renderer="json"
 )
 @addslash
-@argify
-def all_packages(request, verbose=False):
+@argify(limit=int)
+def all_packages(request, verbose=False, limit=None, token=None):
     """ List all packages """
+    if limit is not None:
+        if limit < 1:
+            return HTTPBadRequest("limit must be a positive integer")
+        packages, token = request.db.summary_page(limit, token)
+        readable = set(request.access.filter_readable([p["name"] for p in packages]))
+        packages = [p for p in packages if p["name"] in readable]
+        if not verbose:
+            packages = [p["name"] for p in packages]
+        return {"packages": packages, "token": token}
     if verbose:
         packages = request.db.summary()
+        readable = set(request.access.filter_readable([p["name"] for p in packages]))
+        packages = [p for p in packages if p["name"] in readable]
     else:
-        packages = request.db.distinct()
-    i = 0
-    while i < len(packages):
-        package = packages[i]
-        name = package if isinstance(package, six.string_types) else package["name"]
-        if not request.access.has_permission(name, "read"):
-            del packages[i]
-            continue
-        i += 1
+        packages = request.access.filter_readable(request.db.distinct())
     return {"packages": packages}
 
 
@@ -58,10 +61,18 @@ def all_packages(request, verbose=False):
     permission="read",
 )
 @addslash
-def package_versions(context, request):
+@argify(offset=int, limit=int)
+def package_versions(context, request, offset=0, limit=None):
     """ List all unique package versions """
     normalized_name = normalize_name(context.name)
-    versions = request.db.all(normalized_name)
+    if offset < 0:
+        return HTTPBadRequest("offset must not be negative")
+    if limit is not None and limit < 1:
+        return HTTPBadRequest("limit must be a positive integer")
+    if offset or limit is not None:
+        versions = request.db.paginate(normalized_name, offset, limit)
+    else:
+        versions = request.db.all(normalized_name)
     return {
         "packages": versions,
         "write": request.access.has_permission(normalized_name, "write"),
@@ -175,6 +186,28 @@ def change_password(request, old_password, new_password):
     return request.response
 
 
+@view_config(
+    context=APIResource,
+    name="user",
+    subpath=("token"),
+    request_method="POST",
+    renderer="json",
+    permission="login",
+)
+@argify(expire=int)
+def create_api_token(request, password, scope="read", expire=None):
+    """ Create a signed API token for the current user """
+    if not request.access.verify_user(request.userid, password):
+        return HTTPForbidden()
+    if request.access.signing_key is None:
+        return HTTPBadRequest("auth.signing_key is not set")
+    try:
+        token = request.access.get_api_token(request.userid, scope, expire)
+    except ValueError as e:
+        return HTTPBadRequest(str(e))
+    return {"token": token}
+
+
 @view_config(
     context=APIResource,
     name="fetch",
@@ -17,8 +17,8 @@ def list_packages(request):
     """ Render the list for all versions of all packages """
     names = request.db.distinct()
     # remove the ones that you are not allowed to see
-    names = filter(lambda x: request.access.has_permission(x, "read"), names)
+    names = request.access.filter_readable(names)
     packages = []
     for package_name in names:
-        packages += request.db.all(package_name)
+        packages += request.db.all_files(package_name)
     return {"pkgs": packages_to_dict(request, packages)}
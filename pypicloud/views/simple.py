@@ -1,16 +1,25 @@
 """ Views for simple pip interaction """
 import posixpath
+import time
+from hashlib import md5
 
 import pkg_resources
 import logging
 import six
-from pyramid.httpexceptions import HTTPBadRequest, HTTPFound, HTTPNotFound, HTTPConflict
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPFound,
+    HTTPNotFound,
+    HTTPNotModified,
+    HTTPConflict,
+)
+from pyramid.renderers import render
 from pyramid.view import view_config
 from pyramid_duh import argify, addslash
 from pyramid_rpc.xmlrpc import xmlrpc_method
 
 from pypicloud.route import Root, SimplePackageResource, SimpleResource
-from pypicloud.util import normalize_name, parse_filename
+from pypicloud.util import normalize_name, parse_filename, to_timestamp
 
 
 LOG = logging.getLogger(__name__)
@@ -52,11 +61,9 @@ def search(request, criteria, query_type):
     endpoint (configured as /pypi/) that specify the method "search".
 
     """
-    filtered = []
-    for pkg in request.db.search(criteria, query_type):
-        if request.access.has_permission(pkg.name, "read"):
-            filtered.append(pkg.search_summary())
-    return filtered
+    packages = list(request.db.search(criteria, query_type))
+    readable = set(request.access.filter_readable(set(pkg.name for pkg in packages)))
+    return [pkg.search_summary() for pkg in packages if pkg.name in readable]
 
 
 @view_config(
@@ -65,15 +72,30 @@ def search(request, criteria, query_type):
 @addslash
 def simple(request):
     """ Render the list of all unique package names """
-    names = request.db.distinct()
-    i = 0
-    while i < len(names):
-        name = names[i]
-        if not request.access.has_permission(name, "read"):
-            del names[i]
-            continue
-        i += 1
-    return {"pkgs": names}
+    index_cache = request.registry.index_cache
+    cached = None
+    if index_cache is not None:
+        # The set of visible packages only depends on the principals of the user
+        key = frozenset(request.effective_principals)
+        cached = index_cache.get(key)
+    if cached is None:
+        body = render("simple.jinja2", {"pkgs": _readable_names(request)}, request)
+        # The ETag is a hash of the body, so it can be checked without the cache
+        etag = md5(body.encode("utf-8")).hexdigest()
+        cached = (etag, body)
+        if index_cache is not None:
+            index_cache[key] = cached
+    etag, body = cached
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag)
+    request.response.etag = etag
+    request.response.text = body
+    return request.response
+
+
+def _readable_names(request):
+    """ Get all package names that the user has read permissions for """
+    return request.access.filter_readable(request.db.distinct())
 
 
 def _package_versions(context, request):
@@ -133,6 +155,44 @@ def package_versions_json(context, request):
     return response
 
 
+def _not_modified(request, normalized_name, stamp):
+    """
+    Set the ETag for a package page on the response
+
+    The page is only validated with the ETag. A Last-Modified date can't
+    tell that an older file was deleted, so it is never sent or honored.
+
+    Parameters
+    ----------
+    request : :class:`~pyramid.request.Request`
+    normalized_name : str
+    stamp : tuple or None
+        The result of :meth:`~pypicloud.cache.base.ICache.version_stamp`
+
+    Returns
+    -------
+    response : :class:`~pyramid.httpexceptions.HTTPNotModified` or None
+        A 304 response if the client already has the current page, otherwise
+        None
+
+    """
+    if stamp is None:
+        return None
+    last_modified, count = stamp
+    pieces = [normalized_name, to_timestamp(last_modified), count]
+    url_expiration = request.db.get_url_expiration()
+    if url_expiration is not None:
+        # The page contains signed urls, so it may only be reused until they
+        # are halfway to expiring.
+        pieces.append(int(time.time()) // max(url_expiration // 2, 1))
+    etag = md5(":".join((str(p) for p in pieces)).encode("utf-8")).hexdigest()
+
+    request.response.etag = etag
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag)
+    return None
+
+
 def get_fallback_packages(request, package_name, redirect=True):
     """ Get all package versions for a package from the fallback_base_url """
     dists = request.locator.get_project(package_name)
@@ -180,15 +240,20 @@ def _redirect(context, request):
 def _simple_redirect(context, request):
     """ Service /simple with fallback=redirect """
     normalized_name = normalize_name(context.name)
-    packages = request.db.all(normalized_name)
-    if packages:
-        if not request.access.has_permission(normalized_name, "read"):
-            if request.is_logged_in:
-                return _redirect(context, request)
-            else:
-                return request.request_login()
+    stamp = request.db.version_stamp(normalized_name)
+    if stamp is None:
+        return _redirect(context, request)
+    if not request.access.has_permission(normalized_name, "read"):
+        if request.is_logged_in:
+            return _redirect(context, request)
         else:
-            return _pkg_response(packages_to_dict(request, packages))
+            return request.request_login()
+    not_modified = _not_modified(request, normalized_name, stamp)
+    if not_modified is not None:
+        return not_modified
+    packages = request.db.all_files(normalized_name)
+    if packages:
+        return _pkg_response(packages_to_dict(request, packages))
     else:
         return _redirect(context, request)
 
@@ -196,7 +261,7 @@ def _simple_redirect(context, request):
 def _simple_redirect_always_show(context, request):
     """ Service /simple with fallback=redirect """
     normalized_name = normalize_name(context.name)
-    packages = request.db.all(normalized_name)
+    packages = request.db.all_files(normalized_name)
     if packages:
         if not request.access.has_permission(normalized_name, "read"):
             if request.is_logged_in:
@@ -224,7 +289,11 @@ def _simple_cache(context, request):
         else:
             return request.request_login()
 
-    packages = request.db.all(normalized_name)
+    stamp = request.db.version_stamp(normalized_name)
+    not_modified = _not_modified(request, normalized_name, stamp)
+    if not_modified is not None:
+        return not_modified
+    packages = request.db.all_files(normalized_name)
     if packages:
         return _pkg_response(packages_to_dict(request, packages))
 
@@ -248,7 +317,7 @@ def _simple_cache_always_show(context, request):
         else:
             return request.request_login()
 
-    packages = request.db.all(normalized_name)
+    packages = request.db.all_files(normalized_name)
     if packages:
         if not request.access.can_update_cache():
             if request.is_logged_in:
@@ -288,5 +357,9 @@ def _simple_serve(context, request):
         else:
             return request.request_login()
 
-    packages = request.db.all(normalized_name)
+    stamp = request.db.version_stamp(normalized_name)
+    not_modified = _not_modified(request, normalized_name, stamp)
+    if not_modified is not None:
+        return not_modified
+    packages = request.db.all_files(normalized_name)
     return _pkg_response(packages_to_dict(request, packages))
@@ -27,6 +27,7 @@ REQUIREMENTS = [
     "pyramid_jinja2",
     "pyramid_rpc",
     "pyramid_tm",
+    'scandir; python_version < "3.5"',
     "six",
     "transaction",
     "zope.sqlalchemy",
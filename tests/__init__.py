@@ -101,6 +101,7 @@ class MockServerTest(unittest.TestCase):
     def setUp(self):
         self.request = DummyRequest()
         self.request.registry = MagicMock()
+        self.request.registry.index_cache = None
         self.request.userid = None
         self.request.__class__.is_logged_in = property(_is_logged_in)
         self.db = self.request.db = DummyCache(self.request)
@@ -23,8 +23,9 @@ from pypicloud.access import (
     includeme,
     get_pwd_context,
 )
-from pypicloud.access.base import group_to_principal
+from pypicloud.access.base import group_to_principal, READ_ONLY_TOKEN
 from pypicloud.access.ldap_ import LDAPAccessBackend
+from pypicloud.util import TimedCache
 from pypicloud.access.sql import (
     SQLAccessBackend,
     User,
@@ -279,6 +280,22 @@ class TestBaseBackend(BaseACLTest):
         perms = self.backend.allowed_permissions("anypkg")
         self.assertEqual(perms, {Authenticated: ("read", "write")})
 
+    def test_filter_readable(self):
+        """ filter_readable returns packages the user can read, in order """
+        self.backend.user_permissions.return_value = {}
+        self.backend.group_permissions.side_effect = lambda p: {
+            "everyone": ["read"] if p != "b" else ["write"]
+        }
+        self.assertEqual(self.backend.filter_readable(["c", "b", "a"]), ["c", "a"])
+        self.assertEqual(self.backend.filter_readable(["c", "b"], "write"), ["b"])
+
+    def test_filter_readable_admin(self):
+        """ Admins can read all packages """
+        self.request.userid = "abc"
+        access = IAccessBackend(self.request)
+        access.is_admin = lambda x: True
+        self.assertEqual(access.filter_readable(iter(["a", "b"])), ["a", "b"])
+
     def test_admin_principal(self):
         """ Admin user has the 'admin' principal """
         access = IAccessBackend(None)
@@ -290,6 +307,84 @@ class TestBaseBackend(BaseACLTest):
             principals, [Everyone, Authenticated, "admin", "group:brotatos", "user:abc"]
         )
 
+    def test_principals_memoized(self):
+        """ Principals are only looked up once per request """
+        self.backend.is_admin.return_value = False
+        self.backend.groups.return_value = ["brotatos"]
+        principals = self.backend.user_principals("abc")
+        self.assertEqual(self.backend.user_principals("abc"), principals)
+        self.assertEqual(self.backend.groups.call_count, 1)
+
+    def test_principal_cache(self):
+        """ Principals are shared between requests with a principal_cache """
+        cache = TimedCache(None)
+        access = IAccessBackend(None, principal_cache=cache)
+        with patch.object(access, "groups") as groups, patch.object(
+            access, "is_admin"
+        ) as is_admin:
+            is_admin.return_value = False
+            groups.return_value = ["brotatos"]
+            access.user_principals("abc")
+        access = IAccessBackend(None, principal_cache=cache)
+        with patch.object(access, "groups") as groups, patch.object(
+            access, "is_admin"
+        ) as is_admin:
+            principals = access.user_principals("abc")
+            self.assertFalse(groups.called)
+        self.assertItemsEqual(
+            principals, [Everyone, Authenticated, "group:brotatos", "user:abc"]
+        )
+
+    def test_invalidate_principals(self):
+        """ Invalidating principals drops them from the principal_cache """
+        cache = TimedCache(None)
+        access = IAccessBackend(None, principal_cache=cache)
+        access.is_admin = lambda x: False
+        access.groups = lambda x: []
+        access.user_principals("abc")
+        access.user_principals("def")
+        access.invalidate_principals("abc")
+        self.assertEqual(list(cache.keys()), ["def"])
+        access.invalidate_principals()
+        self.assertEqual(len(cache), 0)
+
+    def test_credential_cache(self):
+        """ Successful logins are cached and skip the password hash """
+        context = MagicMock()
+        context.verify.return_value = True
+        access = IAccessBackend(
+            None, pwd_context=context, credential_cache=TimedCache(None)
+        )
+        access._get_password_hash = lambda x: "hash"
+        self.assertTrue(access.verify_user("abc", "pass"))
+        self.assertTrue(access.verify_user("abc", "pass"))
+        self.assertEqual(context.verify.call_count, 1)
+
+    def test_credential_cache_wrong_password(self):
+        """ A cached login does not accept a different password """
+        context = MagicMock()
+        access = IAccessBackend(
+            None, pwd_context=context, credential_cache=TimedCache(None)
+        )
+        access._get_password_hash = lambda x: "hash"
+        context.verify.return_value = True
+        access.verify_user("abc", "pass")
+        context.verify.return_value = False
+        self.assertFalse(access.verify_user("abc", "wrong"))
+
+    def test_credential_cache_password_changed(self):
+        """ A cached login is not used after the password hash changes """
+        context = MagicMock()
+        access = IAccessBackend(
+            None, pwd_context=context, credential_cache=TimedCache(None)
+        )
+        access._get_password_hash = lambda x: "hash"
+        context.verify.return_value = True
+        access.verify_user("abc", "pass")
+        access._get_password_hash = lambda x: "newhash"
+        context.verify.return_value = False
+        self.assertFalse(access.verify_user("abc", "pass"))
+
     def test_load(self):
         """ Base backend has no default implementation for load() """
         access = IAccessBackend(None)
@@ -317,6 +412,112 @@ class TestBaseBackend(BaseACLTest):
         token = access.get_signup_token(user)
         self.assertIsNone(access.validate_signup_token(token + "a"))
 
+    def _token_backend(self, **kwargs):
+        """ Create a backend that can sign API tokens for user 'dsa' """
+        access = IAccessBackend(None, signing_key="abc", **kwargs)
+        hashes = {"dsa": "hash"}
+        access._get_password_hash = hashes.get
+        return access, hashes
+
+    def test_api_token_validate(self):
+        """ API tokens will validate """
+        access, _ = self._token_backend()
+        token = access.get_api_token("dsa", "write")
+        self.assertEqual(access.validate_api_token(token), ("dsa", "write"))
+
+    @patch("pypicloud.access.base.time")
+    def test_api_token_expire(self, time):
+        """ API tokens expire """
+        access, _ = self._token_backend()
+        time.time.return_value = 1000
+        token = access.get_api_token("dsa", expire=10)
+        time.time.return_value = 1011
+        self.assertIsNone(access.validate_api_token(token))
+
+    @patch("pypicloud.access.base.time")
+    def test_api_token_max_expire(self, time):
+        """ API tokens can't outlive auth.api_token_expire """
+        access, _ = self._token_backend(api_token_expiration=100)
+        time.time.return_value = 1000
+        token = access.get_api_token("dsa", expire=10 ** 10)
+        self.assertEqual(token.split(":")[1], "1100")
+
+    def test_api_token_bad_expire(self):
+        """ API tokens must expire in the future """
+        access, _ = self._token_backend()
+        with self.assertRaises(ValueError):
+            access.get_api_token("dsa", expire=0)
+
+    def test_api_token_invalid(self):
+        """ API tokens with a bad signature are rejected """
+        access, _ = self._token_backend()
+        token = access.get_api_token("dsa")
+        self.assertIsNone(access.validate_api_token(token + "a"))
+        self.assertIsNone(access.validate_api_token(token.replace("read", "write")))
+
+    def test_api_token_deleted_user(self):
+        """ API tokens are rejected after the user is deleted """
+        access, hashes = self._token_backend()
+        token = access.get_api_token("dsa")
+        del hashes["dsa"]
+        self.assertIsNone(access.validate_api_token(token))
+
+    def test_api_token_password_change(self):
+        """ API tokens are rejected after the user changes their password """
+        access, hashes = self._token_backend()
+        token = access.get_api_token("dsa")
+        hashes["dsa"] = "new hash"
+        self.assertIsNone(access.validate_api_token(token))
+
+    def test_api_token_cache(self):
+        """ The user lookup for API tokens is cached """
+        access, hashes = self._token_backend(api_token_cache=TimedCache(None))
+        token = access.get_api_token("dsa")
+        self.assertEqual(access.validate_api_token(token), ("dsa", "read"))
+        access._get_password_hash = MagicMock(side_effect=hashes.get)
+        self.assertEqual(access.validate_api_token(token), ("dsa", "read"))
+        self.assertFalse(access._get_password_hash.called)
+
+    def test_api_token_cache_invalidate(self):
+        """ Dropping the cached credentials revokes the user's tokens """
+        access, hashes = self._token_backend(api_token_cache=TimedCache(None))
+        token = access.get_api_token("dsa")
+        self.assertEqual(access.validate_api_token(token), ("dsa", "read"))
+        hashes["dsa"] = "new hash"
+        access.invalidate_credentials("dsa")
+        self.assertIsNone(access.validate_api_token(token))
+
+    def test_api_token_not_signup_token(self):
+        """ Signup tokens and API tokens are not interchangeable """
+        access = IMutableAccessBackend(None, signing_key="abc")
+        access._get_password_hash = lambda username: "hash"
+        access.user_data = lambda username: {"username": username}
+        self.assertIsNone(access.validate_api_token(access.get_signup_token("dsa")))
+        self.assertIsNone(access.validate_signup_token(access.get_api_token("dsa")))
+
+    def test_api_token_bad_scope(self):
+        """ API tokens must have a known scope """
+        access, _ = self._token_backend()
+        with self.assertRaises(ValueError):
+            access.get_api_token("dsa", "admin")
+
+    @patch("pypicloud.access.base.effective_principals")
+    def test_read_only_token(self, principals):
+        """ Read-only tokens have no write permission, even for admins """
+        principals.return_value = [Everyone, READ_ONLY_TOKEN]
+        self.request.userid = "abc"
+        self.backend.is_admin.return_value = True
+        self.assertTrue(self.backend.has_permission("p1", "read"))
+        self.assertFalse(self.backend.has_permission("p1", "write"))
+        self.assertEqual(self.backend.filter_readable(["p1"], "write"), [])
+        self.backend.user_permissions.return_value = {"abc": ["read", "write"]}
+        context = MagicMock()
+        context.__acl__ = self.backend.get_acl("p1")
+        context.__parent__ = None
+        principals = ["user:abc", READ_ONLY_TOKEN]
+        self.assertTrue(self.auth.permits(context, principals, "read"))
+        self.assertFalse(self.auth.permits(context, principals, "write"))
+
     def test_check_health(self):
         """ Base check_health returns True """
         ok, msg = self.backend.check_health()
@@ -593,6 +794,38 @@ class TestRemoteBackend(unittest.TestCase):
         )
         self.assertEqual(perms, self.requests.get().json())
 
+    def test_bulk_permissions(self):
+        """ Query server for permissions on many packages at once """
+        self.backend._settings["auth.uri.bulk_permissions"] = "/bulk"
+        self.requests.post().json.return_value = {
+            "pkg1": {"users": {"dsa": ["read"]}, "groups": {"g1": ["read", "write"]}}
+        }
+        self.backend.default_read = ["authenticated"]
+        self.backend.default_write = []
+        perms = self.backend.bulk_allowed_permissions(["pkg1", "pkg2"])
+        self.requests.post.assert_called_with(
+            "server/bulk", params=None, json=["pkg1", "pkg2"], auth=self.auth
+        )
+        self.assertEqual(
+            perms,
+            {
+                "pkg1": {"user:dsa": ("read",), "group:g1": ("read", "write")},
+                "pkg2": {Authenticated: ("read",)},
+            },
+        )
+
+    def test_bulk_permissions_fallback(self):
+        """ Without a bulk uri, query permissions one package at a time """
+        self.requests.get().json.return_value = {}
+        self.backend.default_read = []
+        self.backend.default_write = []
+        perms = self.backend.bulk_allowed_permissions(["pkg1"])
+        self.assertFalse(self.requests.post.called)
+        self.requests.get.assert_called_with(
+            "server/group_permissions", params={"package": "pkg1"}, auth=self.auth
+        )
+        self.assertEqual(perms, {"pkg1": {}})
+
     def test_user_data(self):
         """ Retrieve all users """
         users = self.backend.user_data()
@@ -756,6 +989,27 @@ class TestSQLiteBackend(unittest.TestCase):
         perms = self.access.group_permissions("pkg1")
         self.assertEqual(perms, {"brotatos": ["read"], "sharkfest": ["read", "write"]})
 
+    def test_bulk_allowed_permissions(self):
+        """ Retrieve permissions on many packages from database """
+        user = make_user("foo", "bar", False)
+        g1 = Group("brotatos")
+        p1 = UserPermission("pkg1", "foo", True, False)
+        p2 = GroupPermission("pkg1", "brotatos", True, True)
+        p3 = GroupPermission("pkg2", "brotatos", True, False)
+        self.db.add_all([user, g1, p1, p2, p3])
+        transaction.commit()
+        self.access.default_read = ["authenticated"]
+        self.access.default_write = []
+        perms = self.access.bulk_allowed_permissions(["pkg1", "pkg2", "pkg3"])
+        self.assertEqual(
+            perms,
+            {
+                "pkg1": {"user:foo": ("read",), "group:brotatos": ("read", "write")},
+                "pkg2": {"group:brotatos": ("read",)},
+                "pkg3": {Authenticated: ("read",)},
+            },
+        )
+
     def test_user_package_perms(self):
         """ Fetch all packages a user has permissions on """
         user = make_user("foo", "bar", False)
@@ -877,6 +1131,19 @@ class TestSQLiteBackend(unittest.TestCase):
         user = self.db.query(User).first()
         self.assertTrue(self.access.verify_user("foo", "baz"))
 
+    def test_edit_password_invalidates_credentials(self):
+        """ Changing a password drops the cached login """
+        self.access.credential_cache = TimedCache(None)
+        user = make_user("foo", "bar", False)
+        self.db.add(user)
+        transaction.commit()
+        self.assertTrue(self.access.verify_user("foo", "bar"))
+        self.assertIn("foo", self.access.credential_cache)
+        self.access.edit_user_password("foo", "baz")
+        self.assertNotIn("foo", self.access.credential_cache)
+        transaction.commit()
+        self.assertFalse(self.access.verify_user("foo", "bar"))
+
     def test_delete_user(self):
         """ Can delete users """
         user = make_user("foo", "bar", False)
@@ -913,6 +1180,16 @@ class TestSQLiteBackend(unittest.TestCase):
         self.db.add(user)
         self.assertFalse(user.admin)
 
+    def test_make_admin_invalidates_principals(self):
+        """ Making a user an admin updates their principals """
+        user = make_user("foo", "bar", False)
+        self.db.add(user)
+        transaction.commit()
+        self.assertNotIn("admin", self.access.user_principals("foo"))
+        self.access.set_user_admin("foo", True)
+        transaction.commit()
+        self.assertIn("admin", self.access.user_principals("foo"))
+
     def test_add_user_to_group(self):
         """ Can add a user to a group """
         user = make_user("foo", "bar", False)
@@ -1657,6 +1934,12 @@ class TestAWSSecretsManagerBackend(unittest.TestCase):
         self.access.edit_user_group("user", "group2", False)
         self.assertItemsEqual(self.access.groups("user"), [])
 
+    def test_edit_group_invalidates_principals(self):
+        """ Changing a user's groups updates their principals """
+        self.assertIn("group:group2", self.access.user_principals("user"))
+        self.access.edit_user_group("user", "group2", False)
+        self.assertNotIn("group:group2", self.access.user_principals("user"))
+
     def test_create_group(self):
         """ Can create a group """
         self.access.create_group("group3")
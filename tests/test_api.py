@@ -13,6 +13,7 @@ class TestApi(MockServerTest):
     def setUp(self):
         super(TestApi, self).setUp()
         self.access = self.request.access = MagicMock()
+        self.access.filter_readable.side_effect = list
 
     def test_list_packages(self):
         """ List all packages """
@@ -25,7 +26,7 @@ class TestApi(MockServerTest):
         """ If no read permission, package not in all_packages """
         p1 = make_package()
         self.db.upload(p1.filename, None)
-        self.access.has_permission.return_value = False
+        self.access.filter_readable.side_effect = lambda names: []
         pkgs = api.all_packages(self.request)
         self.assertEqual(pkgs["packages"], [])
 
@@ -39,6 +40,42 @@ class TestApi(MockServerTest):
             [{"name": p1.name, "summary": None, "last_modified": p1.last_modified}],
         )
 
+    def test_list_packages_paginate(self):
+        """ List one page of packages with a continuation token """
+        for name in ("pkg1", "pkg2", "pkg3"):
+            self.db.upload(make_package(name).filename, None, name)
+        pkgs = api.all_packages(self.request, False, 2)
+        self.assertEqual(pkgs, {"packages": ["pkg1", "pkg2"], "token": "pkg2"})
+        pkgs = api.all_packages(self.request, False, 2, pkgs["token"])
+        self.assertEqual(pkgs, {"packages": ["pkg3"], "token": None})
+
+    def test_list_packages_bad_limit(self):
+        """ The page size must be positive """
+        self.db.summary_page = MagicMock()
+        for limit in (0, -1):
+            ret = api.all_packages(self.request, False, limit)
+            self.assertTrue(isinstance(ret, HTTPBadRequest))
+        self.assertFalse(self.db.summary_page.called)
+
+    def test_package_versions_paginate(self):
+        """ List a page of package versions, newest first """
+        for version in ("1.1", "1.10", "1.9"):
+            self.db.upload(make_package(version=version).filename, None)
+        context = MagicMock()
+        context.name = "mypkg"
+        ret = api.package_versions(context, self.request, 1, 1)
+        self.assertEqual([p.version for p in ret["packages"]], ["1.9"])
+
+    def test_package_versions_bad_page(self):
+        """ The offset can't be negative and the page size must be positive """
+        self.db.paginate = MagicMock()
+        context = MagicMock()
+        context.name = "mypkg"
+        for offset, limit in ((-1, None), (0, 0), (1, -1)):
+            ret = api.package_versions(context, self.request, offset, limit)
+            self.assertTrue(isinstance(ret, HTTPBadRequest))
+        self.assertFalse(self.db.paginate.called)
+
     def test_delete_missing(self):
         """ Deleting a missing package raises 400 """
         context = MagicMock()
@@ -89,6 +126,22 @@ class TestApi(MockServerTest):
         self.assertTrue(isinstance(ret, HTTPForbidden))
         self.access.verify_user.assert_called_with("u", "a")
 
+    def test_create_api_token(self):
+        """ Create an API token for the current user """
+        self.request.userid = "u"
+        ret = api.create_api_token(self.request, "a", "write", 10)
+        self.access.verify_user.assert_called_with("u", "a")
+        self.access.get_api_token.assert_called_with("u", "write", 10)
+        self.assertEqual(ret, {"token": self.access.get_api_token()})
+
+    def test_create_api_token_no_verify(self):
+        """ Creating an API token fails if invalid credentials """
+        self.request.userid = "u"
+        self.access.verify_user.return_value = False
+        ret = api.create_api_token(self.request, "a")
+        self.assertTrue(isinstance(ret, HTTPForbidden))
+        self.assertFalse(self.access.get_api_token.called)
+
     def test_download(self):
         """ Downloading package returns download response from db """
         db = self.request.db = MagicMock()
@@ -7,6 +7,7 @@ from pyramid.security import Everyone
 
 from . import MockServerTest
 from pypicloud import auth
+from pypicloud.access.base import READ_ONLY_TOKEN
 
 
 class TestBasicAuth(MockServerTest):
@@ -102,6 +103,13 @@ class TestBasicAuthPolicy(MockServerTest):
         userid = self.policy.authenticated_userid(self.request)
         self.assertEqual(userid, "dsa")
 
+    def test_auth_skip_token(self):
+        """ Basic auth ignores API tokens """
+        self.get_creds.return_value = {"login": "__token__", "password": "foobar"}
+        userid = self.policy.authenticated_userid(self.request)
+        self.assertIsNone(userid)
+        self.assertFalse(self.request.access.verify_user.called)
+
     def test_principals_userid_no_credentials(self):
         """ Only [Everyone] if no credentials """
         principals = self.policy.effective_principals(self.request)
@@ -178,3 +186,72 @@ class TestSessionAuthPolicy(MockServerTest):
         headers = self.policy.forget(self.request)
         self.assertTrue(session.delete.called)
         self.assertEqual(headers, [])
+
+
+class TestGetApiToken(MockServerTest):
+
+    """ Unit tests for getting API tokens from the request """
+
+    def setUp(self):
+        super(TestGetApiToken, self).setUp()
+        self.request.environ["wsgi.version"] = "9001"
+        self.request.access = MagicMock()
+
+    def test_no_headers(self):
+        """ Returns None if no headers found """
+        self.assertIsNone(auth.get_api_token(self.request))
+
+    def test_bearer(self):
+        """ Validates bearer tokens """
+        self.request.environ["HTTP_AUTHORIZATION"] = "Bearer abcd"
+        token = auth.get_api_token(self.request)
+        self.request.access.validate_api_token.assert_called_with("abcd")
+        self.assertEqual(token, self.request.access.validate_api_token())
+
+    def test_basic(self):
+        """ Validates the password of the __token__ user """
+        userpass = b64encode(b"__token__:abcd").decode("utf8")
+        self.request.environ["HTTP_AUTHORIZATION"] = "Basic " + userpass
+        token = auth.get_api_token(self.request)
+        self.request.access.validate_api_token.assert_called_with("abcd")
+        self.assertEqual(token, self.request.access.validate_api_token())
+
+    def test_basic_other_user(self):
+        """ Returns None for basic auth with a real user """
+        userpass = b64encode(b"dsa:abcd").decode("utf8")
+        self.request.environ["HTTP_AUTHORIZATION"] = "Basic " + userpass
+        self.assertIsNone(auth.get_api_token(self.request))
+        self.assertFalse(self.request.access.validate_api_token.called)
+
+
+class TestTokenAuthPolicy(MockServerTest):
+
+    """ Tests for the TokenAuthenticationPolicy """
+
+    def setUp(self):
+        super(TestTokenAuthPolicy, self).setUp()
+        self.policy = auth.TokenAuthenticationPolicy()
+        self.request.api_token = None
+
+    def test_auth_no_token(self):
+        """ No userid if no valid token """
+        userid = self.policy.authenticated_userid(self.request)
+        self.assertIsNone(userid)
+
+    def test_auth(self):
+        """ Return userid from the token """
+        self.request.api_token = ("dsa", "write")
+        userid = self.policy.authenticated_userid(self.request)
+        self.assertEqual(userid, "dsa")
+
+    def test_principals(self):
+        """ Write tokens add no principals """
+        self.request.api_token = ("dsa", "write")
+        principals = self.policy.effective_principals(self.request)
+        self.assertItemsEqual(principals, [Everyone])
+
+    def test_principals_read_only(self):
+        """ Read tokens add the read-only principal """
+        self.request.api_token = ("dsa", "read")
+        principals = self.policy.effective_principals(self.request)
+        self.assertItemsEqual(principals, [Everyone, READ_ONLY_TOKEN])
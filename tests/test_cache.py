@@ -3,19 +3,37 @@
 from __future__ import unicode_literals
 
 import calendar
+import threading
 import transaction
+from datetime import datetime, timedelta
 import unittest
 from dynamo3 import Throughput
 from flywheel.fields.types import UTC
 from mock import MagicMock, patch, ANY
 from pyramid.testing import DummyRequest
 from redis import RedisError
+from redis.exceptions import ResponseError
+from six.moves.queue import Queue
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
 
 from . import DummyCache, DummyStorage, make_package
 from pypicloud.cache import ICache, SQLCache, RedisCache
-from pypicloud.cache.dynamo import DynamoCache, DynamoPackage, PackageSummary
-from pypicloud.cache.sql import SQLPackage
+from pypicloud.cache.dynamo import (
+    DynamoCache,
+    DynamoPackage,
+    PackageSummary,
+    SummarySnapshot,
+)
+from pypicloud.cache.redis_cache import NearCache
+from pypicloud.cache.search import NGramSearchIndex, get_search_index
+from pypicloud.cache.sql import (
+    ReplicaSet,
+    SQLPackage,
+    SQLPackageSummary,
+    create_schema,
+    make_sort_version,
+)
 from pypicloud.storage import IStorage
 
 
@@ -140,6 +158,136 @@ class TestBaseCache(unittest.TestCase):
         ok, msg = cache.check_health()
         self.assertTrue(ok)
 
+    def test_summary_page(self):
+        """ summary_page returns pages of summaries sorted by name """
+        cache = DummyCache()
+        for name in ("c", "a", "b"):
+            cache.upload("%s-1.tar.gz" % name, None, name)
+        page, token = cache.summary_page(2)
+        self.assertEqual([p["name"] for p in page], ["a", "b"])
+        self.assertEqual(token, "b")
+        page, token = cache.summary_page(2, token)
+        self.assertEqual([p["name"] for p in page], ["c"])
+        self.assertIsNone(token)
+
+
+class TestNGramSearchIndex(unittest.TestCase):
+
+    """ Tests for the in-process search index """
+
+    def setUp(self):
+        super(TestNGramSearchIndex, self).setUp()
+        self.index = get_search_index({"db.search_index": "ngram"})
+        self.cache = DummyCache(search_index=self.index)
+        self.cache.upload("mypkg-1.0.tar.gz", None, summary="a fast parser")
+        self.cache.upload("mypkg-1.1.tar.gz", None, summary="a slow parser")
+        self.cache.upload("otherpkg-2.0.tar.gz", None, summary=None)
+        self.cache.upload("pkg-0.1.tar.gz", None, summary="parses things")
+
+    def search(self, criteria, query_type="or"):
+        """ Search with and without the index and compare the results """
+        with patch.object(self.cache, "search_index", None):
+            expected = self.cache.search(criteria, query_type)
+        results = self.cache.search(criteria, query_type)
+        self.assertItemsEqual(
+            [p.filename for p in results], [p.filename for p in expected]
+        )
+        return [p.filename for p in results]
+
+    def test_configure(self):
+        """ db.search_index selects the index """
+        self.assertTrue(isinstance(self.index, NGramSearchIndex))
+        self.assertIsNone(get_search_index({}))
+
+    def test_same_results(self):
+        """ The index gives the same results as an unindexed search """
+        self.search({"name": ["pkg"], "summary": ["pkg"]})
+        self.search({"name": ["pars"], "summary": ["pars"]})
+        self.search({"name": ["fast"], "summary": ["fast"]})
+        self.search({"name": ["pa"], "summary": ["pa"]})
+        self.search({"name": ["other", "my"], "summary": []}, "or")
+        self.search({"name": ["my", "pkg"], "summary": ["slow", "fast"]}, "and")
+        self.search({"name": ["my", "zzz"], "summary": []}, "and")
+        self.search({"name": [], "summary": []}, "and")
+
+    def test_rank(self):
+        """ Exact name matches come first, then prefixes """
+        results = self.search({"name": ["pkg"], "summary": ["pkg"]})
+        self.assertEqual(
+            results, ["pkg-0.1.tar.gz", "mypkg-1.1.tar.gz", "otherpkg-2.0.tar.gz"]
+        )
+
+    def test_upload_and_delete(self):
+        """ Uploads and deletes update the index """
+        self.search({"name": ["new"], "summary": []})
+        self.cache.upload("newpkg-1.0.tar.gz", None)
+        self.assertEqual(self.search({"name": ["new"]}), ["newpkg-1.0.tar.gz"])
+        self.cache.delete(self.cache.fetch("newpkg-1.0.tar.gz"))
+        self.assertEqual(self.search({"name": ["new"]}), [])
+
+    def test_rebuild_after_reload(self):
+        """ The index is rebuilt after the cache is reloaded """
+        self.search({"name": ["pkg"]})
+        self.cache.save(make_package("hidden", summary="x"))
+        self.assertEqual(self.cache.search({"name": ["hidden"]}, "or"), [])
+        self.cache._invalidate_indexes()
+        self.assertEqual(len(self.cache.search({"name": ["hidden"]}, "or")), 1)
+
+    def test_rebuild_after_cache_time(self):
+        """ The index is rebuilt when it gets old """
+        self.index.cache_time = 0
+        self.search({"name": ["pkg"]})
+        self.cache.save(make_package("hidden", summary="x"))
+        with patch("pypicloud.cache.search.time") as time:
+            time.time.return_value = 2 ** 40
+            results = self.cache.search({"name": ["hidden"]}, "or")
+        self.assertEqual(len(results), 1)
+
+    def test_rebuild_outside_lock(self):
+        """ The cache is scanned without the lock and changes aren't lost """
+        iter_cached = self.cache._iter_cached
+
+        def scan(batch_size):
+            """ Change the cache after it was read """
+            batches = list(iter_cached(batch_size))
+            self.assertTrue(self.index._lock.acquire(False))
+            self.index._lock.release()
+            self.cache.upload("newpkg-1.0.tar.gz", None)
+            self.cache.delete(self.cache.fetch("pkg-0.1.tar.gz"))
+            return batches
+
+        with patch.object(self.cache, "_iter_cached", scan):
+            self.cache.search({"name": ["pkg"]}, "or")
+        self.assertEqual(self.search({"name": ["new"]}), ["newpkg-1.0.tar.gz"])
+        self.assertNotIn("pkg-0.1.tar.gz", self.search({"name": ["pkg"]}))
+
+
+class TestSQLSchemaUpgrade(unittest.TestCase):
+
+    """ Tests for upgrading the schema of an existing SQL cache """
+
+    def test_add_sort_version(self):
+        """ The sort_version column is added to an old packages table """
+        engine = create_engine("sqlite://")
+        engine.execute(
+            "CREATE TABLE packages (filename VARCHAR(255) PRIMARY KEY, "
+            "name VARCHAR(255) NOT NULL, version VARCHAR(1000) NOT NULL, "
+            "last_modified DATETIME NOT NULL, summary VARCHAR(255), "
+            "data TEXT NOT NULL)"
+        )
+        engine.execute(
+            "INSERT INTO packages VALUES ('mypkg-1.10.tar.gz', 'mypkg', '1.10', "
+            "'2018-01-01 00:00:00', 'summary', '{}')"
+        )
+        create_schema(engine)
+        inspector = inspect(engine)
+        columns = [column["name"] for column in inspector.get_columns("packages")]
+        self.assertIn("sort_version", columns)
+        indexes = [index["name"] for index in inspector.get_indexes("packages")]
+        self.assertIn("ix_packages_name_sort_version", indexes)
+        sort_version = engine.execute("SELECT sort_version FROM packages").scalar()
+        self.assertEqual(sort_version, make_sort_version("1.10"))
+
 
 class TestSQLiteCache(unittest.TestCase):
 
@@ -169,6 +317,7 @@ class TestSQLiteCache(unittest.TestCase):
         super(TestSQLiteCache, self).tearDown()
         transaction.abort()
         self.sql.query(SQLPackage).delete()
+        self.sql.query(SQLPackageSummary).delete()
         transaction.commit()
         self.request._process_finished_callbacks()
 
@@ -242,6 +391,23 @@ class TestSQLiteCache(unittest.TestCase):
         all_pkgs = self.sql.query(SQLPackage).all()
         self.assertItemsEqual(all_pkgs, keys)
 
+    def test_reload_upsert(self):
+        """ reload_from_storage() replaces existing rows in batches """
+        self.db.reload_batch_size = 1
+        old = make_package(summary="old", factory=SQLPackage)
+        self.db.save(old)
+        keys = [
+            make_package(summary="new", factory=SQLPackage),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=SQLPackage),
+        ]
+        self.storage.list.return_value = keys
+        self.db.reload_from_storage(False)
+        all_pkgs = self.sql.query(SQLPackage).all()
+        self.assertItemsEqual(all_pkgs, keys)
+        self.assertEqual(self.db.fetch(old.filename).summary, "new")
+        summaries = dict((s["name"], s["summary"]) for s in self.db.summary())
+        self.assertEqual(summaries, {"mypkg": "new", "mypkg2": "summary"})
+
     def test_fetch(self):
         """ fetch() retrieves a package from the database """
         pkg = make_package(factory=SQLPackage)
@@ -265,6 +431,22 @@ class TestSQLiteCache(unittest.TestCase):
         saved_pkgs = self.db.all("mypkg")
         self.assertItemsEqual(saved_pkgs, pkgs[:2])
 
+    def test_all_files(self):
+        """ all_files() loads the files of a package without the ORM """
+        pkgs = [
+            make_package(factory=SQLPackage, path="a/b"),
+            make_package(version="1.3", filename="mypath3", factory=SQLPackage),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=SQLPackage),
+        ]
+        self.sql.add_all(pkgs)
+        self.sql.flush()
+        files = self.db.all_files("mypkg")
+        self.assertItemsEqual(files, pkgs[:2])
+        for pkg in files:
+            self.assertFalse(isinstance(pkg, SQLPackage))
+        paths = dict((pkg.filename, pkg.data.get("path")) for pkg in files)
+        self.assertEqual(paths[pkgs[0].filename], "a/b")
+
     def test_distinct(self):
         """ distinct() returns all unique package names """
         pkgs = [
@@ -272,10 +454,57 @@ class TestSQLiteCache(unittest.TestCase):
             make_package(version="1.3", filename="mypath3", factory=SQLPackage),
             make_package("mypkg2", "1.3.4", "my/other/path", factory=SQLPackage),
         ]
-        self.sql.add_all(pkgs)
+        for pkg in pkgs:
+            self.db.save(pkg)
         saved_pkgs = self.db.distinct()
         self.assertItemsEqual(saved_pkgs, set([p.name for p in pkgs]))
 
+    def test_version_stamp(self):
+        """ version_stamp() returns the latest last_modified and file count """
+        pkgs = [
+            make_package(last_modified=datetime(2018, 1, 1), factory=SQLPackage),
+            make_package(
+                version="1.3",
+                filename="mypath3",
+                last_modified=datetime(2018, 2, 1),
+                factory=SQLPackage,
+            ),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=SQLPackage),
+        ]
+        self.sql.add_all(pkgs)
+        self.assertEqual(self.db.version_stamp("mypkg"), (datetime(2018, 2, 1), 2))
+        self.assertIsNone(self.db.version_stamp("missing"))
+
+    def test_versions_sorted_in_db(self):
+        """ all(), paginate() and latest() order by the sortable version """
+        pkgs = [
+            make_package(version="1.10", filename="a-1.10", factory=SQLPackage),
+            make_package(version="1.9", filename="a-1.9", factory=SQLPackage),
+            make_package(version="1.10rc1", filename="a-1.10rc1", factory=SQLPackage),
+            make_package(version="1.10", filename="a-1.10-py3", factory=SQLPackage),
+        ]
+        self.sql.add_all(pkgs)
+        filenames = [pkg.filename for pkg in self.db.all("mypkg")]
+        self.assertEqual(filenames, ["a-1.10-py3", "a-1.10", "a-1.10rc1", "a-1.9"])
+        page = self.db.paginate("mypkg", 1, 2)
+        self.assertEqual([pkg.filename for pkg in page], ["a-1.10", "a-1.10rc1"])
+        self.assertEqual(self.db.latest("mypkg").filename, "a-1.10-py3")
+        self.assertIsNone(self.db.latest("other"))
+
+    def test_search_latest(self):
+        """ search() returns the most recent matching version of each package """
+        pkgs = [
+            make_package(version="1.10", filename="a-1.10", factory=SQLPackage),
+            make_package(version="1.9", filename="a-1.9", factory=SQLPackage),
+            make_package("mypkg2", "2.0", "b-2.0", summary="new", factory=SQLPackage),
+            make_package("mypkg2", "1.0", "b-1.0", summary="old", factory=SQLPackage),
+        ]
+        self.sql.add_all(pkgs)
+        packages = self.db.search({"name": ["mypkg"]}, "or")
+        self.assertItemsEqual([p.filename for p in packages], ["a-1.10", "b-2.0"])
+        packages = self.db.search({"summary": ["old"]}, "or")
+        self.assertItemsEqual([p.filename for p in packages], ["b-1.0"])
+
     def test_search_or(self):
         """ search() returns packages that match the query """
         pkgs = [
@@ -337,6 +566,53 @@ class TestSQLiteCache(unittest.TestCase):
             <= 1
         )
 
+    def test_summary_maintained(self):
+        """ save() and clear() keep the summary of the newest file """
+        old = make_package(
+            version="1.1",
+            last_modified=datetime(2018, 1, 1),
+            summary="old",
+            factory=SQLPackage,
+        )
+        new = make_package(
+            version="1.0",
+            last_modified=datetime(2018, 1, 2),
+            summary="new",
+            factory=SQLPackage,
+        )
+        self.db.save(old)
+        self.db.save(new)
+        self.assertEqual(self.db.summary()[0]["summary"], "new")
+        self.db.clear(self.db.fetch(new.filename))
+        self.assertEqual(self.db.summary()[0]["summary"], "old")
+        self.db.clear(self.db.fetch(old.filename))
+        self.assertEqual(self.db.summary(), [])
+        self.assertEqual(self.db.distinct(), [])
+
+    def test_summary_older_save(self):
+        """ Saving an older file doesn't replace the summary """
+        # Written by another process, so the session hasn't loaded it
+        self.sql.execute(
+            SQLPackageSummary.__table__.insert(),
+            {"name": "mypkg", "summary": "new", "last_modified": datetime(2018, 1, 2)},
+        )
+        old = make_package(
+            version="1.0",
+            last_modified=datetime(2018, 1, 1),
+            summary="old",
+            factory=SQLPackage,
+        )
+        self.db.save(old)
+        self.assertEqual(self.db.summary()[0]["summary"], "new")
+
+    def test_rebuild_summaries(self):
+        """ reload_if_needed() fills in the summaries of cached packages """
+        pkg = make_package(factory=SQLPackage)
+        self.sql.add(pkg)
+        self.db.reload_if_needed()
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.assertFalse(self.storage.list.called)
+
     def test_multiple_packages_same_version(self):
         """ Can upload multiple packages that have the same version """
         with patch.object(self.db, "allow_overwrite", False):
@@ -387,6 +663,118 @@ class TestPostgresCache(TestSQLiteCache):
     DB_URL = "postgresql://postgres@127.0.0.1:5432/postgres"
 
 
+class TestSQLReplicas(unittest.TestCase):
+
+    """ Tests for reading from SQL replicas """
+
+    def setUp(self):
+        super(TestSQLReplicas, self).setUp()
+        settings = {
+            "pypi.storage": "tests.DummyStorage",
+            "db.url": "sqlite://",
+            "db.replica.urls": "sqlite://",
+        }
+        self.kwargs = SQLCache.configure(settings)
+        self.replicas = self.kwargs["replicas"]
+        self.replica_engine = self.replicas.engines[0]
+        create_schema(self.replica_engine)
+        transaction.begin()
+        self.request = DummyRequest()
+        self.request.tm = transaction.manager
+        self.db = SQLCache(self.request, **self.kwargs)
+        self.storage = self.db.storage = MagicMock(spec=IStorage)
+
+    def tearDown(self):
+        super(TestSQLReplicas, self).tearDown()
+        transaction.abort()
+        self.request._process_finished_callbacks()
+
+    def _save_on_replica(self, pkg):
+        """ Save a package directly to the replica """
+        session = self.replicas.dbmaker(bind=self.replica_engine)
+        session.merge(pkg)
+        session.merge(
+            SQLPackageSummary(
+                name=pkg.name, last_modified=pkg.last_modified, summary=pkg.summary
+            )
+        )
+        session.commit()
+        session.close()
+
+    def test_configure(self):
+        """ db.replica.* settings are not passed to the primary engine """
+        self.assertEqual(len(self.replicas.engines), 1)
+        self.assertEqual(self.replicas.retry_interval, 30)
+        self.assertEqual(self.replicas.sticky_time, 0)
+
+    def test_no_replicas(self):
+        """ Without replicas, reads use the primary """
+        settings = {"pypi.storage": "tests.DummyStorage", "db.url": "sqlite://"}
+        kwargs = SQLCache.configure(settings)
+        self.assertIsNone(kwargs["replicas"])
+        db = SQLCache(self.request, **kwargs)
+        self.assertIs(db.read_db, db.db)
+
+    def test_read_from_replica(self):
+        """ Reads are sent to the replica """
+        pkg = make_package(factory=SQLPackage)
+        self._save_on_replica(pkg)
+        self.assertEqual(self.db.fetch(pkg.filename), pkg)
+        self.assertEqual(self.db.all(pkg.name), [pkg])
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.assertEqual(len(self.db.summary()), 1)
+        self.assertIsNone(self.db.db.query(SQLPackage).first())
+
+    def test_read_your_writes(self):
+        """ After a write, the request reads from the primary """
+        pkg = make_package(factory=SQLPackage)
+        self._save_on_replica(pkg)
+        self.db.fetch(pkg.filename)
+        pkg2 = make_package("mypkg2", factory=SQLPackage)
+        self.db.save(pkg2)
+        self.assertEqual(self.db.distinct(), ["mypkg2"])
+
+    def test_clear_replica_package(self):
+        """ Packages read from the replica can be deleted from the primary """
+        pkg = make_package(factory=SQLPackage)
+        self._save_on_replica(pkg)
+        self.db.db.merge(pkg)
+        self.db.db.flush()
+        self.db.clear(self.db.fetch(pkg.filename))
+        self.db.db.flush()
+        self.assertIsNone(self.db.db.query(SQLPackage).first())
+
+    def test_sticky_time(self):
+        """ After a write, the process reads from the primary for a while """
+        self.replicas.sticky_time = 30
+        self.db.save(make_package(factory=SQLPackage))
+        self.assertIsNone(self.replicas.choose())
+        db = SQLCache(self.request, **self.kwargs)
+        self.assertIs(db.read_db, db.db)
+
+    def test_fallback(self):
+        """ If the replica fails, read from the primary and skip the replica """
+        pkg = make_package(factory=SQLPackage)
+        self.db.db.merge(pkg)
+        self.replicas.dbmaker = MagicMock()
+        self.replicas.dbmaker().query.side_effect = SQLAlchemyError("down")
+        self.assertEqual(self.db.fetch(pkg.filename), pkg)
+        self.assertIsNone(self.replicas.choose())
+
+    def test_round_robin(self):
+        """ Replicas are chosen in turn, skipping failed ones """
+        replicas = ReplicaSet(["a", "b", "c"])
+        self.assertEqual([replicas.choose() for _ in range(4)], ["a", "b", "c", "a"])
+        replicas.mark_failed("c")
+        self.assertEqual([replicas.choose() for _ in range(3)], ["b", "a", "b"])
+
+    def test_retry_failed(self):
+        """ Failed replicas are retried after the retry interval """
+        replicas = ReplicaSet(["a"], retry_interval=0)
+        replicas.mark_failed("a")
+        self.assertEqual(replicas.choose(), "a")
+
+
 class TestRedisCache(unittest.TestCase):
 
     """ Tests for the redis cache """
@@ -497,6 +885,31 @@ class TestRedisCache(unittest.TestCase):
         count = self.redis.scard(self.db.redis_set)
         self.assertEqual(count, 0)
 
+    def test_clear_all_batches(self):
+        """ clear_all() deletes the keys in batches """
+        self.db.scan_batch_size = 2
+        for i in range(5):
+            self.db.save(make_package(version="1.%d" % i))
+        self.db.clear_all()
+        self.assertEqual(self.redis.keys(self.db.redis_prefix + "*"), [])
+
+    def test_clear_all_unlink(self):
+        """ clear_all() can use UNLINK instead of DEL """
+        self.db.unlink = True
+        self.db.save(make_package())
+        with patch.object(self.redis, "delete") as delete:
+            self.db.clear_all()
+        self.assertFalse(delete.called)
+        self.assertEqual(self.redis.keys(self.db.redis_prefix + "*"), [])
+
+    def test_load_all_packages_batches(self):
+        """ Loading all packages scans the keys in batches """
+        self.db.scan_batch_size = 2
+        pkgs = [make_package(version="1.%d" % i) for i in range(5)]
+        for pkg in pkgs:
+            self.db.save(pkg)
+        self.assertItemsEqual(self.db._load_all_packages(), pkgs)
+
     def test_reload(self):
         """ reload_from_storage() inserts packages into the database """
         keys = [
@@ -508,6 +921,40 @@ class TestRedisCache(unittest.TestCase):
         for pkg in keys:
             self.assert_in_redis(pkg)
 
+    def test_version_index(self):
+        """ all() reads versions in order from the version index """
+        self.db.version_index = True
+        pkgs = [make_package(version=v) for v in ("1.1", "1.10", "1.9", "1.0a1")]
+        for pkg in pkgs:
+            self.db.save(pkg)
+        versions = [p.version for p in self.db.all("mypkg")]
+        self.assertEqual(versions, ["1.10", "1.9", "1.1", "1.0a1"])
+        self.assertEqual(self.db.latest("mypkg").version, "1.10")
+        page = self.db.paginate("mypkg", 1, 2)
+        self.assertEqual([p.version for p in page], ["1.9", "1.1"])
+
+    def test_version_index_backfill(self):
+        """ Files cached before the version index was enabled get indexed """
+        old = make_package(version="1.1")
+        self.db.save(old)
+        self.db.version_index = True
+        new = make_package(version="1.2")
+        self.db.save(new)
+        self.assertEqual(self.db.all("mypkg"), [new, old])
+        self.assertEqual(self.redis.zcard(self.db.redis_version_index("mypkg")), 2)
+        self.assertEqual(self.db.paginate("mypkg", 1, 1), [old])
+
+    def test_version_index_clear(self):
+        """ clear() removes the package from the version index """
+        self.db.version_index = True
+        p1 = make_package(version="1.1")
+        p2 = make_package(version="1.2")
+        self.db.save(p1)
+        self.db.save(p2)
+        self.db.clear(p2)
+        self.assertEqual(self.db.all("mypkg"), [p1])
+        self.assertEqual(self.redis.zcard(self.db.redis_version_index("mypkg")), 1)
+
     def test_fetch(self):
         """ fetch() retrieves a package from the database """
         pkg = make_package()
@@ -545,6 +992,23 @@ class TestRedisCache(unittest.TestCase):
 
         self.assertItemsEqual(saved_pkgs, set([p.name for p in pkgs]))
 
+    def test_version_stamp(self):
+        """ version_stamp() returns the summary last_modified and file count """
+        pkgs = [
+            make_package(last_modified=datetime(2018, 1, 1), factory=SQLPackage),
+            make_package(
+                version="1.3",
+                filename="mypath3",
+                last_modified=datetime(2018, 2, 1),
+                factory=SQLPackage,
+            ),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=SQLPackage),
+        ]
+        for pkg in pkgs:
+            self.db.save(pkg)
+        self.assertEqual(self.db.version_stamp("mypkg"), (datetime(2018, 2, 1), 2))
+        self.assertIsNone(self.db.version_stamp("missing"))
+
     def test_delete_package(self):
         """ Deleting the last package of a name removes from distinct() """
         pkgs = [
@@ -635,6 +1099,20 @@ class TestRedisCache(unittest.TestCase):
             p2.last_modified.utctimetuple(),
         )
 
+    def test_summary_older_save(self):
+        """ Saving an older package does not overwrite the summary """
+        p1 = make_package(version="1.2", summary="new")
+        p2 = make_package(
+            version="1.1",
+            summary="old",
+            last_modified=p1.last_modified - timedelta(hours=1),
+        )
+        self.db.save(p1)
+        self.db.save(p2)
+        summaries = self.db.summary()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]["summary"], "new")
+
     def test_check_health_success(self):
         """ check_health returns True for good connection """
         ok, msg = self.db.check_health()
@@ -652,6 +1130,163 @@ class TestRedisCache(unittest.TestCase):
         ok, msg = self.db.check_health()
         self.assertFalse(ok)
 
+    def _use_near_cache(self):
+        """ Put a near-cache in front of the redis cache """
+        near_cache = NearCache(self.redis, self.db.redis_prefix, 300, 100)
+        near_cache._ensure_listening = MagicMock()
+        near_cache._ready = True
+        self.db.near_cache = near_cache
+        return near_cache
+
+    def test_near_cache_reads(self):
+        """ Reads are served from the near-cache after the first load """
+        self._use_near_cache()
+        pkg = make_package()
+        self.db.save(pkg)
+        self.assertEqual(self.db.fetch(pkg.filename), pkg)
+        self.assertEqual(self.db.all(pkg.name), [pkg])
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.assertEqual(len(self.db.summary()), 1)
+        self.redis.flushdb()
+        self.assertEqual(self.db.fetch(pkg.filename), pkg)
+        self.assertEqual(self.db.all(pkg.name), [pkg])
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.assertEqual(len(self.db.summary()), 1)
+
+    def test_near_cache_local_writes(self):
+        """ Saving and clearing packages invalidates the near-cache """
+        self._use_near_cache()
+        pkg = make_package()
+        self.assertEqual(self.db.distinct(), [])
+        self.db.save(pkg)
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.assertEqual(self.db.all(pkg.name), [pkg])
+        pkg2 = make_package(version="1.2")
+        self.db.save(pkg2)
+        self.assertEqual(self.db.all(pkg.name), [pkg2, pkg])
+        self.db.clear(pkg2)
+        self.assertEqual(self.db.all(pkg.name), [pkg])
+        self.db.clear_all()
+        self.assertIsNone(self.db.fetch(pkg.filename))
+        self.assertEqual(self.db.distinct(), [])
+
+    def test_near_cache_remote_invalidate(self):
+        """ Invalidation messages from redis drop the matching entries """
+        near_cache = self._use_near_cache()
+        pkg = make_package()
+        self.db.save(pkg)
+        self.db.fetch(pkg.filename)
+        self.db.summary()
+        self.redis.flushdb()
+        near_cache.invalidate([self.db.redis_key(pkg.filename)])
+        self.assertIsNone(self.db.fetch(pkg.filename))
+        self.assertEqual(len(self.db.summary()), 1)
+        near_cache.invalidate([self.db.redis_summary_key(pkg.name)])
+        self.assertEqual(self.db.summary(), [])
+
+    def test_near_cache_not_ready(self):
+        """ Nothing is cached until invalidations are being received """
+        near_cache = self._use_near_cache()
+        near_cache.clear()
+        pkg = make_package()
+        self.db.save(pkg)
+        self.db.fetch(pkg.filename)
+        self.redis.flushdb()
+        self.assertIsNone(self.db.fetch(pkg.filename))
+
+    def test_near_cache_copies(self):
+        """ Modifying a returned package doesn't change the near-cache """
+        self._use_near_cache()
+        pkg = make_package()
+        self.db.save(pkg)
+        self.db.fetch(pkg.filename).summary = "changed"
+        self.db.all(pkg.name)[0].data["foo"] = "bar"
+        self.assertEqual(self.db.fetch(pkg.filename).summary, pkg.summary)
+        self.assertEqual(self.db.all(pkg.name)[0].data, pkg.data)
+
+
+class TestNearCache(unittest.TestCase):
+
+    """ Tests for the redis near-cache """
+
+    def setUp(self):
+        super(TestNearCache, self).setUp()
+        self.cache = NearCache(MagicMock(), "pypicloud:", 300, 100)
+        self.cache._ensure_listening = MagicMock()
+        self.cache._ready = True
+
+    def test_get_caches(self):
+        """ The loader is only called once """
+        loader = MagicMock(return_value="a")
+        self.assertEqual(self.cache.get(("fetch", "a"), loader), "a")
+        self.assertEqual(self.cache.get(("fetch", "a"), loader), "a")
+        self.assertEqual(loader.call_count, 1)
+
+    def test_invalidated_during_load(self):
+        """ A value is not cached if anything is invalidated while loading """
+
+        def loader():
+            """ Simulate a write during the read """
+            self.cache.invalidate(["pypicloud:set"])
+            return "a"
+
+        self.cache.get(("fetch", "a"), loader)
+        self.assertNotIn(("fetch", "a"), self.cache._cache)
+
+    def test_invalidate_package(self):
+        """ Changing a package drops its entry and all version lists """
+        self.cache._cache.update(
+            {("fetch", "a"): 1, ("fetch", "b"): 2, ("all", "a"): 3, ("distinct",): 4}
+        )
+        self.cache.invalidate(["pypicloud:package:a"])
+        self.assertEqual(self.cache._cache, {("fetch", "b"): 2, ("distinct",): 4})
+
+    def test_invalidate_name_sets(self):
+        """ Changing the set of names drops distinct and summary """
+        self.cache._cache.update(
+            {("all", "a"): 1, ("distinct",): 2, ("summary",): 3, ("all", "b"): 4}
+        )
+        self.cache.invalidate(["pypicloud:set", "pypicloud:versions:a"])
+        self.assertEqual(self.cache._cache, {("all", "b"): 4})
+
+    def test_invalidate_flush(self):
+        """ A flush drops everything """
+        self.cache._cache.update({("fetch", "a"): 1, ("summary",): 2})
+        self.cache.invalidate(None)
+        self.assertEqual(self.cache._cache, {})
+
+    def test_ignore_other_keys(self):
+        """ Keys outside of the prefix are ignored """
+        self.cache._cache.update({("fetch", "a"): 1})
+        self.cache.invalidate(["other:package:a"])
+        self.assertEqual(self.cache._cache, {("fetch", "a"): 1})
+
+    @patch("pypicloud.cache.redis_cache.time")
+    def test_tracking_unsupported(self, time):
+        """ The near-cache disables itself if redis can't track clients """
+        cache = NearCache(MagicMock(), "pypicloud:", 300, 100)
+        cache._listen_once = MagicMock(side_effect=ResponseError("unknown command"))
+        cache._listen()
+        self.assertFalse(time.sleep.called)
+        loader = MagicMock(return_value="a")
+        cache._thread = None
+        cache.get(("fetch", "a"), loader)
+        cache.get(("fetch", "a"), loader)
+        self.assertEqual(loader.call_count, 2)
+        self.assertIsNone(cache._thread)
+
+    @patch("pypicloud.cache.redis_cache.time")
+    def test_reconnect_backoff(self, time):
+        """ Reconnecting waits longer after each failure """
+        cache = NearCache(MagicMock(), "pypicloud:", 300, 100)
+        cache.max_retry_delay = 4
+        cache._listen_once = MagicMock(
+            side_effect=[RedisError()] * 4 + [ResponseError()]
+        )
+        cache._listen()
+        delays = [c[0][0] for c in time.sleep.call_args_list]
+        self.assertEqual(delays, [1, 2, 4, 4])
+
 
 class TestDynamoCache(unittest.TestCase):
 
@@ -673,6 +1308,7 @@ class TestDynamoCache(unittest.TestCase):
             "db.aws_access_key_id": "",
             "db.aws_secret_access_key": "",
         }
+        cls.settings = settings
         cls.kwargs = DynamoCache.configure(settings)
         cls.engine = cls.kwargs["engine"]
 
@@ -749,6 +1385,65 @@ class TestDynamoCache(unittest.TestCase):
         all_pkgs = self.engine.scan(DynamoPackage).all()
         self.assertItemsEqual(all_pkgs, keys)
 
+    def test_reload_summaries(self):
+        """ reload_from_storage() saves one summary per name, from the newest file """
+        keys = [
+            make_package(
+                version="1.1",
+                last_modified=datetime(2018, 1, 2),
+                summary="new",
+                factory=DynamoPackage,
+            ),
+            make_package(
+                version="1.2",
+                last_modified=datetime(2018, 1, 1),
+                summary="old",
+                factory=DynamoPackage,
+            ),
+        ]
+        self.storage.list.return_value = keys
+        self.db.reload_batch_size = 1
+        self.db.reload_from_storage()
+        self.assertItemsEqual(self.engine.scan(DynamoPackage).all(), keys)
+        summaries = self.db.summary()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]["summary"], "new")
+
+    def test_parallel_scan(self):
+        """ Scanning in segments returns every item """
+        pkgs = [
+            make_package(version="1.%d" % i, factory=DynamoPackage) for i in range(20)
+        ]
+        self._save_pkgs(*pkgs)
+        self.db.scan_segments = 4
+        self.assertItemsEqual(list(self.db._scan(DynamoPackage)), pkgs)
+        filenames = self.db.cached_filenames()
+        self.assertEqual(filenames, set(pkg.filename for pkg in pkgs))
+
+    def test_parallel_scan_abandoned(self):
+        """ Segments stop scanning when the consumer stops reading """
+        started = Queue()
+
+        def scan2(*_, **__):
+            """ A table that never ends """
+            done = threading.Event()
+            started.put(done)
+            try:
+                while True:
+                    yield {"filename": "a"}
+            finally:
+                done.set()
+
+        self.db.scan_segments = 2
+        with patch.object(self.engine, "dynamo") as dynamo:
+            dynamo.scan2.side_effect = scan2
+            scan = self.db._scan(DynamoPackage, attributes=["filename"])
+            next(scan)
+            segments = [started.get(timeout=10) for _ in range(2)]
+            scan.close()
+            for done in segments:
+                self.assertTrue(done.wait(10))
+
     def test_fetch(self):
         """ fetch() retrieves a package from the database """
         pkg = make_package(factory=DynamoPackage)
@@ -783,6 +1478,24 @@ class TestDynamoCache(unittest.TestCase):
         saved_pkgs = self.db.distinct()
         self.assertItemsEqual(saved_pkgs, set([p.name for p in pkgs]))
 
+    def test_version_stamp(self):
+        """ version_stamp() returns the summary last_modified and file count """
+        pkgs = [
+            make_package(last_modified=datetime(2018, 1, 1), factory=DynamoPackage),
+            make_package(
+                version="1.3",
+                filename="mypath3",
+                last_modified=datetime(2018, 2, 1),
+                factory=DynamoPackage,
+            ),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=DynamoPackage),
+        ]
+        self._save_pkgs(*pkgs)
+        self.assertEqual(
+            self.db.version_stamp("mypkg"), (datetime(2018, 2, 1, tzinfo=UTC), 2)
+        )
+        self.assertIsNone(self.db.version_stamp("missing"))
+
     def test_search_or(self):
         """ search() returns packages that match the query """
         pkgs = [
@@ -856,6 +1569,80 @@ class TestDynamoCache(unittest.TestCase):
             all_versions = self.db.all(name)
             self.assertEqual(len(all_versions), 2)
 
+    def test_all_files_index(self):
+        """ all_files() queries the files index """
+        settings = dict(self.settings)
+        settings["db.files_index"] = "true"
+        self.engine.delete_schema()
+        self.addCleanup(self.engine.create_schema)
+        self.addCleanup(self.engine.delete_schema)
+        self.addCleanup(DynamoPackage.meta_.global_indexes.pop)
+        kwargs = DynamoCache.configure(settings)
+        db = DynamoCache(DummyRequest(), **kwargs)
+        pkgs = [
+            make_package(factory=DynamoPackage, path="pkg/mypkg-1.1.tar.gz"),
+            make_package(version="1.3", filename="mypath3", factory=DynamoPackage),
+            make_package("mypkg2", "1.3.4", "my/other/path", factory=DynamoPackage),
+        ]
+        self._save_pkgs(*pkgs)
+        with patch.object(db, "all") as all_versions:
+            packages = db.all_files("mypkg")
+            all_versions.assert_not_called()
+        self.assertItemsEqual(packages, pkgs[:2])
+        by_filename = dict((pkg.filename, pkg) for pkg in packages)
+        self.assertEqual(
+            by_filename[pkgs[0].filename].data, {"path": "pkg/mypkg-1.1.tar.gz"}
+        )
+        self.assertEqual(
+            by_filename["mypath3"].last_modified,
+            pkgs[1].last_modified.replace(tzinfo=UTC),
+        )
+
+    def test_summary_page(self):
+        """ summary_page scans one page of the summary table at a time """
+        pkgs = [make_package("pkg%d" % i, factory=DynamoPackage) for i in range(5)]
+        self._save_pkgs(*pkgs)
+        names = []
+        page, token = self.db.summary_page(2)
+        while token is not None:
+            self.assertEqual(len(page), 2)
+            names.extend(p["name"] for p in page)
+            page, token = self.db.summary_page(2, token)
+        names.extend(p["name"] for p in page)
+        self.assertItemsEqual(names, [pkg.name for pkg in pkgs])
+
+    def test_summary_snapshot(self):
+        """ The summary snapshot is only read from the table once """
+        self.db.summary_snapshot = SummarySnapshot(300)
+        pkg = make_package(factory=DynamoPackage)
+        self._save_pkgs(pkg)
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        with patch.object(self.db, "_scan") as scan:
+            self.assertEqual(self.db.distinct(), [pkg.name])
+            self.assertEqual(len(self.db.summary()), 1)
+            scan.assert_not_called()
+
+    def test_summary_snapshot_save_clear(self):
+        """ Saving and clearing packages updates the summary snapshot """
+        self.db.summary_snapshot = SummarySnapshot(300)
+        self.assertEqual(self.db.distinct(), [])
+        pkg = make_package(factory=DynamoPackage)
+        self.db.save(pkg)
+        self.assertEqual(self.db.distinct(), [pkg.name])
+        self.db.clear(pkg)
+        self.assertEqual(self.db.distinct(), [])
+
+    def test_summary_snapshot_page(self):
+        """ summary_page reads pages from the summary snapshot """
+        self.db.summary_snapshot = SummarySnapshot(300)
+        pkgs = [make_package("pkg%d" % i, factory=DynamoPackage) for i in range(3)]
+        self._save_pkgs(*pkgs)
+        page, token = self.db.summary_page(2)
+        self.assertEqual([p["name"] for p in page], ["pkg0", "pkg1"])
+        page, token = self.db.summary_page(2, token)
+        self.assertEqual([p["name"] for p in page], ["pkg2"])
+        self.assertIsNone(token)
+
     def test_clear_all_keep_throughput(self):
         """ Calling clear_all will keep same table throughput """
         throughput = {}
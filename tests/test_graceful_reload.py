@@ -9,7 +9,7 @@ from sqlalchemy.exc import OperationalError
 from . import make_package
 from pypicloud.cache import SQLCache, RedisCache
 from pypicloud.cache.dynamo import DynamoCache, DynamoPackage, PackageSummary
-from pypicloud.cache.sql import SQLPackage
+from pypicloud.cache.sql import SQLPackage, SQLPackageSummary, SQLMetadata
 from pypicloud.storage import IStorage
 
 
@@ -46,12 +46,17 @@ class TestDynamoCache(unittest.TestCase):
         super(TestDynamoCache, self).setUp()
         self.db = DynamoCache(DummyRequest(), **self.kwargs)
         self.storage = self.db.storage = MagicMock(spec=IStorage)
+        self.storage.list_changes.side_effect = self._list_changes
 
     def tearDown(self):
         super(TestDynamoCache, self).tearDown()
         for model in (DynamoPackage, PackageSummary):
             self.engine.scan(model).delete()
 
+    def _list_changes(self, factory, since):
+        """ Mocked method for listing the filenames in storage """
+        return set(p.filename for p in self.storage.list(factory)), []
+
     def _save_pkgs(self, *pkgs):
         """ Save a DynamoPackage to the db """
         for pkg in pkgs:
@@ -93,21 +98,21 @@ class TestDynamoCache(unittest.TestCase):
         self.db.save(pkgs[0])
         self.db.save(pkgs[1])
 
-        # Return first pkgs[1], then pkgs[1:] because the second time we list
-        # we will have "uploaded" pkgs[2]
-        return_values = [lambda: pkgs[1:2], lambda: pkgs[1:]]
-
         def list_storage(package_class):
             """ mocked method for listing storage packages """
-            # The first time we list from storage, concurrently "upload"
-            # pkgs[2]
-            if len(return_values) == 2:
+            # While we list from storage, concurrently "upload" pkgs[2]
+            if len(pkgs) == 2:
                 pkg = make_package("mypkg3", factory=DynamoPackage)
                 pkgs.append(pkg)
                 self.db.save(pkg)
-            return return_values.pop(0)()
+            return pkgs[1:2]
 
         self.storage.list.side_effect = list_storage
+        # The second time we list we will have "uploaded" pkgs[2]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set(p.filename for p in pkgs[1:]),
+            pkgs[2:],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.engine.scan(DynamoPackage).all()
@@ -122,10 +127,12 @@ class TestDynamoCache(unittest.TestCase):
         ]
         self.db.save(pkgs[0])
 
-        # Return first pkgs[:], then pkgs[:1] because the second time we list
-        # we will have "deleted" pkgs[1]
-        return_values = [pkgs[:], pkgs[:1]]
-        self.storage.list.side_effect = lambda _: return_values.pop(0)
+        # The second time we list we will have "deleted" pkgs[1]
+        self.storage.list.return_value = pkgs[:]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set([pkgs[0].filename]),
+            [],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.engine.scan(DynamoPackage).all()
@@ -180,11 +187,16 @@ class TestRedisCache(unittest.TestCase):
         super(TestRedisCache, self).setUp()
         self.db = RedisCache(DummyRequest(), **self.kwargs)
         self.storage = self.db.storage = MagicMock(spec=IStorage)
+        self.storage.list_changes.side_effect = self._list_changes
 
     def tearDown(self):
         super(TestRedisCache, self).tearDown()
         self.redis.flushdb()
 
+    def _list_changes(self, factory, since):
+        """ Mocked method for listing the filenames in storage """
+        return set(p.filename for p in self.storage.list(factory)), []
+
     def _save_pkgs(self, *pkgs):
         """ Save packages to the db """
         pipe = self.redis.pipeline()
@@ -219,21 +231,21 @@ class TestRedisCache(unittest.TestCase):
         self.db.save(pkgs[0])
         self.db.save(pkgs[1])
 
-        # Return first pkgs[1], then pkgs[1:] because the second time we list
-        # we will have "uploaded" pkgs[2]
-        return_values = [lambda: pkgs[1:2], lambda: pkgs[1:]]
-
         def list_storage(package_class):
             """ mocked method for listing storage packages """
-            # The first time we list from storage, concurrently "upload"
-            # pkgs[2]
-            if len(return_values) == 2:
+            # While we list from storage, concurrently "upload" pkgs[2]
+            if len(pkgs) == 2:
                 pkg = make_package("mypkg3")
                 pkgs.append(pkg)
                 self.db.save(pkg)
-            return return_values.pop(0)()
+            return pkgs[1:2]
 
         self.storage.list.side_effect = list_storage
+        # The second time we list we will have "uploaded" pkgs[2]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set(p.filename for p in pkgs[1:]),
+            pkgs[2:],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.db._load_all_packages()
@@ -245,10 +257,12 @@ class TestRedisCache(unittest.TestCase):
         pkgs = [make_package(), make_package("mypkg2")]
         self.db.save(pkgs[0])
 
-        # Return first pkgs[:], then pkgs[:1] because the second time we list
-        # we will have "deleted" pkgs[1]
-        return_values = [pkgs[:], pkgs[:1]]
-        self.storage.list.side_effect = lambda _: return_values.pop(0)
+        # The second time we list we will have "deleted" pkgs[1]
+        self.storage.list.return_value = pkgs[:]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set([pkgs[0].filename]),
+            [],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.db._load_all_packages()
@@ -271,6 +285,59 @@ class TestRedisCache(unittest.TestCase):
         summary = summaries[0]
         self.assertEqual(summary["last_modified"].hour, pkgs[1].last_modified.hour)
 
+    def test_reload_in_batches(self):
+        """ Reconcile storage and the cache a few packages at a time """
+        self.db.reload_batch_size = 2
+        pkgs = [make_package(version="1.%d" % i) for i in range(5)]
+        extra = make_package("mypkg2")
+        self._save_pkgs(pkgs[0], extra)
+        self.storage.list.return_value = pkgs
+        self.db.reload_from_storage()
+        self.assertItemsEqual(self.db._load_all_packages(), pkgs)
+        self.assertEqual(len(self.db.summary()), 1)
+
+    def test_incremental_first_reload(self):
+        """ Without a watermark, do a full reload and store the watermark """
+        self.db.incremental_reload = True
+        keys = [make_package()]
+        self.storage.list.return_value = keys
+        self.db.reload_from_storage()
+        self.assertTrue(self.storage.list.called)
+        self.assertItemsEqual(self.db._load_all_packages(), keys)
+        self.assertIsNotNone(self.db.get_watermark())
+
+    def test_incremental_reload(self):
+        """ With a watermark, only save changed packages and remove deleted """
+        self.db.incremental_reload = True
+        old = make_package(last_modified=datetime.utcnow() - timedelta(hours=1))
+        deleted = make_package("mypkg2", last_modified=old.last_modified)
+        self._save_pkgs(old, deleted)
+        watermark = datetime.utcnow() - timedelta(minutes=30)
+        self.db.set_watermark(watermark)
+        new = make_package(version="1.5")
+        self.storage.list_changes.side_effect = lambda *_: (
+            set([old.filename, new.filename]),
+            [new],
+        )
+        self.db.reload_from_storage()
+        self.assertFalse(self.storage.list.called)
+        self.assertItemsEqual(self.db._load_all_packages(), [old, new])
+        self.assertEqual(len(self.db.summary()), 1)
+        self.assertGreater(self.db.get_watermark(), watermark)
+
+    def test_reload_empty_with_watermark(self):
+        """ If the cache is empty, ignore the watermark and reload everything """
+        self.db.incremental_reload = True
+        watermark = datetime.utcnow() - timedelta(minutes=30)
+        self.db.set_watermark(watermark)
+        keys = [make_package()]
+        self.storage.list.return_value = keys
+        self.db.reload_if_needed()
+        self.assertTrue(self.storage.list.called)
+        self.assertItemsEqual(self.db._load_all_packages(), keys)
+        self.assertGreater(self.db.get_watermark(), watermark)
+        self.assertTrue(self.db.incremental_reload)
+
 
 class TestSQLiteCache(unittest.TestCase):
 
@@ -299,14 +366,21 @@ class TestSQLiteCache(unittest.TestCase):
         self.db = SQLCache(self.request, **self.kwargs)
         self.sql = self.db.db
         self.storage = self.db.storage = MagicMock(spec=IStorage)
+        self.storage.list_changes.side_effect = self._list_changes
 
     def tearDown(self):
         super(TestSQLiteCache, self).tearDown()
         transaction.abort()
         self.sql.query(SQLPackage).delete()
+        self.sql.query(SQLPackageSummary).delete()
+        self.sql.query(SQLMetadata).delete()
         transaction.commit()
         self.request._process_finished_callbacks()
 
+    def _list_changes(self, factory, since):
+        """ Mocked method for listing the filenames in storage """
+        return set(p.filename for p in self.storage.list(factory)), []
+
     def _make_package(self, *args, **kwargs):
         """ Wrapper around make_package """
         # Some SQL dbs are rounding the timestamps (looking at you MySQL >:|
@@ -341,22 +415,22 @@ class TestSQLiteCache(unittest.TestCase):
         self.db.save(pkgs[0])
         self.db.save(pkgs[1])
 
-        # Return first pkgs[1], then pkgs[1:] because the second time we list
-        # we will have "uploaded" pkgs[2]
-        return_values = [lambda: pkgs[1:2], lambda: pkgs[1:]]
-
         def list_storage(package_class):
             """ mocked method for listing storage packages """
-            # The first time we list from storage, concurrently "upload"
-            # pkgs[2]
-            if len(return_values) == 2:
+            # While we list from storage, concurrently "upload" pkgs[2]
+            if len(pkgs) == 2:
                 nowish = datetime.utcnow() + timedelta(seconds=1)
                 pkg = self._make_package("mypkg3", last_modified=nowish)
                 pkgs.append(pkg)
                 self.db.save(pkg)
-            return return_values.pop(0)()
+            return pkgs[1:2]
 
         self.storage.list.side_effect = list_storage
+        # The second time we list we will have "uploaded" pkgs[2]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set(p.filename for p in pkgs[1:]),
+            pkgs[2:],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.sql.query(SQLPackage).all()
@@ -367,10 +441,12 @@ class TestSQLiteCache(unittest.TestCase):
         pkgs = [self._make_package(), self._make_package("mypkg2")]
         self.db.save(pkgs[0])
 
-        # Return first pkgs[:], then pkgs[:1] because the second time we list
-        # we will have "deleted" pkgs[1]
-        return_values = [pkgs[:], pkgs[:1]]
-        self.storage.list.side_effect = lambda _: return_values.pop(0)
+        # The second time we list we will have "deleted" pkgs[1]
+        self.storage.list.return_value = pkgs[:]
+        self.storage.list_changes.side_effect = lambda *_: (
+            set([pkgs[0].filename]),
+            [],
+        )
 
         self.db.reload_from_storage()
         all_pkgs = self.sql.query(SQLPackage).all()
@@ -388,6 +464,60 @@ class TestSQLiteCache(unittest.TestCase):
         all_pkgs = self.sql.query(SQLPackage).all()
         self.assertItemsEqual(all_pkgs, pkgs)
 
+    def test_reload_in_batches(self):
+        """ Reconcile storage and the cache a few packages at a time """
+        self.db.reload_batch_size = 2
+        pkgs = [self._make_package(version="1.%d" % i) for i in range(5)]
+        extra = self._make_package("mypkg2")
+        self.db.save(pkgs[0])
+        self.db.save(extra)
+        self.storage.list.return_value = pkgs
+        self.db.reload_from_storage()
+        self.assertItemsEqual(self.sql.query(SQLPackage).all(), pkgs)
+
+    def test_incremental_first_reload(self):
+        """ Without a watermark, do a full reload and store the watermark """
+        self.db.incremental_reload = True
+        keys = [self._make_package()]
+        self.storage.list.return_value = keys
+        self.db.reload_from_storage()
+        self.assertTrue(self.storage.list.called)
+        self.assertItemsEqual(self.sql.query(SQLPackage).all(), keys)
+        self.assertIsNotNone(self.db.get_watermark())
+
+    def test_incremental_reload(self):
+        """ With a watermark, only save changed packages and remove deleted """
+        self.db.incremental_reload = True
+        last_modified = datetime.utcnow() - timedelta(hours=1)
+        old = self._make_package(last_modified=last_modified)
+        deleted = self._make_package("mypkg2", last_modified=last_modified)
+        self.db.save(old)
+        self.db.save(deleted)
+        watermark = datetime.utcnow() - timedelta(minutes=30)
+        self.db.set_watermark(watermark)
+        new = self._make_package(version="1.5")
+        self.storage.list_changes.side_effect = lambda *_: (
+            set([old.filename, new.filename]),
+            [new],
+        )
+        self.db.reload_from_storage()
+        self.assertFalse(self.storage.list.called)
+        self.assertItemsEqual(self.sql.query(SQLPackage).all(), [old, new])
+        self.assertGreater(self.db.get_watermark(), watermark)
+
+    def test_reload_empty_with_watermark(self):
+        """ If the cache is empty, ignore the watermark and reload everything """
+        self.db.incremental_reload = True
+        watermark = datetime.utcnow() - timedelta(minutes=30)
+        self.db.set_watermark(watermark)
+        keys = [self._make_package()]
+        self.storage.list.return_value = keys
+        self.db.reload_if_needed()
+        self.assertTrue(self.storage.list.called)
+        self.assertItemsEqual(self.sql.query(SQLPackage).all(), keys)
+        self.assertGreater(self.db.get_watermark(), watermark)
+        self.assertTrue(self.db.incremental_reload)
+
 
 class TestMySQLCache(TestSQLiteCache):
     """ Test the SQLAlchemy cache on a MySQL DB """
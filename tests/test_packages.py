@@ -17,9 +17,9 @@ class TestPackages(MockServerTest):
         """ Should return packages with their names and urls """
         self.request.db = MagicMock()
         self.request.db.distinct.return_value = ["a", "b", "c"]
-        self.request.access.has_permission.side_effect = (
-            lambda x, _: x == "b" or x == "c"
-        )
+        self.request.access.filter_readable.side_effect = lambda names: [
+            x for x in names if x == "b" or x == "c"
+        ]
 
         def get_packages(x):
             """ Returns a list of mocked package objects for this package """
@@ -38,7 +38,7 @@ class TestPackages(MockServerTest):
             }
             return d.get(x, [])
 
-        self.request.db.all.side_effect = get_packages
+        self.request.db.all_files.side_effect = get_packages
         result = list_packages(self.request)
         expected = {"b0": "b0.ext", "c0": "c0.ext", "c1": "c1.ext", "c2": "c2.ext"}
         self.assertEqual(result, {"pkgs": expected})
@@ -75,6 +75,7 @@ class TestEndpointSecurity(unittest.TestCase):
             "package.%s.group.authenticated" % package.name: "r",
             "package.%s.group.brotatos" % package.name: "rw",
             "group.brotatos": ["user2"],
+            "auth.signing_key": "abc",
         }
         app = main({}, **settings)
         cls.app = webtest.TestApp(app)
@@ -121,6 +122,55 @@ class TestEndpointSecurity(unittest.TestCase):
         response = self.app.post(url, params, headers=_auth("user2", "user2"))
         self.assertEqual(response.status_int, 200)
 
+    def _token(self, username, scope):
+        """ Create an API token through the API """
+        response = self.app.post(
+            "/api/user/token",
+            {"password": username, "scope": scope},
+            headers=_auth(username, username),
+        )
+        return response.json["token"]
+
+    def test_api_pkg_token(self):
+        """ /api/package/<pkg> accepts API tokens """
+        token = self._token("user", "read")
+        response = self.app.get(
+            "/api/package/%s/" % self.package.name, headers=_auth("__token__", token)
+        )
+        self.assertEqual(response.status_int, 200)
+
+    def test_api_pkg_bad_token(self):
+        """ /api/package/<pkg> rejects invalid API tokens """
+        token = self._token("user", "read")
+        response = self.app.get(
+            "/api/package/%s/" % self.package.name,
+            expect_errors=True,
+            headers={"Authorization": "Bearer " + token + "a"},
+        )
+        self.assertEqual(response.status_int, 401)
+
+    def test_api_pkg_versions_read_token(self):
+        """ Read-only API tokens cannot upload """
+        token = self._token("user2", "read")
+        package = make_package(self.package.name, "1.5")
+        params = {"content": webtest.forms.Upload(package.filename, b"datadatadata")}
+        url = "/api/package/%s/%s" % (package.name, package.filename)
+        response = self.app.post(
+            url, params, expect_errors=True, headers=_auth("__token__", token)
+        )
+        self.assertEqual(response.status_int, 403)
+
+    def test_api_pkg_versions_write_token(self):
+        """ API tokens with write scope can upload """
+        token = self._token("user2", "write")
+        package = make_package(self.package.name, "1.5")
+        params = {"content": webtest.forms.Upload(package.filename, b"datadatadata")}
+        url = "/api/package/%s/%s" % (package.name, package.filename)
+        response = self.app.post(
+            url, params, headers={"Authorization": "Bearer " + token}
+        )
+        self.assertEqual(response.status_int, 200)
+
     def test_api_delete_unauthed(self):
         """ delete /api/package/<pkg>/<filename> requires write perms """
         url = "/api/package/%s/%s" % (self.package.name, self.package.filename)
@@ -1,10 +1,15 @@
 """ Unit tests for the simple endpoints """
 import six
+import transaction
 
+from datetime import datetime
 from mock import MagicMock, patch
+from webob.datetime_utils import UTC
+from webob.etag import AnyETag, ETagMatcher, NoETag
 
 from . import MockServerTest, make_package
 from pypicloud.auth import _request_login
+from pypicloud.util import TimedCache
 from pypicloud.views.simple import (
     upload,
     search,
@@ -28,6 +33,7 @@ class TestSimple(MockServerTest):
     def setUp(self):
         super(TestSimple, self).setUp()
         self.request.access = MagicMock()
+        self.request.access.filter_readable.side_effect = list
 
     def test_upload(self):
         """ Upload endpoint returns the result of api call """
@@ -90,20 +96,97 @@ class TestSimple(MockServerTest):
         upload(self.request, content1, name1, version1)
         upload(self.request, content2, name2, version2)
         upload(self.request, content3, name3, version3)
-        self.request.access.has_permission.side_effect = lambda x, _: x == "pkg1"
+        self.request.access.filter_readable.side_effect = lambda names: [
+            x for x in names if x == "pkg1"
+        ]
         criteria = {"name": ["pkg"]}
         response = search(self.request, criteria, "and")
         self.assertItemsEqual(
             response, [{"name": "pkg1", "version": "1.1", "summary": ""}]
         )
 
-    def test_list(self):
+    @patch("pypicloud.views.simple.render")
+    def test_list(self, render):
         """ Simple list should return api call """
         self.request.db = MagicMock()
         self.request.db.distinct.return_value = ["a", "b", "c"]
-        self.request.access.has_permission.side_effect = lambda x, _: x == "b"
+        self.request.access.filter_readable.side_effect = lambda names: [
+            x for x in names if x == "b"
+        ]
+        render.return_value = "rendered"
+        self.request.if_none_match = NoETag
         result = simple(self.request)
-        self.assertEqual(result, {"pkgs": ["b"]})
+        self.assertEqual(result.text, "rendered")
+        render.assert_called_once_with("simple.jinja2", {"pkgs": ["b"]}, self.request)
+
+    @patch("pypicloud.views.simple.render")
+    def test_list_not_modified(self, render):
+        """ Simple list responds to If-None-Match without the cache """
+        self.request.if_none_match = NoETag
+        render.return_value = "rendered"
+        etag = simple(self.request).etag
+        self.assertIsNotNone(etag)
+        self.request.if_none_match = ETagMatcher([etag])
+        self.assertEqual(simple(self.request).status_code, 304)
+        render.return_value = "changed"
+        self.assertEqual(simple(self.request).text, "changed")
+
+    @patch("pypicloud.views.simple.render")
+    def test_list_cached(self, render):
+        """ Simple list is rendered once per set of principals """
+        self.request.registry.index_cache = TimedCache(None)
+        self.request.db = MagicMock()
+        self.request.db.distinct.return_value = ["a", "b", "c"]
+        self.request.access.filter_readable.side_effect = lambda names: [
+            x for x in names if x == "b"
+        ]
+        render.return_value = "rendered"
+        self.request.if_none_match = NoETag
+        with patch.object(self.request.__class__, "effective_principals", ["user:foo"]):
+            result = simple(self.request)
+            self.assertEqual(result.text, "rendered")
+            simple(self.request)
+        render.assert_called_once_with("simple.jinja2", {"pkgs": ["b"]}, self.request)
+        self.assertEqual(self.request.db.distinct.call_count, 1)
+
+    @patch("pypicloud.views.simple.render")
+    def test_list_cached_not_modified(self, render):
+        """ Cached simple list responds to If-None-Match """
+        self.request.registry.index_cache = TimedCache(None)
+        self.request.if_none_match = NoETag
+        render.return_value = "rendered"
+        etag = simple(self.request).etag
+        self.request.if_none_match = ETagMatcher([etag])
+        self.assertEqual(simple(self.request).status_code, 304)
+
+    @patch("pypicloud.views.simple.render")
+    def test_list_cache_invalidate(self, render):
+        """ Uploading a package drops the rendered simple list """
+        self.request.registry.index_cache = TimedCache(None)
+        self.request.if_none_match = NoETag
+        render.return_value = "rendered"
+        simple(self.request)
+        content = MagicMock()
+        content.filename = "foo-1.2.tar.gz"
+        self.db.upload(content.filename, content, "foo")
+        simple(self.request)
+        self.assertEqual(render.call_count, 2)
+
+    @patch("pypicloud.views.simple.render")
+    def test_list_cache_invalidate_after_commit(self, render):
+        """ A list rendered before the upload is committed is dropped """
+        self.request.registry.index_cache = TimedCache(None)
+        self.request.tm = transaction.TransactionManager()
+        self.request.tm.begin()
+        self.request.if_none_match = NoETag
+        render.return_value = "rendered"
+        content = MagicMock()
+        content.filename = "foo-1.2.tar.gz"
+        self.db.upload(content.filename, content, "foo")
+        simple(self.request)
+        self.request.tm.commit()
+        simple(self.request)
+        self.assertEqual(render.call_count, 2)
 
     def test_fallback_packages(self):
         """ Fetch fallback packages """
@@ -194,7 +277,11 @@ class PackageReadTestBase(unittest.TestCase):
         if path is not None:
             request.path = path
 
-        request.db.all.return_value = pkgs
+        request.db.all_files.return_value = pkgs
+        request.db.version_stamp.return_value = (
+            (package.last_modified, 1) if package is not None else None
+        )
+        request.db.get_url_expiration.return_value = None
         return request
 
     def should_ask_auth(self, request):
@@ -578,3 +665,77 @@ class TestNoFallback(PackageReadTestBase):
     def test_package_write_user(self):
         """ Package, write perms, user. """
         self.should_serve(self.get_request(self.package, "rc", "foo"))
+
+
+class TestConditionalRequests(PackageReadTestBase):
+
+    """ Tests for the ETag on the package pages """
+
+    fallback = "none"
+
+    def get_request(self, *args, **kwargs):
+        request = super(TestConditionalRequests, self).get_request(*args, **kwargs)
+        request.if_none_match = NoETag
+        request.if_modified_since = None
+        return request
+
+    def test_set_validators(self):
+        """ Serving a package sets the ETag """
+        request = self.get_request(self.package, "r")
+        package_versions(self.package, request)
+        self.assertIsNotNone(request.response.etag)
+
+    def test_etag_not_modified(self):
+        """ If-None-Match with the current ETag returns a 304 """
+        request = self.get_request(self.package, "r")
+        package_versions(self.package, request)
+        etag = request.response.etag
+
+        request = self.get_request(self.package, "r")
+        request.if_none_match = ETagMatcher([etag])
+        ret = package_versions(self.package, request)
+        self.assertEqual(ret.status_code, 304)
+        self.assertFalse(request.db.all_files.called)
+
+    def test_etag_changed(self):
+        """ If-None-Match with an old ETag serves the packages """
+        request = self.get_request(self.package, "r")
+        request.if_none_match = ETagMatcher(["abc"])
+        self.should_serve(request)
+
+    def test_etag_file_deleted(self):
+        """ Deleting a file that isn't the newest changes the ETag """
+        request = self.get_request(self.package, "r")
+        package_versions(self.package, request)
+        etag = request.response.etag
+
+        request = self.get_request(self.package, "r")
+        request.db.version_stamp.return_value = (self.package.last_modified, 0)
+        request.if_none_match = ETagMatcher([etag])
+        self.should_serve(request)
+
+    def test_ignore_if_modified_since(self):
+        """ If-Modified-Since can't detect deleted files, so it's ignored """
+        request = self.get_request(self.package, "r")
+        request.if_modified_since = datetime.utcnow().replace(tzinfo=UTC)
+        self.should_serve(request)
+
+    def test_no_read_permission(self):
+        """ Validators are not checked before permissions """
+        request = self.get_request(self.package, "", "foo")
+        request.if_none_match = AnyETag
+        self.should_404(request)
+
+    def test_signed_urls(self):
+        """ With expiring urls the ETag changes over time """
+        request = self.get_request(self.package, "r")
+        request.db.get_url_expiration.return_value = 60
+        with patch("pypicloud.views.simple.time") as time:
+            time.time.return_value = 0
+            package_versions(self.package, request)
+            etag = request.response.etag
+            time.time.return_value = 30
+            request = self.get_request(self.package, "r")
+            request.db.get_url_expiration.return_value = 60
+            request.if_none_match = ETagMatcher([etag])
+            self.should_serve(request)
@@ -79,6 +79,87 @@ class TestS3Storage(unittest.TestCase):
         self.assertEqual(package.filename, filename)
         self.assertEqual(package.summary, None)
 
+    def test_list_many(self):
+        """ Parallel listing finds the packages in every key range """
+        self.storage.prepend_hash = True
+        packages = [make_package(version="1.%d" % i) for i in range(40)]
+        for package in packages:
+            self.storage.upload(package, BytesIO(b"foobar"))
+        # Keys that are not under the hashed prefixes
+        self.bucket.Object("0").put(Body="foobar")
+        self.bucket.Object("zzz/mypkg-9.0.tar.gz").put(Body="foobar")
+        listed = list(self.storage.list(Package))
+        self.assertItemsEqual(
+            [p.filename for p in listed],
+            [p.filename for p in packages] + ["mypkg-9.0.tar.gz"],
+        )
+
+    def test_list_serial(self):
+        """ With one list worker, list the packages serially """
+        self.storage.list_workers = 1
+        package = make_package()
+        self.storage.upload(package, BytesIO(b"foobar"))
+        listed = list(self.storage.list(Package))
+        self.assertEqual(listed, [package])
+
+    def test_list_manifest(self):
+        """ Listing writes a manifest with the package metadata """
+        self.storage.manifest = True
+        package = make_package()
+        self.storage.upload(package, BytesIO(b"foobar"))
+        self.assertEqual(list(self.storage.list(Package)), [package])
+        manifest = self.storage._read_manifest()
+        self.assertItemsEqual(manifest.keys(), [self.storage.get_path(package)])
+
+    def test_list_manifest_no_head(self):
+        """ Packages in the manifest don't need to fetch their metadata """
+        self.storage.manifest = True
+        package = make_package()
+        self.storage.upload(package, BytesIO(b"foobar"))
+        list(self.storage.list(Package))
+        with patch.object(self.storage, "_fetch_metadata") as fetch:
+            listed = list(self.storage.list(Package))
+        self.assertFalse(fetch.called)
+        self.assertEqual(listed, [package])
+        self.assertEqual(listed[0].summary, package.summary)
+
+    def test_list_manifest_reconcile(self):
+        """ The manifest picks up added and deleted packages """
+        self.storage.manifest = True
+        p1 = make_package(version="1.1")
+        p2 = make_package(version="1.2")
+        self.storage.upload(p1, BytesIO(b"foobar"))
+        list(self.storage.list(Package))
+        self.storage.upload(p2, BytesIO(b"foobar"))
+        self.storage.delete(p1)
+        self.assertEqual(list(self.storage.list(Package)), [p2])
+        manifest = self.storage._read_manifest()
+        self.assertItemsEqual(manifest.keys(), [self.storage.get_path(p2)])
+
+    def test_list_changes(self):
+        """ Only HEAD the objects that were modified since the watermark """
+        package = make_package()
+        self.storage.upload(package, BytesIO(b"foobar"))
+        since = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        with patch.object(self.storage, "_fetch_metadata") as fetch:
+            filenames, changed = self.storage.list_changes(Package, since)
+        self.assertFalse(fetch.called)
+        self.assertEqual(filenames, set([package.filename]))
+        self.assertEqual(changed, [])
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        filenames, changed = self.storage.list_changes(Package, since)
+        self.assertEqual(changed, [package])
+        self.assertEqual(changed[0].summary, package.summary)
+
+    def test_list_shards(self):
+        """ Key ranges cover all keys under the prefix """
+        self.storage.bucket_prefix = "pkgs/"
+        shards = self.storage._shards()
+        self.assertEqual(len(shards), 16)
+        self.assertEqual(shards[0], (None, "pkgs/1"))
+        self.assertEqual(shards[1], ("pkgs/1", "pkgs/2"))
+        self.assertEqual(shards[-1], ("pkgs/f", None))
+
     def test_get_url(self):
         """ Mock s3 and test package url generation """
         package = make_package()
@@ -297,6 +378,20 @@ class TestFileStorage(unittest.TestCase):
         self.assertEqual(pkg.filename, package.filename)
         self.assertEqual(pkg.summary, package.summary)
 
+    def test_list_changes(self):
+        """ Only load the packages that were modified since the watermark """
+        old = make_package(version="1.1")
+        new = make_package(version="1.2")
+        self.storage.upload(old, BytesIO(b"foobar"))
+        self.storage.upload(new, BytesIO(b"foobar"))
+        mtime = time.time() - 2 * 60 * 60
+        os.utime(self.storage.get_path(old), (mtime, mtime))
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        filenames, changed = self.storage.list_changes(Package, since)
+        self.assertEqual(filenames, set([old.filename, new.filename]))
+        self.assertEqual(changed, [new])
+        self.assertEqual(changed[0].summary, new.summary)
+
     def test_delete(self):
         """ delete() should remove package from storage """
         package = make_package()
@@ -322,6 +417,81 @@ class TestFileStorage(unittest.TestCase):
         finally:
             os.rmdir(tempdir)
 
+    def test_list_workers(self):
+        """ Package directories can be listed in parallel """
+        packages = [make_package("pkg%d" % i) for i in range(5)]
+        for package in packages:
+            self.storage.upload(package, BytesIO(b"foobar"))
+        self.storage.list_workers = 3
+        listed = list(self.storage.list(Package))
+        self.assertItemsEqual(listed, packages)
+        self.assertEqual(set(pkg.summary for pkg in listed), set(["summary"]))
+
+    def test_index(self):
+        """ The index is built from the directory and kept up to date """
+        settings = {"storage.dir": self.tempdir, "storage.index": "true"}
+        storage = FileStorage(self.request, **FileStorage.configure(settings))
+        old = make_package(version="1.1")
+        storage.upload(old, BytesIO(b"foobar"))
+        self.assertFalse(os.path.exists(storage.index.path))
+        self.assertEqual(list(storage.list(Package)), [old])
+
+        new = make_package(version="1.2", summary="new")
+        storage.upload(new, BytesIO(b"foobar"))
+        storage.delete(old)
+        with patch.object(storage, "_scan") as scan:
+            packages = list(storage.list(Package))
+            scan.assert_not_called()
+        self.assertEqual(packages, [new])
+        self.assertEqual(packages[0].summary, "new")
+
+    def test_index_list_changes(self):
+        """ list_changes reads the mtimes from the index """
+        settings = {"storage.dir": self.tempdir, "storage.index": "true"}
+        storage = FileStorage(self.request, **FileStorage.configure(settings))
+        old = make_package(version="1.1")
+        new = make_package(version="1.2")
+        storage.upload(old, BytesIO(b"foobar"))
+        mtime = time.time() - 2 * 60 * 60
+        os.utime(storage.get_path(old), (mtime, mtime))
+        # Build the index
+        list(storage.list(Package))
+        storage.upload(new, BytesIO(b"foobar"))
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        filenames, changed = storage.list_changes(Package, since)
+        self.assertEqual(filenames, set([old.filename, new.filename]))
+        self.assertEqual(changed, [new])
+
+    def test_sendfile(self):
+        """ X-Sendfile sends the path of the package file """
+        settings = {"storage.dir": self.tempdir, "storage.sendfile": "X-Sendfile"}
+        storage = FileStorage(self.request, **FileStorage.configure(settings))
+        package = make_package()
+        response = storage.download_response(package)
+        self.assertEqual(response.headers["X-Sendfile"], storage.get_path(package))
+        self.assertEqual(response.body, b"")
+
+    def test_accel_redirect(self):
+        """ X-Accel-Redirect sends the internal uri of the package file """
+        settings = {
+            "storage.dir": self.tempdir,
+            "storage.sendfile": "x-accel-redirect",
+            "storage.sendfile_prefix": "/packages/",
+        }
+        storage = FileStorage(self.request, **FileStorage.configure(settings))
+        package = make_package(filename="my pkg-1.1.tar.gz")
+        response = storage.download_response(package)
+        self.assertEqual(
+            response.headers["X-Accel-Redirect"],
+            "/packages/mypkg/1.1/my%20pkg-1.1.tar.gz",
+        )
+
+    def test_accel_redirect_no_prefix(self):
+        """ X-Accel-Redirect requires the internal uri prefix """
+        settings = {"storage.dir": self.tempdir, "storage.sendfile": "x-accel-redirect"}
+        with self.assertRaises(ValueError):
+            FileStorage.configure(settings)
+
     def test_check_health(self):
         """ Base check_health returns True """
         ok, msg = self.storage.check_health()
@@ -1,7 +1,9 @@
 """ Tests for pypicloud utilities """
 from pypicloud import util
+import threading
 import unittest
 from mock import patch
+from pkg_resources import parse_version
 
 
 class TestParse(unittest.TestCase):
@@ -37,6 +39,44 @@ class TestParse(unittest.TestCase):
         self.assertEqual(version, "1.1")
 
 
+class TestSortableVersion(unittest.TestCase):
+
+    """ Tests for sortable_version """
+
+    def test_sort_order(self):
+        """ Keys sort in the same order as parsed versions """
+        versions = [
+            "1.0",
+            "1.0.1",
+            "1.10",
+            "1.9",
+            "1!0.1",
+            "1.0a1",
+            "1.0b2",
+            "1.0rc1",
+            "1.0.dev1",
+            "1.0a1.dev1",
+            "1.0.post1",
+            "1.0.post1.dev1",
+            "1.0+abc.1",
+            "1.0+1",
+            "20181016",
+        ]
+        by_key = sorted(versions, key=util.sortable_version)
+        self.assertEqual(by_key, sorted(versions, key=parse_version))
+
+    def test_equal_versions(self):
+        """ Equal versions have the same key """
+        self.assertEqual(util.sortable_version("1.0"), util.sortable_version("1.0.0"))
+        self.assertEqual(
+            util.sortable_version("1.0-1"), util.sortable_version("1.0.post1")
+        )
+
+    def test_invalid_version(self):
+        """ Invalid versions sort before valid ones """
+        self.assertLess(util.sortable_version("foo"), util.sortable_version("0.0.1"))
+
+
 class TestScrapers(unittest.TestCase):
 
     """ Test the distlib scrapers """
@@ -98,6 +138,51 @@ class TestTimedCache(unittest.TestCase):
         with self.assertRaises(ValueError):
             util.TimedCache(-4)
 
+    @patch("pypicloud.util.time")
+    def test_max_size(self, time):
+        """ Cache evicts the oldest entry when full """
+        cache = util.TimedCache(None, max_size=2)
+        time.time.return_value = 0
+        cache["a"] = 1
+        time.time.return_value = 1
+        cache["b"] = 2
+        cache["b"] = 3
+        time.time.return_value = 2
+        cache["c"] = 4
+        self.assertEqual(cache, {"b": 3, "c": 4})
+
+    @patch("pypicloud.util.time")
+    def test_max_size_expired(self, time):
+        """ Cache evicts expired entries first when full """
+        cache = util.TimedCache(5, max_size=2)
+        time.time.return_value = 0
+        cache.set_expire("a", 1, None)
+        cache["b"] = 2
+        time.time.return_value = 8
+        cache["c"] = 3
+        self.assertEqual(cache, {"a": 1, "c": 3})
+
+    def test_max_size_threads(self):
+        """ Threads can insert into a full cache at the same time """
+        cache = util.TimedCache(None, max_size=10)
+        errors = []
+
+        def insert(start):
+            """ Insert many keys """
+            try:
+                for i in range(start, start + 2000):
+                    cache[i] = i
+            except Exception as e:  # pylint: disable=W0703
+                errors.append(e)
+
+        threads = [threading.Thread(target=insert, args=(i * 10000,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 10)
+
     @patch("pypicloud.util.time")
     def test_cache_time_zero(self, time):
         """ Cache time of 0 never caches """
@@ -164,3 +249,14 @@ class TestTimedCache(unittest.TestCase):
         self.assertTrue("a" not in cache)
         cache.set_expire("b", None, 0)
         self.assertTrue("b" not in cache)
+
+    @patch("pypicloud.util.time")
+    def test_clear(self, time):
+        """ clear() removes values and their expiration times """
+        cache = util.TimedCache(5)
+        time.time.return_value = 0
+        cache["a"] = 1
+        cache.clear()
+        time.time.return_value = 8
+        self.assertTrue("a" not in cache)
+        self.assertEqual(cache.get("a", 5), 5)